@@ -10,6 +10,10 @@ Find original HESE rescan files at:
 This script processes all track maps, converts them to an equatorial map,
 applies 1° smoothing in normal space and normalizes the map to have integral 1
 over the whole sphere.
+
+The truncated maps are stored sparse as binary column files with the non-zero
+pixel indices and values as columns and the remaining source info plus the
+map's `nside` in the header. Load them with `_loader.source_map_loader`.
 """
 from __future__ import print_function, division
 import os
@@ -21,6 +25,7 @@ from concurrent.futures import ProcessPoolExecutor, wait
 import numpy as np
 
 from _paths import PATHS
+from _saver import column_file_saver
 from myi3scripts.hese import make_healpy_map_from_HESE_scan
 from tdepps.utils import get_pixel_in_sigma_region
 
@@ -83,12 +88,14 @@ for map_f in map_files:
     # empirical and resembles the size of smoothing artifacts after visual
     # inspection of the original maps
     _, _, in_region_pix = get_pixel_in_sigma_region(pdf_map, sigma=6.)
-    truncated_map = np.zeros_like(pdf_map)
-    truncated_map[in_region_pix] = pdf_map[in_region_pix]
-
-    # Save map dict again
-    src["map"] = truncated_map.tolist()
-    fname = os.path.join(outpath, os.path.basename(map_f))
+    in_region_pix = np.sort(in_region_pix)
+
+    # Save only the non-zero pixels and the map dict info in the header
+    del src["map"]
+    src["nside"] = int(np.sqrt(len(pdf_map) / 12))
+    cols = {"pix": in_region_pix.astype(np.int64),
+            "vals": pdf_map[in_region_pix].astype(np.float64)}
+    fname = os.path.join(outpath,
+                         os.path.basename(map_f).replace(".json.gz", ".cols"))
     print("- Done, saving truncated map to:\n  {}".format(fname))
-    with gzip.open(fname, "w") as f:
-        json.dump(src, fp=f, indent=2, separators=(",", ":"))
+    column_file_saver(fname, cols=cols, meta=src)
@@ -5,7 +5,8 @@ Make rundicts from official runlists and data selection as stated on the
 analysis wikis.
 
 Datasets are loaded from the skylab dataset module, along with the official run
-selection.
+selection. With `HESE_STACKING_SYNTHETIC=1` the synthetic samples from
+`make_synthetic_data.py` are used instead.
 """
 
 import os
@@ -13,9 +14,8 @@ import json
 import numpy as np
 import astropy.time as astrotime
 
-from skylab.datasets import Datasets
-
 from _paths import PATHS
+from _synthetic import load_datasets
 from myi3scripts import arr2str
 
 
@@ -51,27 +51,29 @@ def make_run_list(ev_times, ev_runids, exclude_runs=None):
     ----------
     .. [1] live.icecube.wisc.edu/snapshots
     """
-    # If selected runs were empty on final level, they are not considered here
-    used_run_ids = np.unique(ev_runids).astype(int)
-    ev_runids = ev_runids.astype(int)
-
+    # Sort by run once, then each run is a contiguous slice. If selected runs
+    # were empty on final level, they are not considered here
+    ev_runids = np.asarray(ev_runids).astype(int)
+    ev_times = np.asarray(ev_times, dtype=float)
     if exclude_runs is not None:
-        used_run_ids = filter(lambda runid: runid not in exclude_runs,
-                              used_run_ids)
+        is_used = ~np.isin(ev_runids, exclude_runs)
+        ev_runids, ev_times = ev_runids[is_used], ev_times[is_used]
         print("  Exluded runs: {}".format(arr2str(exclude_runs, fmt="{:d}")))
 
-    run_list = []
-    livetimes = np.zeros(len(used_run_ids), dtype=float)
-    for i, runid in enumerate(used_run_ids):
-        ev_mask = (ev_runids == runid)
-        ev_t = ev_times[ev_mask]
-        # (Under-) Estimate livetime by difference of last and first event time
-        tstart = astrotime.Time(np.amin(ev_t), format="mjd").iso
-        tstop = astrotime.Time(np.amax(ev_t), format="mjd").iso
-        livetimes[i] = np.amax(ev_t) - np.amin(ev_t)
-        # Append valid run dict to run list
-        run_list.append({"run": runid, "good_tstart": tstart,
-                        "good_tstop": tstop})
+    srt_idx = np.argsort(ev_runids, kind="mergesort")
+    ev_runids, ev_times = ev_runids[srt_idx], ev_times[srt_idx]
+    used_run_ids, first = np.unique(ev_runids, return_index=True)
+
+    # (Under-) Estimate livetime by difference of last and first event time
+    mjd_start = np.minimum.reduceat(ev_times, first)
+    mjd_stop = np.maximum.reduceat(ev_times, first)
+    livetimes = mjd_stop - mjd_start
+
+    # Convert all run borders in a single call
+    tstart = astrotime.Time(mjd_start, format="mjd").iso
+    tstop = astrotime.Time(mjd_stop, format="mjd").iso
+    run_list = [{"run": int(runid), "good_tstart": t0, "good_tstop": t1}
+                for runid, t0, t1 in zip(used_run_ids, tstart, tstop)]
 
     print("  Livetime: {:.3f} days".format(np.sum(livetimes)))
     print("  Had {} / {} runs with non-zero livetime.".format(
@@ -81,6 +83,7 @@ def make_run_list(ev_times, ev_runids, exclude_runs=None):
 
 # Load PS track and GFU data from skylab as record arrays for the 6 years of
 # HESE sources that are analysed here
+Datasets = load_datasets()
 ps_tracks = Datasets["PointSourceTracks"]
 ps_sample_names = ["IC79", "IC86, 2011", "IC86, 2012-2014"]
 gfu_tracks = Datasets["GFU"]
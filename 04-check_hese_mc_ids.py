@@ -5,17 +5,22 @@ Apply HESE filter to sim files and store runIDs, eventIDs and MC primary
 energies for all events surviving the filter.
 The IDs are checked against the final level MCs to sort out any HESE like events
 for sensitivity calulations.
+Run and event IDs are stored packed as ``uint64`` (see `_utils.pack_ids`) in a
+binary column file together with the energy and total charge.
 """
 
 from __future__ import division, print_function
 
-import json
 import argparse
+import numpy as np
 
 from I3Tray import *
 from icecube import icetray, dataclasses, dataio
 from icecube import VHESelfVeto, DomTools, weighting
 
+from _saver import column_file_saver
+from _utils import pack_ids
+
 
 class collector(icetray.I3ConditionalModule):
     """
@@ -62,10 +67,12 @@ class collector(icetray.I3ConditionalModule):
                 self.PushFrame(frame)
 
     def Finish(self):
-        out_dict = {"energy": self.energy, "run_id": self.run_id,
-                    "event_id": self.event_id, "qtot": self.qtot}
-        with open(self.outfile, "w") as outf:
-            json.dump(out_dict, fp=outf, indent=2)
+        cols = {"ids": pack_ids(np.array(self.run_id, dtype=np.int64),
+                                np.array(self.event_id, dtype=np.int64)),
+                "energy": np.array(self.energy, dtype=float),
+                "qtot": np.array(self.qtot, dtype=float)}
+        meta = {"nevts": len(self.run_id)}
+        column_file_saver(self.outfile, cols=cols, meta=meta)
         print("Wrote output file to:\n  ", self.outfile)
 
 
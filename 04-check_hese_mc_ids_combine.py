@@ -1,16 +1,23 @@
 # coding:utf-8
 
 """
-Combine output jsons for each sample to a single file containing only the IDs.
+Combine the per job column files for each sample to a single, sorted and
+unique array of packed ``uint64`` run and event IDs (see `_utils.pack_ids`),
+stored as ``.npy``, so `05-prepare_data_and_mc.py` can memory map it directly.
+Job files are read concurrently with `--nworkers` threads.
+
+Combines are incremental: merged job files are recorded in a manifest (see
+`_manifest.py`) and only the IDs of new job files are added to the existing
+outputs. If a merged job file changed or was removed, that sample is rebuilt.
+`--rebuild` rebuilds everything.
 """
 
 from __future__ import division, print_function
 
-import sys
 import os
-import json
+import argparse
 from glob import glob
-import gzip
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 try:
@@ -20,47 +27,33 @@ except ImportError:
     tqdm = iter
 
 from _paths import PATHS
+from _loader import column_file_loader
+from _manifest import CombineManifest
 from myi3scripts import arr2str
 
+
+def read_ids(fname):
+    """ Packed IDs from a single job file """
+    return column_file_loader(fname, names=["ids"])[0]["ids"]
+
+
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("--nworkers", type=int, default=8)
+parser.add_argument("--rebuild", action="store_true",
+                    help="Ignore the manifest and combine all files again.")
+args = parser.parse_args()
+
 inpath = os.path.join(PATHS.data, "check_hese_mc_ids")
 outpath = os.path.join(PATHS.local, "check_hese_mc_ids")
-if os.path.isdir(outpath):
-    res = raw_input("'{}' already exists. ".format(outpath) +
-                    "\nAllow overwrites (y/n)? ")
-    if not res.lower() in ("y", "yes"):
-        print("Abort. Script has done nothing.")
-        sys.exit()
-    print("  Using output directory '{}'.".format(outpath))
-else:
+if not os.path.isdir(outpath):
     os.makedirs(outpath)
     print("Created output directory '{}'.".format(outpath))
+manifest = CombineManifest(outpath, rebuild=args.rebuild)
 
-files = np.array(glob(os.path.join(inpath, "*.json")))
-file_names = np.array(map(lambda s: os.path.basename(s), files))
-dataset_nums = set(map(lambda s: s.split("_")[0], file_names))
-
-# Combine all to a single JSON file
+files = sorted(glob(os.path.join(inpath, "*.cols")))
+dataset_nums = set(os.path.basename(s).split("_")[0] for s in files)
 print("Reading files from directory:\n  {}".format(inpath))
-print("  Found JSON files for datasets: {}".format(arr2str(dataset_nums)))
-run_ids_per_sam = {}
-event_ids_per_sam = {}
-for num in dataset_nums:
-    print("Combining IDs from set '{}':".format(num))
-    run_ids = []
-    event_ids = []
-    _files = files[map(lambda s: s.startswith(num), file_names)]
-    for fi in tqdm(_files):
-        with open(fi, "r") as inf:
-            di = json.load(inf)
-
-        run_ids += di["run_id"]
-        event_ids += di["event_id"]
-
-    assert len(run_ids) == len(event_ids)
-    print("  Total events filtered: {}".format(len(run_ids)))
-    run_ids_per_sam[num] = run_ids
-    event_ids_per_sam[num] = event_ids
-
+print("  Found column files for datasets: {}".format(arr2str(dataset_nums)))
 
 # Combine to single dict for the seperate datasets
 set2num = {
@@ -78,16 +71,29 @@ comment = {
                        "Sets: {}").format(arr2str(set2num["IC86_2012-2015"]))
 }
 
-for name, nums in set2num.items():
-    print("Combining IDs for sample {}.\n  {}".format(name, comment[name]))
-    out_dict = {"run_id": [], "event_id": [], "comment": comment[name]}
-    for num in nums:
-        out_dict["run_id"] += run_ids_per_sam[num]
-        out_dict["event_id"] += event_ids_per_sam[num]
-    # Save to compressed JSON
-    _outp = os.path.join(outpath, "{}.json.gz".format(name))
-    with gzip.open(_outp, "wb") as outf:
-        json.dump(out_dict, fp=outf, indent=2, separators=(",", ": "))
+with ThreadPoolExecutor(max_workers=args.nworkers) as executor:
+    for name, nums in set2num.items():
+        print("Combining IDs for sample {}.\n  {}".format(name, comment[name]))
+        out_name = "{}.npy".format(name)
+        _outp = os.path.join(outpath, out_name)
+        _files = [s for s in files if os.path.basename(s).split("_")[0] in nums]
+        _files, rebuild = manifest.plan(out_name, _files, _outp)
+        if len(_files) == 0:
+            print("  Up to date.")
+            continue
+        print("  {} {} files".format("Combining" if rebuild else "Adding",
+                                     len(_files)))
+        # Read all job files concurrently, IDs stay packed
+        ids = list(tqdm(executor.map(read_ids, _files)))
+        ids = np.unique(np.concatenate(ids).astype(np.uint64))
+        if not rebuild:
+            ids = np.union1d(np.load(_outp), ids)
+        print("  {} unique IDs.".format(len(ids)))
+        # Save sorted IDs as plain npy to memory map them when matching
+        np.save(_outp + ".tmp.npy", ids)
+        os.rename(_outp + ".tmp.npy", _outp)
         print("  Saved to file:\n    '{}'".format(_outp))
+        manifest.record(out_name, _files)
+        manifest.save()
 
 print("Done")
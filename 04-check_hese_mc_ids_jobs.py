@@ -10,7 +10,7 @@ import os
 from glob import glob
 import numpy as np
 
-from _paths import PATHS
+from _paths import PATHS, job_exe
 from dagman import dagman
 
 
@@ -222,9 +222,9 @@ if __name__ == "__main__":
         assert njobs == len(gcd_list[-1])
         assert np.all(np.array(gcd_list[-1]) == gcd_list[-1][0])
 
-        # Outpath: ..[num]_<increment>.json
+        # Outpath: ..[num]_<increment>.cols
         lead_zeros = int(np.ceil(np.log10(nsplits)))
-        outp = ["{2:}_{1:0{0:d}d}.json".format(lead_zeros, idx, num) for
+        outp = ["{2:}_{1:0{0:d}d}.cols".format(lead_zeros, idx, num) for
                 idx in np.arange(nsplits)]
         out_list.append([os.path.join(outpath, pi) for pi in outp])
 
@@ -246,5 +246,7 @@ if __name__ == "__main__":
                      "env-shell.sh"),
         os.path.join("/bin", "bash")
     ]
-    job_creator.create_job(script=script, job_args=job_args, exe=exe,
+    # Jobs get the resolved paths passed, so they don't need to resolve them
+    job_creator.create_job(script=script, job_args=job_args,
+                           exe=job_exe(exe),
                            job_name=job_name, job_dir=job_dir, overwrite=False)
@@ -10,53 +10,41 @@
 3) Remove HESE like events identified in `04-check_hese_mc_ids` from the
    simulation files.
 4) Remove HESE events from on time data sets.
+
+With `HESE_STACKING_SYNTHETIC=1` the synthetic samples from
+`make_synthetic_data.py` are used instead of the skylab datasets.
 """
 
 import os
-import json
-import gzip
 import numpy as np
-from astropy.time import Time as astrotime
-
-from skylab.datasets import Datasets
 
 from _paths import PATHS
+from _synthetic import load_datasets
 from _loader import source_list_loader, time_window_loader, runlist_loader
+from _loader import hese_mc_ids_loader
+from _utils import match_run_event_ids, pack_ids, in_sorted_ids
 from myi3scripts import arr2str
 
 
-def remove_hese_from_mc(mc, heseids):
+def remove_hese_from_mc(mc, hese_ids):
     """
     Mask all values in ``mc`` that have the same run and event ID combination
-    as in ``heseids``.
+    as in ``hese_ids``.
 
     Parameters
     ----------
     mc : record-array
         Needs names ``'Run', 'Event'``.
-    heseids : dict or record-array
-        Needs names / keys ``'run_id', 'event_id``.
+    hese_ids : array-like
+        Sorted, unique packed ``uint64`` IDs, see ``_utils.pack_ids``. May be
+        a memory map.
 
     Returns
     -------
     is_hese_like : array-like, shape (len(mc),)
         Mask: ``True`` if for each event in ``mc`` that is HESE like.
     """
-    # Make combined IDs to easily match against HESE IDs with `np.isin`
-    factor_mc = 10**np.ceil(np.log10(np.amax(mc["Event"])))
-    _evids = np.atleast_1d(heseids["event_id"])
-    factor_hese = 10**np.ceil(np.log10(np.amax(_evids)))
-    factor = max(factor_mc, factor_hese)
-
-    combined_mcids = (factor * mc["Run"] + mc["Event"]).astype(int)
-    assert np.all(combined_mcids > factor)  # Is int overflow a thing here?
-
-    _runids = np.atleast_1d(heseids["run_id"])
-    combined_heseids = (factor * _runids + _evids).astype(int)
-    assert np.all(combined_heseids > factor)
-
-    # Check which MC event is tagged as HESE like
-    is_hese_like = np.isin(combined_mcids, combined_heseids)
+    is_hese_like = in_sorted_ids(pack_ids(mc["Run"], mc["Event"]), hese_ids)
     print("  Found {} / {} HESE like events in MC".format(np.sum(is_hese_like),
                                                           len(mc)))
     return is_hese_like
@@ -65,6 +53,8 @@ def remove_hese_from_mc(mc, heseids):
 def split_data_on_off(ev_t, src_dicts, dt0, dt1):
     """
     Returns a mask to split experimental data in on and off source regions.
+    The source windows are searched in the sorted event times, so memory is
+    linear in the number of events and sources.
 
     Parameters
     ----------
@@ -83,29 +73,42 @@ def split_data_on_off(ev_t, src_dicts, dt0, dt1):
     -------
     offtime : array-like, shape (len(exp),)
         Mask: ``True`` when event in ``exp`` is in the off data region.
+    src_idx : list of arrays
+        For each source, the sorted indices of the events in ``exp`` that are
+        on time for that source.
     """
     SECINDAY = 24. * 60. * 60.
-    nevts, nsrcs = len(ev_t), len(src_dicts)
+    ev_t = np.atleast_1d(ev_t)
+    nevts = len(ev_t)
+
+    src_t = np.array([src["mjd"] for src in src_dicts], dtype=float)
+    dt0_mjd = src_t + dt0 / SECINDAY
+    dt1_mjd = src_t + dt1 / SECINDAY
 
-    dt0_mjd = np.empty(nsrcs, dtype=float)
-    dt1_mjd = np.empty(nsrcs, dtype=float)
-    for i, src in enumerate(src_dicts):
-        dt0_mjd[i] = src["mjd"] + dt0 / SECINDAY
-        dt1_mjd[i] = src["mjd"] + dt1 / SECINDAY
+    # Each source window is a contiguous slice [lo, hi) in sorted times
+    if np.all(ev_t[1:] >= ev_t[:-1]):
+        srt_idx = np.arange(nevts)
+        ev_t_srt = ev_t
+    else:
+        srt_idx = np.argsort(ev_t, kind="mergesort")
+        ev_t_srt = ev_t[srt_idx]
+    lo = np.searchsorted(ev_t_srt, dt0_mjd, side="left")
+    hi = np.searchsorted(ev_t_srt, dt1_mjd, side="right")
 
-    # Broadcast to test every source at once
-    ev_t = np.atleast_1d(ev_t)[None, :]
-    dt0_mjd, dt1_mjd = dt0_mjd[:, None], dt1_mjd[:, None]
+    # Overlapping windows are merged by counting open windows per event
+    nopen = np.zeros(nevts + 1, dtype=int)
+    np.add.at(nopen, lo, 1)
+    np.add.at(nopen, hi, -1)
+    offtime = np.empty(nevts, dtype=bool)
+    offtime[srt_idx] = np.cumsum(nopen[:-1]) == 0
 
-    ontime = np.logical_and(ev_t >= dt0_mjd, ev_t <= dt1_mjd)
-    offtime = np.logical_not(np.any(ontime, axis=0))
-    assert np.sum(np.any(ontime, axis=0)) + np.sum(offtime) == nevts
+    src_idx = [np.sort(srt_idx[lo_i:hi_i]) for lo_i, hi_i in zip(lo, hi)]
 
     print("  Ontime window duration: {:.2f} sec".format(dt1 - dt0))
-    print("  Ontime events: {} / {}".format(np.sum(ontime), nevts))
-    for i, on_per_src in enumerate(ontime):
-        print("  - Source {}: {} on time".format(i, np.sum(on_per_src)))
-    return offtime
+    print("  Ontime events: {} / {}".format(nevts - np.sum(offtime), nevts))
+    for i, idx in enumerate(src_idx):
+        print("  - Source {}: {} on time".format(i, len(idx)))
+    return offtime, src_idx
 
 
 off_data_outpath = os.path.join(PATHS.data, "data_offtime")
@@ -121,9 +124,10 @@ _dts0, _dts1 = time_window_loader("all")
 dt0_min, dt1_max = np.amin(_dts0), np.amax(_dts1)
 
 # Load runlists
-runlists = runlist_loader("all")
+runlists = runlist_loader("all", index=True)
 
 # Load needed data and MC from PS track and add in one year of GFU sample
+Datasets = load_datasets()
 ps_tracks = Datasets["PointSourceTracks"]
 ps_sample_names = ["IC79", "IC86, 2011", "IC86, 2012-2014"]
 gfu_tracks = Datasets["GFU"]
@@ -132,10 +136,10 @@ all_sample_names = sorted(ps_sample_names + gfu_sample_names)
 
 # Base MC is same for multiple samples, match names here
 name2heseid_file = {
-    "IC79": "IC79.json.gz",
-    "IC86_2011": "IC86_2011.json.gz",
-    "IC86_2012-2014": "IC86_2012-2015.json.gz",
-    "IC86_2015": "IC86_2012-2015.json.gz"
+    "IC79": "IC79",
+    "IC86_2011": "IC86_2011",
+    "IC86_2012-2014": "IC86_2012-2015",
+    "IC86_2015": "IC86_2012-2015"
 }
 
 out_paths = [off_data_outpath, on_data_outpath, mc_outpath]
@@ -161,33 +165,34 @@ for name in all_sample_names:
     name = name.replace(", ", "_")
 
     # Remove events before first and after last run per sample
-    first_run = min(map(lambda d: astrotime(d["good_tstart"],
-                                            format="iso").mjd, runlists[name]))
-    last_run = max(map(lambda d: astrotime(d["good_tstop"],
-                                           format="iso").mjd, runlists[name]))
+    first_run, last_run = runlists[name].tmin, runlists[name].tmax
     is_inside_runs = (exp["time"] >= first_run) & (exp["time"] <= last_run)
     print("  Removing {} / {} events outside runs.".format(
         np.sum(~is_inside_runs), len(exp)))
     exp = exp[is_inside_runs]
 
     # Split data in on and off parts with the largest time window
-    is_offtime = split_data_on_off(exp["time"], sources[name], dt0_min, dt1_max)
+    is_offtime, _ = split_data_on_off(exp["time"], sources[name], dt0_min,
+                                      dt1_max)
 
     # Remove HESE like events from MC
-    _fname = os.path.join(PATHS.local, "check_hese_mc_ids",
-                          name2heseid_file[name])
-    with gzip.open(_fname) as _file:
-        heseids = json.load(_file)
-        print("  Loaded HESE like MC IDs from :\n    {}".format(_fname))
-    is_hese_like = remove_hese_from_mc(mc, heseids)
-
-    # Remove HESE events from ontime data
+    _name = name2heseid_file[name]
+    hese_ids = hese_mc_ids_loader(_name, mmap=True)[_name]
+    is_hese_like = remove_hese_from_mc(mc, hese_ids)
+
+    # Remove HESE events from ontime data, they are the sources themselves
     exp_ontime = exp[~is_offtime]
-    raise NotImplementedError("Remove HESE from ontime data!")
+    is_hese_src = match_run_event_ids(
+        exp_ontime["Run"], exp_ontime["Event"],
+        [src["run_id"] for src in sources[name]],
+        [src["event_id"] for src in sources[name]])
+    print("  Removing {} / {} HESE source events from ontime data.".format(
+        np.sum(is_hese_src), len(exp_ontime)))
+    exp_ontime = exp_ontime[~is_hese_src]
 
     # Save, also in npy format
     print("  Saving on, off and non-HESE like MCs at:")
-    out_arrs = [exp[is_offtime], exp[~is_offtime], mc[~is_hese_like]]
+    out_arrs = [exp[is_offtime], exp_ontime, mc[~is_hese_like]]
     for out_path, arr in zip(out_paths, out_arrs):
         _fname = os.path.join(out_path, name + ".npy")
         np.save(file=_fname, arr=arr)
@@ -0,0 +1,68 @@
+# coding: utf-8
+
+"""
+Fit the background injectors and LLH models for each sample and time window
+once and store them as snapshots in `PATHS.data/model_snapshots`.
+The trial scripts `07`, `09` and `10` load these instead of refitting splines
+and PDFs in every single job.
+
+Snapshots are only rebuilt, if the content hash of their input data and
+settings changed. Use `--force` to rebuild all.
+Large model arrays are stored once per content in `model_snapshots/arrays`,
+see `_models.py`. Array files no snapshot refers to anymore are removed.
+"""
+
+import gc
+import os
+import argparse
+from glob import glob
+import numpy as np
+
+from _paths import PATHS
+from _models import build_sample_models, save_model_snapshot, snapshot_path
+from _models import inputs_hash, load_snapshot_hash, load_snapshot_header
+import _loader
+
+
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("--force", action="store_true")
+args = parser.parse_args()
+
+outpath = os.path.join(PATHS.data, "model_snapshots")
+if not os.path.isdir(outpath):
+    os.makedirs(outpath)
+
+# The random state doesn't matter here, it is replaced in each trial job
+rndgen = np.random.RandomState(0)
+
+all_tw_ids = _loader.time_window_loader()
+sample_names = _loader.source_list_loader()
+for tw_id in all_tw_ids:
+    dt0, dt1 = _loader.time_window_loader(tw_id)
+    for key in sample_names:
+        fname = snapshot_path(key, tw_id)
+        digest = inputs_hash(key, tw_id)
+        if not args.force and load_snapshot_hash(fname) == digest:
+            print("Snapshot for sample {}, tw {:02d} is up to date.".format(
+                key, tw_id))
+            continue
+
+        bg_inj, llh = build_sample_models(key, dt0, dt1, rndgen)
+        save_model_snapshot(fname, bg_inj, llh, key, tw_id, digest)
+        print("Saved snapshot to:\n  {}".format(fname))
+
+        del bg_inj
+        del llh
+        gc.collect()
+
+# Remove array files of replaced snapshots
+used = set()
+for fname in glob(os.path.join(outpath, "*.pkl")):
+    header = load_snapshot_header(fname)
+    if header is not None:
+        used.update(header["arrays"])
+unused = [fname for fname in glob(os.path.join(outpath, "arrays", "*.npy"))
+          if os.path.basename(fname)[:-len(".npy")] not in used]
+for fname in unused:
+    os.remove(fname)
+print("Removed {} unused snapshot array files.".format(len(unused)))
@@ -2,99 +2,112 @@
 
 """
 Single job of background only trials.
-Loads data and settings and builds the models, likelihoods and injectors to do
-the trials with.
+Loads the injectors and LLHs from the snapshots made in `06-make_snapshots.py`
+or builds them from data and settings if no valid snapshot is available.
+
+With `--summary` only a mergeable histogram plus the exact `--topk` largest ts
+values are stored instead of every single trial.
+
+With `--engine batched`, `--batch_size` trials are injected at once and all
+`ns` are fitted with vectorized numpy instead of one minimizer call per trial.
+`--check N` compares the batched fit to the minimizer in N extra trials first
+and aborts, if the `ts` differ.
+With `--grad_shortcut`, the minimizer is only called for trials with a
+positive LLH gradient at `ns = 0`, all others are exactly `ts = 0` trials.
+With `--empty_fastpath`, the event counts of all trials are drawn in bulk and
+trials without any event are booked as `ts = 0` without injection. Only the
+remaining trials are injected and fitted with the batched engine.
+With `--bias k > 1`, the expected background counts are scaled by `k` to
+oversample the tail and each trial gets its importance weight stored. The
+weight variance grows exponentially with the total expected background, see
+`_trials.do_biased_trials` for the usable range of `k`. These
+weighted trials are saved to `bg_trials_biased` and combined and turned into
+PDFs with the `--biased` options of the `07` combine and `08` scripts.
+With `--all_windows`, `--tw_id` is ignored and the events are injected once
+for the largest time window. Each trial is then fitted in all nested time
+windows in a single pass, see `_trials.NestedWindowEvaluator`, and one output
+file `tw_XX_allwin_job_<job_id>.cols` per time window is written, as if from a
+separate job per window. The distinct prefix keeps them apart from the per
+window job files. Each file gets its own `rnd_seed` derived from the job's
+seed, which is stored as `job_rnd_seed`. The other trial engines and options
+don't apply to `--all_windows`.
 """
 
 import gc  # Manual garbage collection
 import os
-import json
-import gzip
 import argparse
 import numpy as np
 
-from tdepps.utils import make_src_records
-from tdepps.grb import GRBLLH, GRBModel, MultiGRBLLH
-from tdepps.grb import TimeDecDependentBGDataInjector
+from tdepps.grb import MultiGRBLLH
 from tdepps.grb import MultiBGDataInjector
 from tdepps.grb import GRBLLHAnalysis
-import tdepps.utils.phys as phys
 from _paths import PATHS
+from _models import get_sample_models
+from _saver import column_file_saver, TRIAL_DTYPE
+from _utils import print_memory_report
+from _trial_stats import make_ts_summary, SUMMARY_COLS, TOPK
+from _trials import do_batched_trials, check_batched_trials
+from _trials import do_grad_shortcut_trials, do_empty_fastpath_trials
+from _trials import do_biased_trials, time_window_views
+from _trials import check_time_window_views
+from _trials import NestedWindowEvaluator, do_nested_window_trials
+from _trials import check_nested_windows, sample_probe
 import _loader
 
 
-def flux_model_factory(model, **model_args):
-    """
-    Returns a flux model callable `flux_model(trueE)`.
-
-    Parameters
-    ----------
-    model : str
-        Name of a method in ``tdeps.utils.phys``.
-    model_args : dict
-        Arguments passed to ``tdeps.utils.phys.<model>``.
-
-    Returns
-    -------
-    flux_model : callable
-        Function of single parameter, true energy, with fixed model args.
-    """
-    def flux_model(trueE):
-        flux_mod = getattr(phys, model)
-        return flux_mod(trueE, **model_args)
-
-    return flux_model
-
-
 parser = argparse.ArgumentParser(description="hese_stacking")
 parser.add_argument("--rnd_seed", type=int)
 parser.add_argument("--ntrials", type=int)
 parser.add_argument("--job_id", type=str)
 parser.add_argument("--tw_id", type=int)
+parser.add_argument("--summary", action="store_true")
+parser.add_argument("--topk", type=int, default=TOPK)
+parser.add_argument("--engine", type=str, default="loop",
+                    choices=["loop", "batched"])
+parser.add_argument("--batch_size", type=int, default=10000)
+parser.add_argument("--check", type=int, default=0)
+parser.add_argument("--grad_shortcut", action="store_true")
+parser.add_argument("--empty_fastpath", action="store_true")
+parser.add_argument("--bias", type=float, default=1.,
+                    help="Scale the background counts for importance " +
+                         "sampling. The effective trials drop like " +
+                         "exp(-nb_tot * (bias - 1)**2 / bias) with the " +
+                         "total expected background nb_tot, so keep this " +
+                         "close to 1 for large nb_tot.")
+parser.add_argument("--all_windows", action="store_true")
 args = parser.parse_args()
+if args.bias != 1. and args.summary:
+    raise ValueError("Weighted trials can't be stored as summary.")
+if args.all_windows:
+    # The nested window evaluator is its own engine, it ignores the others
+    for flag, used in [("--engine batched", args.engine == "batched"),
+                       ("--grad_shortcut", args.grad_shortcut),
+                       ("--empty_fastpath", args.empty_fastpath),
+                       ("--bias", args.bias != 1.)]:
+        if used:
+            parser.error("{} can't be combined with --all_windows.".format(
+                flag))
+if args.grad_shortcut and args.engine == "batched":
+    parser.error("--grad_shortcut uses the minimizer, it can't be combined " +
+                 "with --engine batched.")
 rnd_seed = args.rnd_seed
 ntrials = args.ntrials
 job_id = args.job_id
 tw_id = args.tw_id
+if args.all_windows:
+    # Use the largest time window for the injector
+    tw_id = _loader.time_window_loader()[-1]
 
 rndgen = np.random.RandomState(rnd_seed)
 dt0, dt1 = _loader.time_window_loader(tw_id)
 
-# Load files and build the models one after another to save memory
+# Load the fitted models from snapshots one after another to save memory
 bg_injs = {}
-sig_injs = {}
 llhs = {}
 
-# Load files and build the models one after another to save memory
 sample_names = _loader.source_list_loader()
 for key in sample_names:
-    print("\n" + 80 * "#")
-    print("# :: Setup for sample {} ::".format(key))
-    opts = _loader.settings_loader(key)[key].copy()
-    exp_off = _loader.off_data_loader(key)[key]
-    mc = _loader.mc_loader(key)[key]
-    srcs = _loader.source_list_loader(key)[key]
-    runlist = _loader.runlist_loader(key)[key]
-    # Process to tdepps format
-    srcs_rec = make_src_records(srcs, dt0=dt0, dt1=dt1)
-
-    # Setup BG injector
-    bg_inj_i = TimeDecDependentBGDataInjector(inj_opts=opts["bg_inj_opts"],
-                                              random_state=rndgen)
-    bg_inj_i.fit(X=exp_off, srcs=srcs_rec, run_list=runlist)
-    bg_injs[key] = bg_inj_i
-
-    # Setup LLH model and LLH
-    fmod = opts["model_energy_opts"].pop("flux_model")
-    flux_model = flux_model_factory(fmod["model"], **fmod["args"])
-    opts["model_energy_opts"]["flux_model"] = flux_model
-    llhmod = GRBModel(X=exp_off, MC=mc, srcs=srcs_rec, run_list=runlist,
-                      spatial_opts=opts["model_spatial_opts"],
-                      energy_opts=opts["model_energy_opts"])
-    llhs[key] = GRBLLH(llh_model=llhmod, llh_opts=opts["llh_opts"])
-
-    del exp_off
-    del mc
+    bg_injs[key], llhs[key] = get_sample_models(key, tw_id, rndgen)
     gc.collect()
 
 # Build the multi models
@@ -106,29 +119,106 @@ multi_llh = MultiGRBLLH(llh_opts=multi_llh_opts)
 multi_llh.fit(llhs=llhs)
 
 ana = GRBLLHAnalysis(multi_llh, multi_bg_inj, sig_inj=None)
+print_memory_report("after setup")
 
 # Do the background trials
 print("Time window ID is: {}".format(tw_id))
 print(":: Starting {} background trials ::".format(ntrials))
-# Seed close to zero, which is close to the minimum for most cases
-trials, nzeros, _ = ana.do_trials(n_trials=ntrials, n_signal=None, ns0=0.1,
-                                  full_out=False)
+nskipped = 0
+nempty = 0
+wzeros = None
+if args.all_windows:
+    # Trials for all windows at once, the LLH views are only needed for the
+    # window coefficients and the check
+    tw_ids = _loader.time_window_loader()
+    dt0s, dt1s = _loader.time_window_loader("all")
+    views = time_window_views(multi_llh, dt0s, dt1s)
+    srcs = _loader.source_list_loader("all")
+    src_mjds = {key: [src["mjd"] for src in srcs[key]] for key in llhs}
+    # Separate random state, so the probe doesn't shift the trials
+    probe = sample_probe(bg_injs, 100)
+    evaluator = NestedWindowEvaluator(llhs, views, dt0s, dt1s, src_mjds,
+                                      probe=probe)
+    if args.check > 0:
+        check_time_window_views(multi_llh, views, dt0s, dt1s, bg_injs,
+                                n_trials=args.check)
+        check_nested_windows(views, evaluator, bg_injs, n_trials=args.check)
+    del views, probe
+    gc.collect()
+    trials, nzeros = do_nested_window_trials(
+        bg_injs, evaluator, n_trials=ntrials, batch_size=args.batch_size)
+    results = list(zip(tw_ids, dt0s, dt1s, trials, nzeros))
+elif args.bias != 1.:
+    trials, nzeros, wzeros = do_biased_trials(
+        bg_injs, llhs, n_trials=ntrials, rndgen=rndgen, bias=args.bias,
+        batch_size=args.batch_size)
+elif args.empty_fastpath:
+    if args.check > 0:
+        check_batched_trials(multi_llh, bg_injs, llhs, n_trials=args.check)
+    trials, nzeros, nempty = do_empty_fastpath_trials(
+        bg_injs, llhs, n_trials=ntrials, rndgen=rndgen,
+        batch_size=args.batch_size)
+elif args.engine == "batched":
+    if args.check > 0:
+        check_batched_trials(multi_llh, bg_injs, llhs, n_trials=args.check)
+    trials, nzeros, nskipped = do_batched_trials(
+        bg_injs, llhs, n_trials=ntrials, batch_size=args.batch_size)
+elif args.grad_shortcut:
+    trials, nzeros, nskipped = do_grad_shortcut_trials(
+        multi_llh, bg_injs, llhs, n_trials=ntrials, ns0=0.1)
+else:
+    # Seed close to zero, which is close to the minimum for most cases
+    trials, nzeros, _ = ana.do_trials(n_trials=ntrials, n_signal=None,
+                                      ns0=0.1, full_out=False)
+if not args.all_windows:
+    results = [(tw_id, dt0, dt1, trials, nzeros)]
 print(":: Done ::")
 
-# Save as JSON
-outpath = os.path.join(PATHS.data, "bg_trials")
-if not os.path.isdir(outpath):
-    os.makedirs(outpath)
-
-out = {"ns": trials["ns"].tolist(),
-       "ts": trials["ts"].tolist(),
-       "nzeros": nzeros,
-       "time_window": [dt0, dt1],
-       "time_window_id": tw_id,
-       "rnd_seed": rnd_seed,
-       "ntrials": ntrials}
-
-fname = os.path.join(outpath, "tw_{:02d}_job_{}.json.gz".format(tw_id, job_id))
-with gzip.open(fname, "w") as outfile:
-    json.dump(out, fp=outfile, indent=2)
+for tw_id, dt0, dt1, trials, nzeros in results:
+    meta = {"nzeros": int(nzeros),
+            "nskipped": nskipped,
+            "nempty": nempty,
+            "time_window": [float(dt0), float(dt1)],
+            "time_window_id": int(tw_id),
+            "rnd_seed": rnd_seed,
+            "ntrials": ntrials}
+    if args.all_windows:
+        # Distinct seed per window file. Job seeds are < 1e6, so these don't
+        # collide with the seeds of any other job
+        meta["rnd_seed"] = rnd_seed * 100 + int(tw_id) + 100000000
+        meta["job_rnd_seed"] = rnd_seed
+        meta["all_windows"] = True
+
+    if args.summary:
+        # Save only the mergeable histogram and tail summary
+        outpath = os.path.join(PATHS.data, "bg_trials_summary")
+        summary = make_ts_summary(trials["ts"], nzeros=nzeros,
+                                  ntrials=ntrials, topk=args.topk)
+        cols = {key: summary[key] for key in SUMMARY_COLS}
+        meta["noverflow"] = summary["noverflow"]
+        meta["topk"] = args.topk
+        dtype = None
+    elif wzeros is not None:
+        # Keep the weights in full precision, they span many orders of
+        # magnitude
+        outpath = os.path.join(PATHS.data, "bg_trials_biased")
+        cols = {"ns": trials["ns"].astype(TRIAL_DTYPE),
+                "ts": trials["ts"].astype(TRIAL_DTYPE),
+                "weights": trials["weights"]}
+        meta["wzeros"] = wzeros
+        meta["bias"] = args.bias
+        dtype = None
+    else:
+        # Save all trials as binary column file
+        outpath = os.path.join(PATHS.data, "bg_trials")
+        cols = {"ns": trials["ns"], "ts": trials["ts"]}
+        dtype = TRIAL_DTYPE
+
+    if not os.path.isdir(outpath):
+        os.makedirs(outpath)
+
+    prefix = "tw_{:02d}_allwin" if args.all_windows else "tw_{:02d}"
+    fname = os.path.join(outpath, (prefix + "_job_{}.cols").format(tw_id,
+                                                                   job_id))
+    column_file_saver(fname, cols=cols, meta=meta, dtype=dtype)
     print("Saved to:\n  {}".format(fname))
@@ -2,50 +2,127 @@
 
 """
 Combine output for each time window to a single file containing all trials.
+Trials are streamed file by file into a memory mapped output, so memory usage
+is bounded by a single job file and not by the full time window.
+
+With `--summary` the trial summaries from `07-bg_trials.py --summary` are
+merged by addition instead.
+With `--biased` the importance weighted trials from `07-bg_trials.py --bias`
+are combined, the summed weights of the zero trials are added up.
+
+Combines are incremental: merged job files are recorded in a manifest (see
+`_manifest.py`) and only new job files are appended to the existing outputs in
+place, rewriting only the file header (see `_saver.column_file_appender`).
+Files with an already merged seed are skipped. If a merged job file changed or
+was removed, that time window is rebuilt. `--rebuild` rebuilds everything.
 """
 
 import os
-import sys
-import json
-import gzip
+import argparse
 from glob import glob
 
-try:
-    from tqdm import tqdm
-except ImportError:
-    print("If you want fancy status bars: `pip install --user tqdm` ;)")
-    tqdm = iter
-
 from _paths import PATHS
-from _loader import time_window_loader
+from _loader import time_window_loader, column_file_header_loader
+from _loader import column_file_loader
+from _saver import column_file_merger, column_file_appender
+from _saver import column_file_saver
+from _trial_stats import merge_ts_summaries, SUMMARY_COLS, SUMMARY_COUNTS
+from _manifest import CombineManifest
 
 
-inpath = os.path.join(PATHS.data, "bg_trials")
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("--summary", action="store_true")
+parser.add_argument("--biased", action="store_true")
+parser.add_argument("--rebuild", action="store_true",
+                    help="Ignore the manifest and combine all files again.")
+args = parser.parse_args()
+if args.biased and args.summary:
+    parser.error("Weighted trials are not stored as summaries.")
 
-outpath = os.path.join(PATHS.data, "bg_trials_combined")
-if os.path.isdir(outpath):
-    res = raw_input("'{}' already exists. ".format(outpath) +
-                    "\nAllow overwrites (y/n)? ")
-    if not res.lower() in ("y", "yes"):
-        print("Abort. Script has done nothing.")
-        sys.exit()
-    print("  Using output directory '{}'.".format(outpath))
+if args.biased:
+    inpath = os.path.join(PATHS.data, "bg_trials_biased")
+    outpath = os.path.join(PATHS.data, "bg_trials_biased_combined")
+elif args.summary:
+    inpath = os.path.join(PATHS.data, "bg_trials_summary")
+    outpath = os.path.join(PATHS.data, "bg_trials_summary_combined")
 else:
+    inpath = os.path.join(PATHS.data, "bg_trials")
+    outpath = os.path.join(PATHS.data, "bg_trials_combined")
+if not os.path.isdir(outpath):
     os.makedirs(outpath)
     print("Created output directory '{}'.".format(outpath))
+manifest = CombineManifest(outpath, rebuild=args.rebuild)
 
 # Collect for all time windows
 all_tw_ids = time_window_loader()
 for tw_id in all_tw_ids:
-    file_path = os.path.join(inpath, "tw_{:02d}_job_*.json.gz".format(tw_id))
-    files = sorted(glob(file_path))
+    # Files from per window jobs and from `07-bg_trials.py --all_windows`
+    files = []
+    for pattern in ["tw_{:02d}_job_*.cols", "tw_{:02d}_allwin_job_*.cols"]:
+        files += glob(os.path.join(inpath, pattern.format(tw_id)))
+    files = sorted(files)
     print("Time window {:02d}, found {} trial files:".format(tw_id, len(files)))
-    if len(files) > 0:
-        print("  {}\n  ...\n  {}".format(files[0], files[-1]))
-        # Build output dict
-        trials = {
-            "ns": [],
-            "ts": [],
+    out_name = "tw_{:02d}.cols".format(tw_id)
+    fpath = os.path.join(outpath, out_name)
+    if len(files) == 0:
+        print("  - no trials found")
+        continue
+
+    files, rebuild = manifest.plan(out_name, files, fpath)
+    if len(files) == 0:
+        print("  - up to date")
+        continue
+    print("  {}\n  ...\n  {}".format(files[0], files[-1]))
+    print("  - {} {} files".format("Combining" if rebuild else "Adding",
+                                   len(files)))
+    # Only the headers of the new files are read to check the seeds
+    metas = {_file: column_file_header_loader(_file)[0] for _file in files}
+    seeds = [metas[_file]["rnd_seed"] for _file in files]
+    # The output header also knows files merged by an interrupted combine
+    out_seeds = None
+    if not rebuild:
+        out_seeds = column_file_header_loader(fpath)[0]["rnd_seed"]
+    files, seeds = manifest.drop_duplicate_seeds(out_name, files, seeds,
+                                                 out_seeds)
+    metas = [metas[_file] for _file in files]
+    if len(files) == 0:
+        manifest.save()
+        continue
+
+    if args.summary:
+        # Summaries are small, load them all and merge by addition
+        summaries, ntrials_per_batch, topks = [], [], []
+        if not rebuild:
+            cols, meta_old = column_file_loader(fpath)
+            cols.update({key: meta_old[key] for key in SUMMARY_COUNTS})
+            summaries.append(cols)
+            topks.append(meta_old["topk"])
+        for _file in files:
+            cols, meta_i = column_file_loader(_file)
+            cols.update({key: meta_i[key] for key in SUMMARY_COUNTS})
+            summaries.append(cols)
+            ntrials_per_batch.append(meta_i["ntrials"])
+            topks.append(meta_i["topk"])
+        # Merged tail is only exact up to the smallest stored tail length
+        topk = min(topks)
+        summary = merge_ts_summaries(summaries, topk=topk)
+        meta = {key: summary[key] for key in SUMMARY_COUNTS}
+        meta.update({"time_window": meta_i["time_window"],
+                     "time_window_id": meta_i["time_window_id"],
+                     "rnd_seed": seeds,
+                     "ntrials_per_batch": ntrials_per_batch,
+                     "topk": topk})
+        if not rebuild:
+            meta["rnd_seed"] = meta_old["rnd_seed"] + seeds
+            meta["ntrials_per_batch"] = (meta_old["ntrials_per_batch"] +
+                                         ntrials_per_batch)
+        column_file_saver(fpath + ".tmp", cols={key: summary[key] for key in
+                                                SUMMARY_COLS}, meta=meta)
+        os.rename(fpath + ".tmp", fpath)
+        print("  - Merged summaries of {} trials".format(meta["ntrials"]))
+    else:
+        # Build output metadata from the file headers only
+        meta = {
             "time_window": None,
             "time_window_id": -1,
             "nzeros": 0,
@@ -53,22 +130,31 @@ for tw_id in all_tw_ids:
             "ntrials": 0,
             "ntrials_per_batch": [],
             }
-        # Concatenate all files
-        for _file in tqdm(files):
-            with gzip.open(_file) as infile:
-                trial_i = json.load(infile)
-            trials["ns"] += trial_i["ns"]
-            trials["ts"] += trial_i["ts"]
-            trials["nzeros"] += trial_i["nzeros"]
-            trials["ntrials"] += trial_i["ntrials"]
-            trials["rnd_seed"].append(trial_i["rnd_seed"])
-            trials["ntrials_per_batch"].append(trial_i["ntrials"])
-        trials["time_window"] = trial_i["time_window"]
-        trials["time_window_id"] = trial_i["time_window_id"]
-        # Save it
-        fpath = os.path.join(outpath, "tw_{:02d}.json.gz".format(tw_id))
-        with gzip.open(fpath, "w") as outf:
-            json.dump(trials, fp=outf, indent=0, separators=(",", ":"))
-            print("  - Saved to:\n    {}".format(fpath))
-    else:
-        print("  - no trials found")
+        if args.biased:
+            meta["wzeros"] = 0.
+        if not rebuild:
+            # Start from the existing output, which is merged first
+            meta = column_file_header_loader(fpath)[0]
+        for meta_i in metas:
+            if args.biased:
+                meta["wzeros"] += meta_i["wzeros"]
+            meta["nzeros"] += meta_i["nzeros"]
+            meta["ntrials"] += meta_i["ntrials"]
+            meta["rnd_seed"].append(meta_i["rnd_seed"])
+            meta["ntrials_per_batch"].append(meta_i["ntrials"])
+        meta["time_window"] = meta_i["time_window"]
+        meta["time_window_id"] = meta_i["time_window_id"]
+        if rebuild:
+            # Stream all files into the preallocated output, the old output is
+            # replaced only when the new one is complete
+            # Reserve space, so the next new files are appended in place
+            nrows = column_file_merger(fpath + ".tmp", files, meta=meta,
+                                       grow=2.)
+            os.rename(fpath + ".tmp", fpath)
+        else:
+            # Write the new trials behind the existing ones
+            nrows = column_file_appender(fpath, files, meta=meta)
+        print("  - Merged {} non-zero trials".format(sum(nrows["ts"])))
+    print("  - Saved to:\n    {}".format(fpath))
+    manifest.record(out_name, files, seeds)
+    manifest.save()
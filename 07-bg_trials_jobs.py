@@ -2,21 +2,53 @@
 
 """
 Create jobfiles for `07-bg_trials.py`.
+With `--local` the jobs are run directly on this machine using all cores,
+limit the concurrent jobs with `--nworkers`.
+With `--bias k`, importance sampled jobs are created, see `07-bg_trials.py`.
+These reach the far tail with much fewer trials, so reduce `--ntrials` too.
+Biased jobs use their own seed range, so their trials are independent of the
+unbiased ones.
+The number of jobs per time window is chosen from the trial rates in the
+`bench_trials.py` benchmark file, so that each job runs `--target_hours`.
 
 ##############################################################################
-# Used seed range for bg trial jobs: [0, 100000]
+# Used seed range for bg trial jobs: [10000, 100000)
+# Used seed range for biased bg trial jobs: [110000, 200000)
 ##############################################################################
 """
 
 import os
+import argparse
 import numpy as np
 
-from dagman import dagman
-from _paths import PATHS
+from _paths import PATHS, job_exe, creator_default_exe
 from _loader import time_window_loader
+from _executor import LocalJobExecutor
+from _job_planner import load_trial_rates, plan_jobs
 
 
-job_creator = dagman.DAGManJobCreator(mem=2)
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("--local", action="store_true",
+                    help="Run all jobs on this machine instead of DAGMan.")
+parser.add_argument("--nworkers", type=int, default=None)
+parser.add_argument("--ntrials", type=float, default=1e8)
+parser.add_argument("--bias", type=float, default=1.,
+                    help="Importance sampling factor, see `07-bg_trials.py`.")
+parser.add_argument("--target_hours", type=float, default=1.)
+parser.add_argument("--benchmark", type=str, default=None,
+                    help="Benchmark file with the trial rates per time " +
+                         "window. Default: file from `bench_trials.py`.")
+args = parser.parse_args()
+
+if args.local:
+    job_creator = LocalJobExecutor(mem=2, max_workers=args.nworkers)
+    exe = job_exe()
+else:
+    # Cluster tooling is only needed for the DAG files
+    from dagman import dagman
+    job_creator = dagman.DAGManJobCreator(mem=2)
+    # Keep the default DAG job command, only the environment is added
+    exe = job_exe(creator_default_exe(job_creator))
 job_name = "hese_transient_stacking"
 
 job_dir = os.path.join(PATHS.jobs, "bg_trials")
@@ -24,41 +56,49 @@ script = os.path.join(PATHS.repo, "07-bg_trials.py")
 
 # Get time windows
 all_tw_ids = time_window_loader()
-ntime_windows = len(all_tw_ids)
 
-# Timing tests: For 6 year pass2 HESE, 5 years PS tracks data, 1 year GFU
-# tw00: 1e6 trials in ~661s -> ~2770 trials / sec
-# tw10: 1e5 trials in ~193s -> ~ 518 trials / sec
-# tw20: 1e4 trials in ~430s -> ~  23 trials / sec
-# Need 1e8 trials, because we have many zero trials
-# Worst case: 1e8trials / 23trials/s / 3600s/h / 1000jobs ~ 1.2 h/job
-ntrials = 1e8
-njobs_per_tw = int(125)
-ntrials_per_job = int(ntrials / float(njobs_per_tw))
-njobs_tot = njobs_per_tw * ntime_windows
-if int(ntrials) != ntrials_per_job * njobs_per_tw:
-    raise ValueError("Job settings does not lead to exactly " +
-                     "{} trials".format(int(ntrials)))
-print("Preparing {} total trials per time window".format(int(ntrials)))
-print("  - {} jobs per time window".format(njobs_per_tw))
-print("  - {} trials per job".format(ntrials_per_job))
-print("Creating {} total jobfiles for all time windows".format(int(njobs_tot)))
-print("Worst runtime per job ~{:.2f}h".format(ntrials_per_job / 20. / 3600.))
+# Need 1e8 trials, because we have many zero trials. Jobs per time window are
+# chosen from the measured trial rates, so that each job runs about
+# `--target_hours`, see `_job_planner.py`
+ntrials = int(args.ntrials)
+rates = load_trial_rates(all_tw_ids, fname=args.benchmark)
+plan = plan_jobs(ntrials, rates, target_hours=args.target_hours)
+njobs_tot = sum(p["njobs"] for p in plan)
+if njobs_tot > 90000:
+    raise ValueError("Too many jobs for the reserved seed range, increase " +
+                     "`--target_hours`.")
+print("Preparing {} total trials per time window".format(ntrials))
+for p in plan:
+    print("  - tw {:02d}: {:5d} jobs, {:9d} trials per job, ~{:.2f}h".format(
+        p["tw_id"], p["njobs"], p["ntrials"][0], p["hours"]))
+print("Creating {} total jobfiles for all time windows".format(njobs_tot))
+print("Worst runtime per job ~{:.2f}h".format(plan[0]["hours"]))
 
-# Make unique job identifiers:
-# job_ids: 000 ... 999, 000 ... 999, ...
-lead_zeros = int(np.ceil(np.log10(njobs_per_tw)))
-job_ids = np.array(ntime_windows * ["{1:0{0:d}d}".format(lead_zeros, i) for i
-                   in range(njobs_per_tw)])
-# tw_ids: 00, ..., 00, 01, .., 01, ..., 20, ..., 20
-tw_ids = np.concatenate([njobs_per_tw * [tw_id] for tw_id in all_tw_ids])
+# Make unique job identifiers, longest running time windows first:
+# job_ids: 000 ... 999, 000 ... 099, ...
+# tw_ids: 20, ..., 20, 19, .., 19, ..., 00, ..., 00
+lead_zeros = len(str(max(p["njobs"] for p in plan) - 1))
+job_ids, tw_ids, ntrials_per_job = [], [], []
+for p in plan:
+    job_ids += ["{1:0{0:d}d}".format(lead_zeros, i)
+                for i in range(p["njobs"])]
+    tw_ids += p["njobs"] * [p["tw_id"]]
+    ntrials_per_job += p["ntrials"]
 
+# Biased trials must not reuse the seeds of the unbiased ones
+seed0 = 10000 if args.bias == 1. else 110000
+if njobs_tot > 90000:
+    raise ValueError("{} jobs exceed the seed range of ".format(njobs_tot) +
+                     "90000 jobs per trial type.")
 job_args = {
-    "rnd_seed": np.arange(10000, 10000 + njobs_tot).astype(int),
-    "ntrials": njobs_tot * [ntrials_per_job],
-    "job_id": job_ids,
-    "tw_id": tw_ids,
+    "rnd_seed": np.arange(seed0, seed0 + njobs_tot).astype(int),
+    "ntrials": ntrials_per_job,
+    "job_id": np.array(job_ids),
+    "tw_id": np.array(tw_ids),
     }
+if args.bias != 1.:
+    job_args["bias"] = njobs_tot * [args.bias]
 
-job_creator.create_job(script=script, job_args=job_args,
+# Jobs get the resolved paths passed, so they don't need to resolve them
+job_creator.create_job(script=script, job_args=job_args, exe=exe,
                        job_name=job_name, job_dir=job_dir, overwrite=True)
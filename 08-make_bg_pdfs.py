@@ -4,25 +4,51 @@
 Makes single BG PDF objects from the BG trials. PDFs are composed from an
 empirical part with good statistics and a fitted exponential tail to get
 continious p-values at the tails.
+
+With `--summary` the PDFs are built from the merged trial summaries of
+`07-bg_trials_combine.py --summary` directly, with the histogram bins as count
+weighted entries and the exact tail values with unit weight, see
+`_trial_stats.ts_summary_to_dist`. Below the exact tail ts values are only
+resolved to the histogram bin width. The threshold scan range must lie in the
+exact tail, otherwise the trials need to be redone with a larger `--topk`.
+
+With `--biased` the PDFs are built from the importance weighted trials of
+`07-bg_trials_combine.py --biased` as weighted empirical distributions with an
+exponential tail fitted to the weighted trials.
 """
 
 import os
-import json
 import gzip
+import argparse
 from glob import glob
 import numpy as np
 
 import tdepps.utils.stats as stats
 from _paths import PATHS
+from _loader import column_file_loader
 from _plots import make_bg_pdf_scan_plots
+from _trial_stats import ts_summary_to_dist, SUMMARY_COUNTS
+from _trial_stats import WeightedEmpWithExpTailDist, scan_best_weighted_thresh
+
 
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("--summary", action="store_true")
+parser.add_argument("--biased", action="store_true")
+args = parser.parse_args()
 
-inpath = os.path.join(PATHS.data, "bg_trials_combined", "tw_??.json.gz")
+if args.biased:
+    inpath = os.path.join(PATHS.data, "bg_trials_biased_combined",
+                          "tw_??.cols")
+elif args.summary:
+    inpath = os.path.join(PATHS.data, "bg_trials_summary_combined",
+                          "tw_??.cols")
+else:
+    inpath = os.path.join(PATHS.data, "bg_trials_combined", "tw_??.cols")
 outpath = os.path.join(PATHS.local, "bg_pdfs")
 plotpath = os.path.join(PATHS.plots, "bg_pdfs")
 
 # Uncomment to process the independent ones from LIDO
-# inpath = os.path.join(PATHS.data, "bg_trials_combined_lido", "tw_??.json.gz")
+# inpath = os.path.join(PATHS.data, "bg_trials_combined_lido", "tw_??.cols")
 # outpath = os.path.join(PATHS.local, "bg_pdfs_lido")
 # plotpath = os.path.join(PATHS.plots, "bg_pdfs_lido")
 
@@ -36,26 +62,48 @@ for fpath in files:
     fname = os.path.basename(fpath)
     print("Making PDF from BG trial file: {}".format(fname))
 
-    with gzip.open(fpath) as inf:
-        trials = json.load(inf)
-        print("- Loaded:\n    {}".format(fpath))
+    # Trials are only known exactly above this, non-zero only for summaries
+    exact_above = 0.
+    if args.biased:
+        trials, meta = column_file_loader(fpath, names=["ts", "weights"])
+        ts, weights = trials["ts"].astype(float), trials["weights"]
+    elif args.summary:
+        summary, meta = column_file_loader(fpath)
+        summary.update({key: meta[key] for key in SUMMARY_COUNTS})
+        emp_dist, exact_above = ts_summary_to_dist(summary)
+    else:
+        trials, meta = column_file_loader(fpath, names=["ts"])
+        ts, nzeros = trials["ts"].astype(float), meta["nzeros"]
+    print("- Loaded:\n    {}".format(fpath))
 
     # Create PDF object and scan the best threshold
     print("- Scanning best threshold")
-    emp_dist = stats.emp_with_exp_tail_dist(trials["ts"], trials["nzeros"],
-                                            thresh=np.amax(trials["ts"]))
+    if args.biased:
+        emp_dist = WeightedEmpWithExpTailDist(ts, weights, meta["wzeros"])
+    elif not args.summary:
+        emp_dist = stats.emp_with_exp_tail_dist(ts, nzeros,
+                                                thresh=np.amax(ts))
     # Scan in a range with still good statistics, but leave the really good
     # statistics part to the empirical PDF
     lo, hi = emp_dist.ppf(q=100. * stats.sigma2prob([3., 5.5]))
+    if lo < exact_above:
+        raise ValueError("Scan range starts at ts = {:.2f}, below the ".format(
+            lo) + "exact summary tail starting at ts = {:.2f}. ".format(
+            exact_above) + "Redo the trials with a larger `--topk`.")
     thresh_vals = np.arange(lo, hi, 0.1)
     # Best fit: KS test p-value is larger than `pval_thresh` the first time
     pval_thresh = 0.5
-    best_thresh, best_idx, pvals, scales = stats.scan_best_thresh(
-        emp_dist, thresh_vals, pval_thresh=pval_thresh)
+    if not hasattr(emp_dist, "weights"):
+        best_thresh, best_idx, pvals, scales = stats.scan_best_thresh(
+            emp_dist, thresh_vals, pval_thresh=pval_thresh)
+    else:
+        best_thresh, best_idx, pvals, scales = scan_best_weighted_thresh(
+            emp_dist, thresh_vals, pval_thresh=pval_thresh)
 
     # Save whole PDF object to recoverable JSON file. Save stored data with
     # float16 precision, which is sufficient and saves space
-    pdf_name = os.path.join(outpath, "bg_pdf_" + fname)
+    tw_name = fname.replace(".cols", "")
+    pdf_name = os.path.join(outpath, "bg_pdf_" + tw_name + ".json.gz")
     print("- Saving PDF object to:\n    {}".format(pdf_name))
     with gzip.open(pdf_name, "w") as f:
         emp_dist.to_json(fp=f, dtype=np.float16, indent=0,
@@ -63,8 +111,7 @@ for fpath in files:
         print("    Done")
 
     # Make scan plots
-    plot_name = os.path.join(plotpath,
-                             "bg_pdf_" + fname.replace(".json.gz", ""))
+    plot_name = os.path.join(plotpath, "bg_pdf_" + tw_name)
     make_bg_pdf_scan_plots(plot_name, emp_dist, thresh_vals, pvals, scales,
                            pval_thresh)
     print("- Saved plot to:\n    {}".format(plot_name))
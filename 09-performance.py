@@ -2,8 +2,8 @@
 
 """
 Single job of performance trials.
-Loads data and settings and builds the models, likelihoods and injectors to do
-the trials with.
+Loads the bg injectors and LLHs from the snapshots made in
+`06-make_snapshots.py` and builds the signal injectors from data and settings.
 Signal is injected with multiple means to robustly estimate the performance by
 fitting a generic but matching chi2 distribution to the trial results.
 
@@ -13,46 +13,20 @@ as we don't consider the source positional uncertainties in the LLHs.
 
 import gc
 import os
-import json
-import gzip
 import argparse
 import numpy as np
 
-from tdepps.utils import make_src_records
-from tdepps.grb import GRBLLH, GRBModel, MultiGRBLLH
-from tdepps.grb import TimeDecDependentBGDataInjector
-from tdepps.grb import UniformTimeSampler, SignalFluenceInjector
-from tdepps.grb import HealpySignalFluenceInjector
+from tdepps.grb import MultiGRBLLH
+from tdepps.grb import UniformTimeSampler
 from tdepps.grb import MultiBGDataInjector, MultiSignalFluenceInjector
 from tdepps.grb import GRBLLHAnalysis
-import tdepps.utils.phys as phys
 from _paths import PATHS
+from _models import get_sample_models, build_sig_injector
+from _saver import column_file_saver, TRIAL_DTYPE
+from _utils import print_memory_report
 import _loader
 
 
-def flux_model_factory(model, **model_args):
-    """
-    Returns a flux model callable `flux_model(trueE)`.
-
-    Parameters
-    ----------
-    model : str
-        Name of a method in ``tdeps.utils.phys``.
-    model_args : dict
-        Arguments passed to ``tdeps.utils.phys.<model>``.
-
-    Returns
-    -------
-    flux_model : callable
-        Function of single parameter, true energy, with fixed model args.
-    """
-    def flux_model(trueE):
-        flux_mod = getattr(phys, model)
-        return flux_mod(trueE, **model_args)
-
-    return flux_model
-
-
 parser = argparse.ArgumentParser(description="hese_stacking")
 parser.add_argument("--rnd_seed", type=int)
 parser.add_argument("--ntrials", type=int)
@@ -68,62 +42,16 @@ rndgen = np.random.RandomState(rnd_seed)
 dt0, dt1 = _loader.time_window_loader(tw_id)
 time_sam = UniformTimeSampler(random_state=rndgen)
 
-# Load files and build the models one after another to save memory
+# Load the fitted bg injectors and LLHs from snapshots and build the signal
+# injectors one after another to save memory
 bg_injs = {}
 sig_injs = {}
 llhs = {}
 
-# Load files and build the models one after another to save memory
 sample_names = _loader.source_list_loader()
 for key in sample_names:
-    print("\n" + 80 * "#")
-    print("# :: Setup for sample {} ::".format(key))
-    opts = _loader.settings_loader(key)[key].copy()
-    exp_off = _loader.off_data_loader(key)[key]
-    mc = _loader.mc_loader(key)[key]
-    srcs = _loader.source_list_loader(key)[key]
-    runlist = _loader.runlist_loader(key)[key]
-    # Process to tdepps format
-    srcs_rec = make_src_records(srcs, dt0=dt0, dt1=dt1)
-
-    # Setup BG injector
-    bg_inj_i = TimeDecDependentBGDataInjector(inj_opts=opts["bg_inj_opts"],
-                                              random_state=rndgen)
-    bg_inj_i.fit(X=exp_off, srcs=srcs_rec, run_list=runlist)
-    bg_injs[key] = bg_inj_i
-
-    # Setup Signal injector
-    fmod = opts["sig_inj_opts"].pop("flux_model")
-    flux_model = flux_model_factory(fmod["model"], **fmod["args"])
-    # Decide what type of injection we need
-    if sig_inj_type == "healpy":
-        # Always inject the best fit source position, exactly as tested
-        opts["sig_inj_opts"]["inj_sigma"] = 3.
-        src_maps = _loader.source_map_loader(src_list=srcs)
-        sig_inj_i = HealpySignalFluenceInjector(
-            flux_model, time_sampler=time_sam, inj_opts=opts["sig_inj_opts"])
-        sig_inj_i.fit(srcs_rec, src_maps=src_maps, MC=mc)
-        del src_maps
-    elif sig_inj_type == "ps":
-        # Inject source position from prior map, worsening performance
-        sig_inj_i = SignalFluenceInjector(flux_model, time_sampler=time_sam,
-                                          inj_opts=opts["sig_inj_opts"])
-        sig_inj_i.fit(srcs_rec, MC=mc)
-    else:
-        raise ValueError("`sig_inj_type` can be 'ps' or 'healpy'.")
-    sig_injs[key] = sig_inj_i
-
-    # Setup LLH model and LLH
-    fmod = opts["model_energy_opts"].pop("flux_model")
-    flux_model = flux_model_factory(fmod["model"], **fmod["args"])
-    opts["model_energy_opts"]["flux_model"] = flux_model
-    llhmod = GRBModel(X=exp_off, MC=mc, srcs=srcs_rec, run_list=runlist,
-                      spatial_opts=opts["model_spatial_opts"],
-                      energy_opts=opts["model_energy_opts"])
-    llhs[key] = GRBLLH(llh_model=llhmod, llh_opts=opts["llh_opts"])
-
-    del exp_off
-    del mc
+    bg_injs[key], llhs[key] = get_sample_models(key, tw_id, rndgen)
+    sig_injs[key] = build_sig_injector(key, dt0, dt1, sig_inj_type, time_sam)
     gc.collect()
 
 # Build the multi models
@@ -138,6 +66,7 @@ multi_llh = MultiGRBLLH(llh_opts=multi_llh_opts)
 multi_llh.fit(llhs=llhs)
 
 ana = GRBLLHAnalysis(multi_llh, multi_bg_inj, sig_inj=multi_sig_inj)
+print_memory_report("after setup")
 
 # Do the performance trials
 print("Time window ID is: {}".format(tw_id))
@@ -161,25 +90,32 @@ perf = ana.performance(ts_val=ts_val, beta=beta, mus=mu_sig, ns0=ns0,
                        n_batch_trials=ntrials)
 print(":: Done ::")
 
-# Convert ndarrays and lists of ndarrays to lists of lists for JSON
-out = {
+# Trial arrays per injected mean are stored flat, split them again with the
+# stored number of trials per mean
+ntrials_per_mu = np.array([len(arr) for arr in perf["ts"]], dtype=int)
+cols = {
+    "ninj": np.concatenate(perf["ninj"]).astype(TRIAL_DTYPE),
+    "ns": np.concatenate(perf["ns"]).astype(TRIAL_DTYPE),
+    "ts": np.concatenate(perf["ts"]).astype(TRIAL_DTYPE),
+    "ntrials_per_mu": ntrials_per_mu,
+    "cdfs": perf["cdfs"],
+    "mus": perf["mus"],
+    "pars": perf["pars"],
+    }
+meta = {
     "beta": perf["beta"],
-    "ninj": [arr.tolist() for arr in perf["ninj"]],
-    "cdfs": perf["cdfs"].tolist(),
-    "mus": perf["mus"].tolist(),
     "mu_bf": perf["mu_bf"],
     "tsval": perf["tsval"],
-    "pars": perf["pars"].tolist(),
-    "ns": [arr.tolist() for arr in perf["ns"]],
-    "ts": [arr.tolist() for arr in perf["ts"]],
+    "time_window": [dt0, dt1],
+    "time_window_id": tw_id,
+    "rnd_seed": rnd_seed,
     }
 
-# Save as JSON
+# Save as binary column file
 outpath = os.path.join(PATHS.data, "performance_trials_" + sig_inj_type)
 if not os.path.isdir(outpath):
     os.makedirs(outpath)
 
-fname = os.path.join(outpath, "tw_{:02d}.json.gz".format(tw_id))
-with gzip.open(fname, "w") as outfile:
-    json.dump(out, fp=outfile, indent=1)
-    print("Saved to:\n  {}".format(fname))
+fname = os.path.join(outpath, "tw_{:02d}.cols".format(tw_id))
+column_file_saver(fname, cols=cols, meta=meta)
+print("Saved to:\n  {}".format(fname))
@@ -9,6 +9,9 @@ Arguments:
 --type=healpy
     - Make 'effective' trials, injecting from the source priors but still
       testing at the best fit positions.
+--local
+    - Run the jobs directly on this machine using all cores instead of writing
+      DAGMan job files. Use `--nworkers` to limit the concurrent jobs.
 
 ##############################################################################
 # Used seed range for performance trial jobs: [200000, 201000]
@@ -19,19 +22,30 @@ import os
 import numpy as np
 import argparse
 
-from dagman import dagman
-from _paths import PATHS
+from _paths import PATHS, job_exe, creator_default_exe
 from _loader import time_window_loader
+from _executor import LocalJobExecutor
 
 
 parser = argparse.ArgumentParser(description="hese_stacking")
 parser.add_argument("--sig_inj", type=str, required=True)
+parser.add_argument("--local", action="store_true",
+                    help="Run all jobs on this machine instead of DAGMan.")
+parser.add_argument("--nworkers", type=int, default=None)
 args = parser.parse_args()
 sig_inj_type = args.sig_inj
 
 # Make jobs
 print("Preparing job files for injector type: '{}'".format(sig_inj_type))
-job_creator = dagman.DAGManJobCreator(mem=3)
+if args.local:
+    job_creator = LocalJobExecutor(mem=3, max_workers=args.nworkers)
+    exe = job_exe()
+else:
+    # Cluster tooling is only needed for the DAG files
+    from dagman import dagman
+    job_creator = dagman.DAGManJobCreator(mem=3)
+    # Keep the default DAG job command, only the environment is added
+    exe = job_exe(creator_default_exe(job_creator))
 job_name = "hese_transient_stacking"
 
 job_dir = os.path.join(PATHS.jobs, "performance_trials_" + sig_inj_type)
@@ -74,5 +88,6 @@ elif sig_inj_type == "healpy":
 else:
     raise ValueError("`sig_inj_type` can be 'ps' or 'healpy'.")
 
-job_creator.create_job(script=script, job_args=job_args,
+# Jobs get the resolved paths passed, so they don't need to resolve them
+job_creator.create_job(script=script, job_args=job_args, exe=exe,
                        job_name=job_name, job_dir=job_dir, overwrite=True)
@@ -2,101 +2,57 @@
 
 """
 Single job of background only post-trials.
-Loads data and settings and builds the models, likelihoods and injectors to do
-the trials with.
-
-First part build models and injectors exactly as in BG trials.
+Loads the injectors and LLHs for the largest time window from the snapshots
+made in `06-make_snapshots.py`, exactly as in the BG trials.
+With `--nested`, each trial is fitted in all nested time windows in a single
+pass with `_trials.NestedWindowEvaluator` instead of one LLH fit per window.
+`--check N` compares the test LLHs, which share their large arrays, to
+independent copies in N extra trials first and aborts, if the `ts` differ.
+The check runs in 2 trials by default, `--check 0` skips it. With `--nested`
+the single pass fit is also compared to the minimizer of each window.
 """
 
 import gc  # Manual garbage collection
 import os
-import json
-import gzip
 import argparse
 import numpy as np
-from copy import deepcopy
 
-from tdepps.utils import make_src_records
-from tdepps.grb import GRBLLH, GRBModel, MultiGRBLLH
-from tdepps.grb import TimeDecDependentBGDataInjector
+from tdepps.grb import MultiGRBLLH
 from tdepps.grb import MultiBGDataInjector
 from tdepps.grb import GRBLLHAnalysis
-import tdepps.utils.phys as phys
 from _paths import PATHS
+from _models import get_sample_models
+from _saver import column_file_saver, TRIAL_DTYPE
+from _utils import print_memory_report
+from _trials import time_window_views, sample_probe, check_time_window_views
+from _trials import NestedWindowEvaluator, do_nested_window_trials
+from _trials import check_nested_windows
 import _loader
 
 
-def flux_model_factory(model, **model_args):
-    """
-    Returns a flux model callable `flux_model(trueE)`.
-
-    Parameters
-    ----------
-    model : str
-        Name of a method in ``tdeps.utils.phys``.
-    model_args : dict
-        Arguments passed to ``tdeps.utils.phys.<model>``.
-
-    Returns
-    -------
-    flux_model : callable
-        Function of single parameter, true energy, with fixed model args.
-    """
-    def flux_model(trueE):
-        flux_mod = getattr(phys, model)
-        return flux_mod(trueE, **model_args)
-
-    return flux_model
-
-
 parser = argparse.ArgumentParser(description="hese_stacking")
 parser.add_argument("--rnd_seed", type=int)
 parser.add_argument("--ntrials", type=int)
 parser.add_argument("--job_id", type=str)
+parser.add_argument("--nested", action="store_true")
+parser.add_argument("--batch_size", type=int, default=1000)
+parser.add_argument("--check", type=int, default=2)
 args = parser.parse_args()
 rnd_seed = args.rnd_seed
 ntrials = args.ntrials
 job_id = args.job_id
 
 rndgen = np.random.RandomState(rnd_seed)
-# Load the largest time window for the injector
-dt0, dt1 = _loader.time_window_loader(-1)
+# Use the largest time window for the injector
+tw_id = _loader.time_window_loader()[-1]
 
-# Load files and build the models one after another to save memory
+# Load the fitted models from snapshots one after another to save memory
 bg_injs = {}
-sig_injs = {}
 llhs = {}
 
-# Load files and build the models one after another to save memory
 sample_names = _loader.source_list_loader()
 for key in sample_names:
-    print("\n" + 80 * "#")
-    print("# :: Setup for sample {} ::".format(key))
-    opts = _loader.settings_loader(key)[key].copy()
-    exp_off = _loader.off_data_loader(key)[key]
-    mc = _loader.mc_loader(key)[key]
-    srcs = _loader.source_list_loader(key)[key]
-    runlist = _loader.runlist_loader(key)[key]
-    # Process to tdepps format
-    srcs_rec = make_src_records(srcs, dt0=dt0, dt1=dt1)
-
-    # Setup BG injector
-    bg_inj_i = TimeDecDependentBGDataInjector(inj_opts=opts["bg_inj_opts"],
-                                              random_state=rndgen)
-    bg_inj_i.fit(X=exp_off, srcs=srcs_rec, run_list=runlist)
-    bg_injs[key] = bg_inj_i
-
-    # Setup LLH model and LLH
-    fmod = opts["model_energy_opts"].pop("flux_model")
-    flux_model = flux_model_factory(fmod["model"], **fmod["args"])
-    opts["model_energy_opts"]["flux_model"] = flux_model
-    llhmod = GRBModel(X=exp_off, MC=mc, srcs=srcs_rec, run_list=runlist,
-                      spatial_opts=opts["model_spatial_opts"],
-                      energy_opts=opts["model_energy_opts"])
-    llhs[key] = GRBLLH(llh_model=llhmod, llh_opts=opts["llh_opts"])
-
-    del exp_off
-    del mc
+    bg_injs[key], llhs[key] = get_sample_models(key, tw_id, rndgen)
     gc.collect()
 
 # Build the multi models
@@ -108,36 +64,49 @@ multi_llh = MultiGRBLLH(llh_opts=multi_llh_opts)
 multi_llh.fit(llhs=llhs)
 
 ana = GRBLLHAnalysis(multi_llh, multi_bg_inj, sig_inj=None)
+print_memory_report("after setup")
 
 # Do the post trials
-# Prepare a list of LLHs each with a different time window to test.
+# Prepare a list of LLHs each with a different time window to test. These
+# share the event data and PDFs with `ana.llh`, only the source time windows
+# are set independently
 dt0s, dt1s = _loader.time_window_loader("all")
-test_llhs = []
-for i, (dt0i, dt1i) in enumerate(zip(dt0s, dt1s)):
-    print("# Build test LLH for time window pair {}".format(i))
-    test_multi_llh = deepcopy(ana.llh)
-    for key, model in test_multi_llh.model.items():
-        print("- {}".format(key))
-        model.set_new_srcs_dt(dt0=dt0i, dt1=dt1i, copy=False)
-
-    test_llhs.append(test_multi_llh)
+test_llhs = time_window_views(ana.llh, dt0s, dt1s)
+print_memory_report("after building the test LLHs")
+if args.check > 0:
+    check_time_window_views(ana.llh, test_llhs, dt0s, dt1s, bg_injs,
+                            n_trials=args.check)
 
 print(":: Starting {} background post trials ::".format(ntrials))
-trials = ana.post_trials(n_trials=ntrials, test_llhs=test_llhs, ns0=0.1)
+if args.nested:
+    srcs = _loader.source_list_loader("all")
+    src_mjds = {key: [src["mjd"] for src in srcs[key]] for key in llhs}
+    # Separate random state, so the probe doesn't shift the trials
+    probe = sample_probe(bg_injs, 100)
+    evaluator = NestedWindowEvaluator(llhs, test_llhs, dt0s, dt1s, src_mjds,
+                                      probe=probe)
+    if args.check > 0:
+        check_nested_windows(test_llhs, evaluator, bg_injs,
+                             n_trials=args.check)
+    trials, _ = do_nested_window_trials(bg_injs, evaluator, n_trials=ntrials,
+                                        batch_size=args.batch_size,
+                                        keep_zeros=True)
+    trials = {"ns": [t["ns"] for t in trials], "ts": [t["ts"] for t in trials]}
+else:
+    trials = ana.post_trials(n_trials=ntrials, test_llhs=test_llhs, ns0=0.1)
 print(":: Done ::")
 
-# Save as JSON
+# Save as binary column file, arrays have shape (ntime_windows, ntrials)
 outpath = os.path.join(PATHS.data, "post_trials")
 if not os.path.isdir(outpath):
     os.makedirs(outpath)
 
-out = {"ns": [arr.tolist() for arr in trials["ns"]],
-       "ts": [arr.tolist() for arr in trials["ts"]],
-       "rnd_seed": rnd_seed,
-       "ntrials": ntrials,
-       "time_windows": [dt0s.tolist(), dt1s.tolist()]}  # Same order as LLHs
+cols = {"ns": np.vstack(trials["ns"]),
+        "ts": np.vstack(trials["ts"])}
+meta = {"rnd_seed": rnd_seed,
+        "ntrials": ntrials,
+        "time_windows": [dt0s.tolist(), dt1s.tolist()]}  # Same order as LLHs
 
-fname = os.path.join(outpath, "job_{}.json.gz".format(job_id))
-with gzip.open(fname, "w") as outfile:
-    json.dump(out, fp=outfile, indent=2)
-    print("Saved to:\n  {}".format(fname))
+fname = os.path.join(outpath, "job_{}.cols".format(job_id))
+column_file_saver(fname, cols=cols, meta=meta, dtype=TRIAL_DTYPE)
+print("Saved to:\n  {}".format(fname))
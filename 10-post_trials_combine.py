@@ -1,64 +1,85 @@
 # coding: utf-8
 
 """
-Combine output for each post trial job output.
+Combine output for each post trial job output. Trials are streamed file by file
+into a memory mapped output.
+
+Combines are incremental: merged job files are recorded in a manifest (see
+`_manifest.py`) and only new job files are appended to the existing output in
+place, rewriting only the file header (see `_saver.column_file_appender`).
+Files with an already merged seed are skipped. If a merged job file changed or
+was removed, the output is rebuilt. `--rebuild` always rebuilds.
 """
 
 import os
-import sys
-import json
-import gzip
+import argparse
 from glob import glob
 
-try:
-    from tqdm import tqdm
-except ImportError:
-    print("If you want fancy status bars: `pip install --user tqdm` ;)")
-    tqdm = iter
-
 from _paths import PATHS
+from _loader import column_file_header_loader
+from _saver import column_file_merger, column_file_appender
+from _manifest import CombineManifest
 
 
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("--rebuild", action="store_true",
+                    help="Ignore the manifest and combine all files again.")
+args = parser.parse_args()
+
 inpath = os.path.join(PATHS.data, "post_trials")
 
 outpath = os.path.join(PATHS.local, "post_trials_combined")
-if os.path.isdir(outpath):
-    res = raw_input("'{}' already exists. ".format(outpath) +
-                    "\nAllow overwrites (y/n)? ")
-    if not res.lower() in ("y", "yes"):
-        print("Abort. Script has done nothing.")
-        sys.exit()
-    print("  Using output directory '{}'.".format(outpath))
-else:
+if not os.path.isdir(outpath):
     os.makedirs(outpath)
     print("Created output directory '{}'.".format(outpath))
+manifest = CombineManifest(outpath, rebuild=args.rebuild)
 
-files = sorted(glob(os.path.join(inpath, "job_*.json.gz")))
+out_name = "post_trials.cols"
+fpath = os.path.join(outpath, out_name)
+files = sorted(glob(os.path.join(inpath, "job_*.cols")))
 if len(files) > 0:
     print("Found {} post trial files".format(len(files)))
-    # Build output dict
-    trials = {
-        "ns": [],
-        "ts": [],
-        "rnd_seed": [],
-        "ntrials": 0,
-        "ntrials_per_batch": [],
-        }
-    # Concatenate all files
-    for _file in tqdm(files):
-        with gzip.open(_file) as infile:
-            trial_i = json.load(infile)
-        trials["ns"] += trial_i["ns"]
-        trials["ts"] += trial_i["ts"]
-        trials["ntrials"] += trial_i["ntrials"]
-        trials["rnd_seed"].append(trial_i["rnd_seed"])
-        trials["ntrials_per_batch"].append(trial_i["ntrials"])
-    trials["time_windows"] = trial_i["time_windows"]
-    # Save it
-    fpath = os.path.join(outpath, "post_trials.json.gz")
-    print("- Saving to:\n    {}".format(fpath))
-    with gzip.open(fpath, "w") as outf:
-        json.dump(trials, fp=outf, indent=0, separators=(",", ":"))
+    files, rebuild = manifest.plan(out_name, files, fpath)
+    metas = {_file: column_file_header_loader(_file)[0] for _file in files}
+    seeds = [metas[_file]["rnd_seed"] for _file in files]
+    # The output header also knows files merged by an interrupted combine
+    out_seeds = None
+    if not rebuild:
+        out_seeds = column_file_header_loader(fpath)[0]["rnd_seed"]
+    files, seeds = manifest.drop_duplicate_seeds(out_name, files, seeds,
+                                                 out_seeds)
+    metas = [metas[_file] for _file in files]
+    if len(files) == 0:
+        manifest.save()
+        print("- Up to date")
+    else:
+        print("- {} {} files".format("Combining" if rebuild else "Adding",
+                                     len(files)))
+        # Build output metadata from the file headers only
+        meta = {
+            "rnd_seed": [],
+            "ntrials": 0,
+            "ntrials_per_batch": [],
+            }
+        if not rebuild:
+            # Start from the existing output, which is merged first
+            meta = column_file_header_loader(fpath)[0]
+        for meta_i in metas:
+            meta["ntrials"] += meta_i["ntrials"]
+            meta["rnd_seed"].append(meta_i["rnd_seed"])
+            meta["ntrials_per_batch"].append(meta_i["ntrials"])
+        meta["time_windows"] = meta_i["time_windows"]
+        # Stream all files into the preallocated output. Arrays have shape
+        # (ntime_windows, ntrials) and are concatenated along the trial axis
+        print("- Saving to:\n    {}".format(fpath))
+        if rebuild:
+            # Reserve space, so the next new files are appended in place
+            column_file_merger(fpath + ".tmp", files, meta=meta, grow=2.)
+            os.rename(fpath + ".tmp", fpath)
+        else:
+            column_file_appender(fpath, files, meta=meta)
+        manifest.record(out_name, files, seeds)
+        manifest.save()
 else:
     print("  No trials found, exiting.")
 
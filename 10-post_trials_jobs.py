@@ -2,6 +2,8 @@
 
 """
 Create jobfiles for `10-post_trials.py`.
+With `--local` the jobs are run directly on this machine using all cores,
+limit the concurrent jobs with `--nworkers`.
 
 ##############################################################################
 # Used seed range for post trial jobs: [300000, 400000]
@@ -9,14 +11,29 @@ Create jobfiles for `10-post_trials.py`.
 """
 
 import os
+import argparse
 import numpy as np
 
-from dagman import dagman
-from _paths import PATHS
+from _paths import PATHS, job_exe, creator_default_exe
 from _loader import time_window_loader
+from _executor import LocalJobExecutor
 
 
-job_creator = dagman.DAGManJobCreator(mem=2)
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("--local", action="store_true",
+                    help="Run all jobs on this machine instead of DAGMan.")
+parser.add_argument("--nworkers", type=int, default=None)
+args = parser.parse_args()
+
+if args.local:
+    job_creator = LocalJobExecutor(mem=2, max_workers=args.nworkers)
+    exe = job_exe()
+else:
+    # Cluster tooling is only needed for the DAG files
+    from dagman import dagman
+    job_creator = dagman.DAGManJobCreator(mem=2)
+    # Keep the default DAG job command, only the environment is added
+    exe = job_exe(creator_default_exe(job_creator))
 job_name = "hese_transient_stacking"
 
 job_dir = os.path.join(PATHS.jobs, "post_trials")
@@ -48,5 +65,6 @@ job_args = {
     "job_id": job_ids,
     }
 
-job_creator.create_job(script=script, job_args=job_args,
+# Jobs get the resolved paths passed, so they don't need to resolve them
+job_creator.create_job(script=script, job_args=job_args, exe=exe,
                        job_name=job_name, job_dir=job_dir, overwrite=True)
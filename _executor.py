@@ -0,0 +1,178 @@
+# coding: utf-8
+
+"""
+Local execution backend for the trial job argument tables.
+
+`LocalJobExecutor` has the same `create_job` interface as
+`dagman.DAGManJobCreator`, but instead of writing job files it runs all jobs
+directly on the local machine with a pool of worker processes. This way a
+`*_jobs.py` script can produce a full time window on a large node without a
+cluster, by only swapping the job creator object.
+"""
+
+from __future__ import print_function, division
+
+import os as _os
+import sys as _sys
+import json as _json
+import time as _time
+import subprocess as _subprocess
+import multiprocessing as _mp
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from concurrent.futures import as_completed as _as_completed
+
+from _utils import available_memory as _available_memory
+
+
+class LocalJobExecutor(object):
+    """
+    Run job argument tables locally on all cores of a machine.
+
+    Parameters
+    ----------
+    mem : float, optional
+        Memory needed per job in GB, used to limit the number of concurrent
+        jobs to the currently available memory. (default: 1)
+    max_workers : int or None, optional
+        Upper limit of concurrently running jobs. If ``None``, the number of
+        CPUs is used. (default: ``None``)
+    """
+    def __init__(self, mem=1, max_workers=None):
+        self._mem = float(mem)
+        self._max_workers = max_workers
+
+    def n_workers(self, njobs):
+        """
+        Number of concurrent jobs, limited by CPUs, available memory, the
+        ``max_workers`` setting and the number of jobs.
+
+        Parameters
+        ----------
+        njobs : int
+            Number of jobs to run.
+
+        Returns
+        -------
+        nworkers : int
+            Number of jobs to run at once, at least 1.
+        """
+        limits = [_mp.cpu_count(), njobs]
+        if self._max_workers is not None:
+            limits.append(self._max_workers)
+        mem = _available_memory()
+        if mem is not None and self._mem > 0:
+            limits.append(int(mem // self._mem))
+        return max(1, min(limits))
+
+    def create_job(self, script, job_args, job_name, job_dir, exe=None,
+                   overwrite=False):
+        """
+        Run all jobs from the argument table and collect the results as they
+        finish. Each job's output goes to ``job_dir/logs/<job_name>_<i>.log``
+        and a summary of all jobs is written to
+        ``job_dir/<job_name>_local.json``.
+
+        Parameters
+        ----------
+        script : str
+            Full path to the script executed per job.
+        job_args : dict
+            Argument names as keys and lists with one value per job as values.
+            Each job gets ``--<name> <value>`` passed.
+        job_name : str
+            Name prefix for the log files.
+        job_dir : str
+            Directory for the logs and the job summary.
+        exe : list of str or None, optional
+            Command prefix to run ``script`` with. If ``None``, the current
+            python interpreter is used. (default: ``None``)
+        overwrite : bool, optional
+            If ``False``, raise if ``job_dir`` already exists.
+            (default: ``False``)
+
+        Returns
+        -------
+        results : list of dicts
+            One dict per job, in job order, with keys ``'job', 'cmd', 'log',
+            'returncode', 'runtime'``.
+
+        Raises
+        ------
+        RuntimeError
+            If any job exits with a non-zero return code. The job summary is
+            written before raising.
+        """
+        if _os.path.isdir(job_dir) and not overwrite:
+            raise RuntimeError("Job dir '{}' already exists. ".format(job_dir) +
+                               "Set `overwrite=True` to overwrite.")
+        log_dir = _os.path.join(job_dir, "logs")
+        if not _os.path.isdir(log_dir):
+            _os.makedirs(log_dir)
+
+        cmds = self._make_cmds(script, job_args, exe)
+        njobs = len(cmds)
+        nworkers = self.n_workers(njobs)
+        lead_zeros = len(str(njobs - 1))
+        print("Running {} jobs locally with {} workers".format(njobs,
+                                                               nworkers))
+
+        results = njobs * [None]
+        with _ThreadPoolExecutor(max_workers=nworkers) as executor:
+            futures = {}
+            for i, cmd in enumerate(cmds):
+                log = _os.path.join(log_dir, "{}_{:0{}d}.log".format(
+                    job_name, i, lead_zeros))
+                futures[executor.submit(_run_job, cmd, log)] = i
+            for ndone, future in enumerate(_as_completed(futures), 1):
+                i = futures[future]
+                res = future.result()
+                res["job"] = i
+                results[i] = res
+                print("  [{}/{}] Job {} {} after {:.1f}s".format(
+                    ndone, njobs, i,
+                    "done" if res["returncode"] == 0 else "FAILED",
+                    res["runtime"]))
+
+        fname = _os.path.join(job_dir, "{}_local.json".format(job_name))
+        with open(fname, "w") as outf:
+            _json.dump(results, fp=outf, indent=1)
+            print("Job summary saved to:\n  {}".format(fname))
+
+        # Fail loudly, so callers and the pipeline don't go on with a
+        # partial set of outputs
+        failed = [job_res["job"] for job_res in results
+                  if job_res["returncode"] != 0]
+        if failed:
+            raise RuntimeError("{} of {} jobs failed: {}. See the logs in "
+                               "'{}'.".format(len(failed), njobs, failed,
+                                              log_dir))
+        return results
+
+    def _make_cmds(self, script, job_args, exe):
+        """ Build one command line per job from the argument table """
+        names = sorted(job_args.keys())
+        njobs = set(len(job_args[name]) for name in names)
+        if len(njobs) != 1:
+            raise ValueError("All job arguments must have the same length.")
+        njobs = njobs.pop()
+
+        exe = [_sys.executable] if exe is None else list(exe)
+        cmds = []
+        for i in range(njobs):
+            cmd = exe + [script]
+            for name in names:
+                cmd += ["--" + name, str(job_args[name][i])]
+            cmds.append(cmd)
+        return cmds
+
+
+def _run_job(cmd, log):
+    """ Run a single job command and write all output to ``log`` """
+    t0 = _time.time()
+    with open(log, "w") as logf:
+        logf.write(" ".join(cmd) + "\n\n")
+        logf.flush()
+        returncode = _subprocess.call(cmd, stdout=logf,
+                                      stderr=_subprocess.STDOUT)
+    return {"cmd": cmd, "log": log, "returncode": returncode,
+            "runtime": _time.time() - t0}
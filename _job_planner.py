@@ -0,0 +1,114 @@
+# coding: utf-8
+
+"""
+Split trial budgets into jobs with similar runtimes, using the measured trial
+throughput per time window.
+
+Rates are read from the benchmark file written by `bench_trials.py`:
+``{"time_windows": {"<tw_id>": {"bg_trials_per_sec": rate, ...}, ...}}``.
+Time windows missing there are interpolated from the hand timed reference
+rates below, linearly in the log of the rate.
+"""
+
+from __future__ import division
+
+import os as _os
+import json as _json
+import numpy as _np
+
+from _paths import PATHS as _PATHS
+
+
+# Timing tests: For 6 year pass2 HESE, 5 years PS tracks data, 1 year GFU
+# tw00: 1e6 trials in ~661s -> ~2770 trials / sec
+# tw10: 1e5 trials in ~193s -> ~ 518 trials / sec
+# tw20: 1e4 trials in ~430s -> ~  23 trials / sec
+REF_TW_IDS = [0, 10, 20]
+REF_RATES = [2770., 518., 23.]
+
+
+def default_benchmark_file():
+    """ Default location of the benchmark file from `bench_trials.py` """
+    return _os.path.join(_PATHS.local, "benchmarks", "trials_benchmark.json")
+
+
+def load_trial_rates(tw_ids, fname=None, key="bg_trials_per_sec"):
+    """
+    Trial rates per time window from a benchmark file, missing ones are
+    interpolated from ``REF_RATES``.
+
+    Parameters
+    ----------
+    tw_ids : array-like
+        Time window indices to get the rates for.
+    fname : str or None, optional
+        Benchmark JSON file. If ``None``, ``default_benchmark_file()`` is used.
+        If the file doesn't exist, only the reference rates are used.
+        (default: ``None``)
+    key : str, optional
+        Which rate to read from the benchmark entries.
+        (default: ``'bg_trials_per_sec'``)
+
+    Returns
+    -------
+    rates : dict
+        Time window indices as keys, trials per second as values.
+    """
+    fname = default_benchmark_file() if fname is None else fname
+    measured = {}
+    if _os.path.isfile(fname):
+        with open(fname) as inf:
+            bench = _json.load(inf)
+        for tw_id, res in bench.get("time_windows", {}).items():
+            if res.get(key, 0) > 0:
+                measured[int(tw_id)] = float(res[key])
+        print("Loaded trial rates for {} time windows from:\n  {}".format(
+            len(measured), fname))
+    else:
+        print("No benchmark file found at:\n  {}".format(fname))
+
+    rates = {}
+    for tw_id in tw_ids:
+        if tw_id in measured:
+            rates[tw_id] = measured[tw_id]
+        else:
+            rates[tw_id] = _np.exp(_np.interp(tw_id, REF_TW_IDS,
+                                              _np.log(REF_RATES)))
+    return rates
+
+
+def plan_jobs(ntrials, rates, target_hours):
+    """
+    Split ``ntrials`` per time window into jobs running about
+    ``target_hours`` each. The trials of a time window add up exactly to
+    ``ntrials``, job sizes differ by at most one trial.
+
+    Parameters
+    ----------
+    ntrials : int
+        Trials per time window.
+    rates : dict
+        Time window indices as keys, trials per second as values.
+    target_hours : float
+        Wanted runtime per job in hours.
+
+    Returns
+    -------
+    plan : list of dicts
+        One dict per time window with keys ``'tw_id', 'njobs', 'ntrials'``,
+        the latter being the list of trials per job, and ``'hours'``, the
+        expected runtime of the largest job. Sorted by expected job runtime,
+        longest first, so the stragglers are submitted first.
+    """
+    ntrials = int(ntrials)
+    target_sec = 3600. * target_hours
+    plan = []
+    for tw_id, rate in rates.items():
+        njobs = max(1, int(_np.ceil(ntrials / rate / target_sec)))
+        njobs = min(njobs, ntrials)
+        base, rest = divmod(ntrials, njobs)
+        ntrials_per_job = rest * [base + 1] + (njobs - rest) * [base]
+        plan.append({"tw_id": tw_id, "njobs": njobs,
+                     "ntrials": ntrials_per_job,
+                     "hours": ntrials_per_job[0] / rate / 3600.})
+    return sorted(plan, key=lambda p: (-p["hours"], p["tw_id"]))
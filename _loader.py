@@ -9,13 +9,13 @@ import os as _os
 import re as _re
 import json as _json
 import gzip as _gzip
+from io import BytesIO as _BytesIO
 import numpy as _np
 from glob import glob as _glob
 
-from myi3scripts import arr2str as _arr2str
-import tdepps.utils.stats as _stats
-
 from _paths import PATHS as _PATHS
+from _saver import read_header_length
+from _runs import RunIndex as _RunIndex
 
 
 def time_window_loader(idx=None):
@@ -50,7 +50,8 @@ def time_window_loader(idx=None):
         try:
             len(idx)
             idx = _np.atleast_1d(idx)
-            print(info + "indices: \n    [{}]".format(_arr2str(idx)))
+            print(info + "indices: \n    [{}]".format(
+                ", ".join(str(i) for i in idx)))
         except TypeError:
             print(info + "index: {}".format(idx))
         return dt0[idx], dt1[idx]
@@ -59,7 +60,8 @@ def time_window_loader(idx=None):
 def bg_pdf_loader(idx=None):
     """
     Loads background trial test statisitc distribution objects of type
-    ``tdepps.utils.stats.emp_with_exp_tail_dist``.
+    ``tdepps.utils.stats.emp_with_exp_tail_dist`` or, for PDFs made from
+    importance weighted trials, ``_trial_stats.WeightedEmpWithExpTailDist``.
 
     Parameters
     ----------
@@ -90,14 +92,25 @@ def bg_pdf_loader(idx=None):
     else:
         all_idx = _np.atleast_1d(idx)
 
+    # Only needed here, keep them out of the import of every loader user
+    import tdepps.utils.stats as stats
+    from _trial_stats import WeightedEmpWithExpTailDist
+
     pdfs = {}
     for idx in all_idx:
         file_id = file_names.index("bg_pdf_tw_{:02d}.json.gz".format(idx))
         fname = files[file_id]
         print("Load bg PDF for time window {:d} from:\n  {}".format(idx,
                                                                     fname))
+        # Decompress and parse once, the weighted PDF is built from the dict
         with _gzip.open(fname) as json_file:
-            pdfs[idx] = (_stats.emp_with_exp_tail_dist.from_json(json_file))
+            raw = json_file.read()
+        d = _json.loads(raw)
+        if "weights" in d:
+            pdfs[idx] = WeightedEmpWithExpTailDist.from_dict(d)
+        else:
+            # tdepps only reads from a file object, hand it the buffered text
+            pdfs[idx] = stats.emp_with_exp_tail_dist.from_json(_BytesIO(raw))
 
     return pdfs
 
@@ -134,11 +147,11 @@ def source_list_loader(names=None):
             names = [names]
 
     print("Loaded source list from:\n  {}".format(source_file))
-    print("  Returning sources for sample(s): {}".format(_arr2str(names)))
+    print("  Returning sources for sample(s): {}".format(", ".join(names)))
     return {name: sources[name] for name in names}
 
 
-def source_map_loader(src_list):
+def source_map_loader(src_list, sparse=False):
     """
     Load the reco LLH map for a given source from the source list loader.
 
@@ -147,27 +160,38 @@ def source_map_loader(src_list):
     src_list : list of dicts, shape (nsrcs)
         List of source dicts, as provided by ``source_list_loader``. Each dict
         must have key ``'map_path'``.
+    sparse : bool, optional
+        If ``True``, only the non-zero pixels are returned, so memory scales
+        with the truncated region and not with the map resolution.
+        (default: ``False``)
 
     Returns
     -------
-    healpy_maps : array-like, shape (nsrcs, npix)
+    healpy_maps : array-like, shape (nsrcs, npix) or list of dicts
         Healpy map belonging to the given source for each source in the same
-        order as in ``src_list``.
+        order as in ``src_list``. If ``sparse`` is ``True``, a list with one
+        dict per source with keys ``'nside'``, ``'pix'`` (non-zero pixel
+        indices) and ``'vals'`` (map values at ``'pix'``) is returned instead.
     """
     healpy_maps = []
     for src in src_list:
         fpath = src["map_path"]
         print("Loading map for source: {}".format(
             _os.path.basename(fpath)))
-        with _gzip.open(fpath) as f:
-            src = _json.load(f)
-
-        healpy_maps.append(_np.array(src["map"]))
+        cols, meta = column_file_loader(fpath)
+        sparse_map = {"nside": meta["nside"], "pix": cols["pix"],
+                      "vals": cols["vals"]}
+        if sparse:
+            healpy_maps.append(sparse_map)
+        else:
+            healpy_maps.append(_densify_map(**sparse_map))
 
+    if sparse:
+        return healpy_maps
     return _np.atleast_2d(healpy_maps)
 
 
-def runlist_loader(names=None):
+def runlist_loader(names=None, index=False):
     """
     Loads runlist for given sample name.
 
@@ -177,6 +201,11 @@ def runlist_loader(names=None):
         Name(s) of the runlist(s) to load. If ``None`` returns a list of all
         possible names. If ``'all'``, returns all available runlists.
         (default: ``None``)
+    index : bool, optional
+        If ``True``, return a numeric ``_runs.RunIndex`` per runlist instead of
+        the list of run dicts. The index is cached in the ``runlists_index``
+        folder next to the runlists and rebuilt when the runlist is newer.
+        (default: ``False``)
 
     Returns
     -------
@@ -186,7 +215,60 @@ def runlist_loader(names=None):
         ``'all'`` returns all available runlists in the dict.
     """
     folder = _os.path.join(_PATHS.local, "runlists")
-    return _common_loader(names, folder=folder, info="runlist")
+    if names is None or not index:
+        return _common_loader(names, folder=folder, info="runlist")
+
+    if names == "all":
+        names = list(runlist_loader())
+    elif not isinstance(names, list):
+        names = [names]
+
+    idx_folder = _os.path.join(_PATHS.local, "runlists_index")
+    if not _os.path.isdir(idx_folder):
+        _os.makedirs(idx_folder)
+    indices = {}
+    for name in names:
+        json_file = _os.path.join(folder, name + ".json")
+        idx_file = _os.path.join(idx_folder, name + ".npz")
+        if (_os.path.isfile(idx_file) and
+                _os.path.getmtime(idx_file) >= _os.path.getmtime(json_file)):
+            print("Load runlist index for sample {} from:\n  {}".format(
+                name, idx_file))
+            indices[name] = _RunIndex.load(idx_file)
+        else:
+            run_list = _common_loader(name, folder=folder, info="runlist")
+            indices[name] = _RunIndex.from_runlist(run_list[name])
+            indices[name].save(idx_file)
+            print("  Saved runlist index to:\n    {}".format(idx_file))
+    return indices
+
+
+def hese_mc_ids_loader(names=None, mmap=True):
+    """
+    Loads the sorted, unique packed HESE like MC IDs from
+    `04-check_hese_mc_ids_combine.py`.
+
+    Parameters
+    ----------
+    names : list of str or None or 'all', optional
+        Name(s) of the MC ID set(s) to load. If ``None`` returns a list of all
+        possible names. If ``'all'``, returns all available ID sets.
+        (default: ``None``)
+    mmap : bool, optional
+        If ``True``, the IDs are opened as read-only memory maps.
+        (default: ``True``)
+
+    Returns
+    -------
+    hese_ids : dict or list
+        Dict with name(s) as key(s) and ``uint64`` ID arrays as value(s), see
+        ``_utils.pack_ids``. If ``names`` was ``None``, returns a list of
+        possible input names. If ``names`` was ``'all'`` returns all available
+        ID sets in the dict.
+    """
+    folder = _os.path.join(_PATHS.local, "check_hese_mc_ids")
+    return _common_loader(names, folder=folder, info="HESE like MC IDs",
+                          mmap=mmap)
 
 
 def settings_loader(names=None):
@@ -210,7 +292,7 @@ def settings_loader(names=None):
     return _common_loader(names, folder=folder, info="settings")
 
 
-def off_data_loader(names=None):
+def off_data_loader(names=None, mmap=False):
     """
     Parameters
     ----------
@@ -218,6 +300,9 @@ def off_data_loader(names=None):
         Name(s) of the datasets(s) to load. If ``None`` returns a list of all
         possible names. If ``'all'``, returns all available runlists.
         (default: ``None``)
+    mmap : bool, optional
+        If ``True``, return read-only memory mapped arrays, so that multiple
+        processes on a node share the same pages. (default: ``False``)
 
     Returns
     -------
@@ -228,10 +313,11 @@ def off_data_loader(names=None):
         the dict.
     """
     folder = _os.path.join(_PATHS.data, "data_offtime")
-    return _common_loader(names, folder=folder, info="offtime data")
+    return _common_loader(names, folder=folder, info="offtime data",
+                          mmap=mmap)
 
 
-def on_data_loader(names=None):
+def on_data_loader(names=None, mmap=False):
     """
     Parameters
     ----------
@@ -239,6 +325,9 @@ def on_data_loader(names=None):
         Name(s) of the datasets(s) to load. If ``None`` returns a list of all
         possible names. If ``'all'``, returns all available runlists.
         (default: ``None``)
+    mmap : bool, optional
+        If ``True``, return read-only memory mapped arrays, so that multiple
+        processes on a node share the same pages. (default: ``False``)
 
     Returns
     -------
@@ -249,10 +338,11 @@ def on_data_loader(names=None):
         the dict.
     """
     folder = _os.path.join(_PATHS.data, "data_ontime")
-    return _common_loader(names, folder=folder, info="ontime data")
+    return _common_loader(names, folder=folder, info="ontime data",
+                          mmap=mmap)
 
 
-def mc_loader(names=None):
+def mc_loader(names=None, mmap=False):
     """
     Parameters
     ----------
@@ -260,6 +350,9 @@ def mc_loader(names=None):
         Name(s) of the datasets(s) to load. If ``None`` returns a list of all
         possible names. If ``'all'``, returns all available runlists.
         (default: ``None``)
+    mmap : bool, optional
+        If ``True``, return read-only memory mapped arrays, so that multiple
+        processes on a node share the same pages. (default: ``False``)
 
     Returns
     -------
@@ -269,10 +362,10 @@ def mc_loader(names=None):
         ``names`` was ``'all'`` returns all available MC array(s) in the dict.
     """
     folder = _os.path.join(_PATHS.data, "mc_no_hese")
-    return _common_loader(names, folder=folder, info="MC")
+    return _common_loader(names, folder=folder, info="MC", mmap=mmap)
 
 
-def _common_loader(names, folder, info):
+def _common_loader(names, folder, info, mmap=False):
     """
     Outsourced some common loader code.
 
@@ -284,6 +377,9 @@ def _common_loader(names, folder, info):
         Full path to folder from where to load the data.
     info : str
         Info for print.
+    mmap : bool, optional
+        If ``True``, ``.npy`` files are opened as read-only memory maps instead
+        of being read into memory. (default: ``False``)
 
     Returns
     -------
@@ -309,7 +405,7 @@ def _common_loader(names, folder, info):
         print("Load {} for sample {} from:\n  {}".format(info, name, fname))
         ext = _os.path.splitext(fname)[1]
         if ext == ".npy":
-            data[name] = _np.load(fname)
+            data[name] = _np.load(fname, mmap_mode="r" if mmap else None)
         elif ext == ".json":
             with open(fname) as json_file:
                 data[name] = _json.load(json_file)
@@ -317,3 +413,87 @@ def _common_loader(names, folder, info):
             raise ValueError("Couldn't load unknown datatype: '{}'".format(ext))
 
     return data
+
+
+def _densify_map(nside, pix, vals):
+    """ Dense healpy map from non-zero pixel indices and values """
+    healpy_map = _np.zeros(12 * nside**2, dtype=vals.dtype)
+    healpy_map[pix] = vals
+    return healpy_map
+
+
+def column_file_loader(fname, mmap=False, names=None):
+    """
+    Load columns and metadata from a binary column file written by
+    ``_saver.column_file_saver`` or ``_saver.column_file_allocator``.
+
+    Parameters
+    ----------
+    fname : str
+        Full path to the column file.
+    mmap : bool, optional
+        If ``True``, columns are returned as read-only ``np.memmap`` objects
+        instead of being read into memory. (default: ``False``)
+    names : list of str or None, optional
+        Which columns to load. If ``None`` all columns are loaded.
+        (default: ``None``)
+
+    Returns
+    -------
+    cols : dict
+        Column names as keys and arrays as values.
+    meta : dict
+        Metadata stored in the file header.
+    """
+    meta, columns = column_file_header_loader(fname)
+    if names is not None:
+        columns = [col for col in columns if col["name"] in names]
+
+    cols = {}
+    with open(fname, "rb") as inf:
+        for col in columns:
+            dt, shape = _np.dtype(col["dtype"]), tuple(col["shape"])
+            # Columns with reserved space store more entries on the last axis,
+            # for 1D columns the valid entries are a prefix
+            stored = shape
+            if len(shape) > 1 and "capacity" in col:
+                stored = shape[:-1] + (col["capacity"],)
+            count = int(_np.prod(stored, dtype=int))
+            if int(_np.prod(shape, dtype=int)) == 0:
+                cols[col["name"]] = _np.empty(shape, dtype=dt)
+                continue
+            elif mmap:
+                arr = _np.memmap(fname, dtype=dt, mode="r",
+                                 offset=col["offset"], shape=stored)
+            else:
+                inf.seek(col["offset"])
+                arr = _np.fromfile(inf, dtype=dt, count=count).reshape(stored)
+            if stored != shape:
+                arr = arr[..., :shape[-1]]
+                if not mmap:
+                    arr = _np.ascontiguousarray(arr)
+            cols[col["name"]] = arr
+    return cols, meta
+
+
+def column_file_header_loader(fname):
+    """
+    Load only the header of a binary column file. Cheap, because no column
+    data is touched.
+
+    Parameters
+    ----------
+    fname : str
+        Full path to the column file.
+
+    Returns
+    -------
+    meta : dict
+        Metadata stored in the file header.
+    columns : list of dicts
+        Column descriptions with keys ``'name', 'dtype', 'shape', 'offset'``.
+    """
+    with open(fname, "rb") as inf:
+        hlen = read_header_length(inf, fname)
+        header = _json.loads(inf.read(hlen).decode("utf-8"))
+    return header["meta"], header["columns"]
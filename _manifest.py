@@ -0,0 +1,170 @@
+# coding: utf-8
+
+"""
+Bookkeeping for incremental combine steps.
+
+A manifest records for each combined output which job files were merged into
+it, with their size, modification time and random seed. On the next combine
+only files not yet in the manifest are merged into the existing output. If a
+merged file changed or vanished, the output is rebuilt from all files. Files
+skipped for a duplicate seed are recorded as skipped and are only looked at
+again when they change. The seeds in the output itself are checked too, so
+files merged by an interrupted combine, before its manifest was saved, are
+not merged twice.
+
+Manifests are stored as JSON next to the combined output folder, so the
+loaders globbing the output folders never see them.
+"""
+
+from __future__ import print_function
+
+import os as _os
+import json as _json
+
+
+class CombineManifest(object):
+    """
+    Merged job files per combined output.
+
+    Parameters
+    ----------
+    outpath : str
+        Output folder of the combine step. The manifest is stored as
+        ``<outpath>_manifest.json``.
+    rebuild : bool, optional
+        If ``True``, the stored manifest is ignored and all outputs are
+        rebuilt from scratch. (default: ``False``)
+    """
+    def __init__(self, outpath, rebuild=False):
+        self._fname = _os.path.normpath(outpath) + "_manifest.json"
+        self._outputs = {}
+        if not rebuild and _os.path.isfile(self._fname):
+            with open(self._fname) as inf:
+                self._outputs = _json.load(inf)["outputs"]
+            print("Loaded combine manifest from:\n  {}".format(self._fname))
+
+    @property
+    def fname(self):
+        return self._fname
+
+    def plan(self, output, files, out_file):
+        """
+        Decide which files need to be merged into an output.
+
+        Parameters
+        ----------
+        output : str
+            Name of the combined output, eg. its file name.
+        files : list of str
+            All job files currently available for this output.
+        out_file : str
+            Path of the combined output file. If it is missing, the output is
+            rebuilt.
+
+        Returns
+        -------
+        new_files : list of str
+            Files to merge. All files, if ``rebuild`` is ``True``.
+        rebuild : bool
+            ``True`` if the output must be built from scratch, because it is
+            missing or a merged file was changed or removed.
+        """
+        merged = self._outputs.get(output, {})
+        for path, entry in list(merged.items()):
+            # Skipped files are not in the output, changed ones are new files
+            if entry.get("skipped", False) and (
+                    not _os.path.isfile(path) or
+                    _file_state(path) != (entry["size"], entry["mtime"])):
+                del merged[path]
+        rebuild = not _os.path.isfile(out_file) or len(merged) == 0
+        if not rebuild:
+            for path, entry in merged.items():
+                if not _os.path.isfile(path):
+                    print("  Merged file was removed, rebuilding:\n    " + path)
+                    rebuild = True
+                    break
+                if _file_state(path) != (entry["size"], entry["mtime"]):
+                    print("  Merged file was changed, rebuilding:\n    " + path)
+                    rebuild = True
+                    break
+        if rebuild:
+            self._outputs[output] = {}
+            return list(files), True
+        return [path for path in files if path not in merged], False
+
+    def drop_duplicate_seeds(self, output, files, seeds, out_seeds=None):
+        """
+        Remove files with a seed already merged into ``output`` or used by an
+        earlier file in ``files``. Those repeat identical trials. The removed
+        files are recorded as skipped, so they are not planned again.
+
+        Parameters
+        ----------
+        output : str
+            Name of the combined output.
+        files : list of str
+            Files to merge.
+        seeds : list
+            Random seed of each file.
+        out_seeds : list or None, optional
+            Seeds stored in the existing output, eg. in its header. A file
+            with a seed in the output, but not in the manifest, was merged by
+            an interrupted combine before the manifest was saved. It is
+            recorded as merged instead of being merged again.
+            (default: ``None``)
+
+        Returns
+        -------
+        files, seeds : lists
+            Files and seeds without the duplicates.
+        """
+        merged = self._outputs.setdefault(output, {})
+        used = set(entry["seed"] for entry in merged.values())
+        unrecorded = set(out_seeds or []) - used
+        keep_files, keep_seeds = [], []
+        for path, seed in zip(files, seeds):
+            if seed in unrecorded:
+                print("  File with seed {} is already merged:\n    {}".format(
+                    seed, path))
+                self._add(merged, path, seed)
+                unrecorded.discard(seed)
+                used.add(seed)
+                continue
+            if seed in used:
+                print("  Skipping file with duplicate seed {}:\n    {}".format(
+                    seed, path))
+                self._add(merged, path, seed, skipped=True)
+                continue
+            used.add(seed)
+            keep_files.append(path)
+            keep_seeds.append(seed)
+        return keep_files, keep_seeds
+
+    def record(self, output, files, seeds=None):
+        """ Add merged files with their current size and mtime """
+        merged = self._outputs.setdefault(output, {})
+        seeds = len(files) * [None] if seeds is None else seeds
+        for path, seed in zip(files, seeds):
+            self._add(merged, path, seed)
+
+    @staticmethod
+    def _add(merged, path, seed, skipped=False):
+        """ Add a file entry with its current size and mtime """
+        size, mtime = _file_state(path)
+        merged[path] = {"size": size, "mtime": mtime, "seed": seed}
+        if skipped:
+            merged[path]["skipped"] = True
+
+    def save(self):
+        """ Write the manifest atomically """
+        tmp = self._fname + ".tmp"
+        with open(tmp, "w") as outf:
+            _json.dump({"outputs": self._outputs}, fp=outf, indent=1,
+                       sort_keys=True)
+        _os.rename(tmp, self._fname)
+
+
+def _file_state(path):
+    """ Size and modification time of a file """
+    st = _os.stat(path)
+    return st.st_size, st.st_mtime
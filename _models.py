@@ -0,0 +1,430 @@
+# coding: utf-8
+
+"""
+Build the per sample background injectors and LLHs used in the trial scripts
+and store them as binary snapshots.
+
+Fitting the injectors and LLH models is the same for every trial job of a time
+window, only the random seed changes. Snapshots are built once per time window
+by `06-make_snapshots.py` and loaded by the trial jobs instead of refitting.
+Each snapshot stores a content hash of its input files and settings. Jobs only
+compare the cheap file fingerprints (size, mtime) to detect stale snapshots.
+
+A snapshot file holds two pickle records: a small header with the hash and
+fingerprints, which can be checked without unpickling the models, and the
+models. Arrays larger than ``ARRAY_MIN_BYTES`` are not pickled but stored as
+``.npy`` files in `model_snapshots/arrays`, named by their content hash. The
+off-time data and MC held by the models of all time windows of a sample are
+therefore stored only once. When loading a snapshot, these arrays are memory
+mapped copy-on-write, so all trial jobs on a node share their pages in the
+page cache instead of each holding a private copy.
+tdepps is only imported by the functions fitting models, so scripts using only
+the snapshot paths or headers don't import it. Unpickling a snapshot imports
+`tdepps.grb` for the model classes, so the trial jobs always pay for it.
+"""
+
+import os as _os
+import hashlib as _hashlib
+import numpy as _np
+from functools import partial as _partial
+try:
+    import cPickle as _pickle
+except ImportError:
+    import pickle as _pickle
+from io import BytesIO as _BytesIO
+
+from _paths import PATHS as _PATHS
+import _loader
+
+
+# Arrays at least this large are stored as separate .npy files
+ARRAY_MIN_BYTES = 1 << 20
+_SNAPSHOT_FORMAT = 2
+# Everything a missing, truncated or incompatible snapshot can raise
+_SNAPSHOT_ERRORS = (IOError, OSError, EOFError, RuntimeError, ValueError,
+                    KeyError, AttributeError, ImportError,
+                    _pickle.UnpicklingError)
+
+
+def flux_model_factory(model, **model_args):
+    """
+    Returns a flux model callable `flux_model(trueE)`. The callable is a
+    ``functools.partial`` object so models using it can be pickled.
+
+    Parameters
+    ----------
+    model : str
+        Name of a method in ``tdeps.utils.phys``.
+    model_args : dict
+        Arguments passed to ``tdeps.utils.phys.<model>``.
+
+    Returns
+    -------
+    flux_model : callable
+        Function of single parameter, true energy, with fixed model args.
+    """
+    import tdepps.utils.phys as phys
+    return _partial(getattr(phys, model), **model_args)
+
+
+def build_sample_models(key, dt0, dt1, rndgen):
+    """
+    Load data and settings for a single sample and fit the background injector
+    and the LLH.
+
+    Parameters
+    ----------
+    key : str
+        Sample name, as in ``_loader.source_list_loader()``.
+    dt0, dt1 : float
+        Left and right time window edges in seconds.
+    rndgen : ``np.random.RandomState`` instance
+        Random state used by the background injector.
+
+    Returns
+    -------
+    bg_inj : ``tdepps.grb.TimeDecDependentBGDataInjector``
+        Fitted background injector.
+    llh : ``tdepps.grb.GRBLLH``
+        LLH with fitted ``tdepps.grb.GRBModel``.
+    """
+    from tdepps.utils import make_src_records
+    from tdepps.grb import GRBLLH, GRBModel
+    from tdepps.grb import TimeDecDependentBGDataInjector
+
+    print("\n" + 80 * "#")
+    print("# :: Setup for sample {} ::".format(key))
+    opts = _loader.settings_loader(key)[key].copy()
+    # Memory mapped, so parallel jobs on a node share the data pages
+    exp_off = _loader.off_data_loader(key, mmap=True)[key]
+    mc = _loader.mc_loader(key, mmap=True)[key]
+    srcs = _loader.source_list_loader(key)[key]
+    runlist = _loader.runlist_loader(key)[key]
+    # Process to tdepps format
+    srcs_rec = make_src_records(srcs, dt0=dt0, dt1=dt1)
+
+    # Setup BG injector
+    bg_inj = TimeDecDependentBGDataInjector(
+        inj_opts=opts["bg_inj_opts"], random_state=rndgen)
+    bg_inj.fit(X=exp_off, srcs=srcs_rec, run_list=runlist)
+
+    # Setup LLH model and LLH
+    fmod = opts["model_energy_opts"].pop("flux_model")
+    flux_model = flux_model_factory(fmod["model"], **fmod["args"])
+    opts["model_energy_opts"]["flux_model"] = flux_model
+    llhmod = GRBModel(X=exp_off, MC=mc, srcs=srcs_rec, run_list=runlist,
+                      spatial_opts=opts["model_spatial_opts"],
+                      energy_opts=opts["model_energy_opts"])
+    llh = GRBLLH(llh_model=llhmod, llh_opts=opts["llh_opts"])
+
+    return bg_inj, llh
+
+
+def build_sig_injector(key, dt0, dt1, sig_inj_type, time_sam):
+    """
+    Load MC and settings for a single sample and fit the signal injector.
+
+    Parameters
+    ----------
+    key : str
+        Sample name, as in ``_loader.source_list_loader()``.
+    dt0, dt1 : float
+        Left and right time window edges in seconds.
+    sig_inj_type : str
+        ``'healpy'`` injects from the source prior maps, ``'ps'`` at the best
+        fit source positions.
+    time_sam : ``tdepps.grb.UniformTimeSampler``
+        Time sampler for the injected events.
+
+    Returns
+    -------
+    sig_inj : ``tdepps.grb.SignalFluenceInjector``
+        Fitted signal injector, ``HealpySignalFluenceInjector`` for healpy.
+    """
+    from tdepps.utils import make_src_records
+    from tdepps.grb import SignalFluenceInjector, HealpySignalFluenceInjector
+
+    opts = _loader.settings_loader(key)[key].copy()
+    mc = _loader.mc_loader(key, mmap=True)[key]
+    srcs = _loader.source_list_loader(key)[key]
+    # Process to tdepps format
+    srcs_rec = make_src_records(srcs, dt0=dt0, dt1=dt1)
+
+    fmod = opts["sig_inj_opts"].pop("flux_model")
+    flux_model = flux_model_factory(fmod["model"], **fmod["args"])
+    # Decide what type of injection we need
+    if sig_inj_type == "healpy":
+        # Always inject the best fit source position, exactly as tested
+        opts["sig_inj_opts"]["inj_sigma"] = 3.
+        src_maps = _loader.source_map_loader(src_list=srcs)
+        sig_inj = HealpySignalFluenceInjector(
+            flux_model, time_sampler=time_sam, inj_opts=opts["sig_inj_opts"])
+        sig_inj.fit(srcs_rec, src_maps=src_maps, MC=mc)
+        del src_maps
+    elif sig_inj_type == "ps":
+        # Inject source position from prior map, worsening performance
+        sig_inj = SignalFluenceInjector(flux_model, time_sampler=time_sam,
+                                        inj_opts=opts["sig_inj_opts"])
+        sig_inj.fit(srcs_rec, MC=mc)
+    else:
+        raise ValueError("`sig_inj_type` can be 'ps' or 'healpy'.")
+    return sig_inj
+
+
+def get_sample_models(key, tw_id, rndgen):
+    """
+    Load the injector and LLH for a sample and time window from its snapshot.
+    If no valid snapshot is available the models are fitted from scratch.
+
+    Parameters
+    ----------
+    key : str
+        Sample name, as in ``_loader.source_list_loader()``.
+    tw_id : int
+        Time window index, as in ``_loader.time_window_loader()``.
+    rndgen : ``np.random.RandomState`` instance
+        Random state set to the background injector.
+
+    Returns
+    -------
+    bg_inj : ``tdepps.grb.TimeDecDependentBGDataInjector``
+        Fitted background injector using ``rndgen``.
+    llh : ``tdepps.grb.GRBLLH``
+        LLH with fitted ``tdepps.grb.GRBModel``.
+    """
+    fname = snapshot_path(key, tw_id)
+    try:
+        return load_model_snapshot(fname, rndgen)
+    except _SNAPSHOT_ERRORS as err:
+        print("No valid snapshot for sample {}, tw {:02d}: {}".format(
+            key, tw_id, err))
+        print("  Fitting models from scratch.")
+    dt0, dt1 = _loader.time_window_loader(tw_id)
+    return build_sample_models(key, dt0, dt1, rndgen)
+
+
+def snapshot_path(key, tw_id):
+    """ Full path of the snapshot file for a sample and time window """
+    return _os.path.join(_PATHS.data, "model_snapshots",
+                         "{}_tw_{:02d}.pkl".format(key, tw_id))
+
+
+def snapshot_array_path(digest):
+    """ Full path of a snapshot array file with the given content hash """
+    return _os.path.join(_PATHS.data, "model_snapshots", "arrays",
+                         digest + ".npy")
+
+
+def snapshot_inputs(key):
+    """
+    Input files the models of a sample are built from.
+
+    Parameters
+    ----------
+    key : str
+        Sample name.
+
+    Returns
+    -------
+    files : list of str
+        Full paths to the input files.
+    """
+    return [
+        _os.path.join(_PATHS.local, "time_window_list", "time_window_list.txt"),
+        _os.path.join(_PATHS.local, "settings", key + ".json"),
+        _os.path.join(_PATHS.local, "source_list", "source_list.json"),
+        _os.path.join(_PATHS.local, "runlists", key + ".json"),
+        _os.path.join(_PATHS.data, "data_offtime", key + ".npy"),
+        _os.path.join(_PATHS.data, "mc_no_hese", key + ".npy"),
+        ]
+
+
+def inputs_hash(key, tw_id):
+    """
+    SHA1 hash of all input file contents for a sample and time window.
+
+    Parameters
+    ----------
+    key : str
+        Sample name.
+    tw_id : int
+        Time window index.
+
+    Returns
+    -------
+    digest : str
+        Hex digest of the input file contents and the time window index.
+    """
+    sha = _hashlib.sha1("tw_{:02d}".format(tw_id).encode("utf-8"))
+    for fname in snapshot_inputs(key):
+        with open(fname, "rb") as inf:
+            for chunk in iter(lambda: inf.read(1 << 20), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def save_model_snapshot(fname, bg_inj, llh, key, tw_id, digest):
+    """
+    Pickle a fitted injector and LLH together with the input fingerprints.
+    Large arrays are stored in content addressed ``.npy`` files, arrays that
+    already exist from other snapshots are not written again.
+
+    Parameters
+    ----------
+    fname : str
+        Full output file path.
+    bg_inj, llh : tdepps objects
+        Fitted background injector and LLH.
+    key : str
+        Sample name.
+    tw_id : int
+        Time window index.
+    digest : str
+        Content hash as returned by ``inputs_hash``.
+    """
+    # Keep the arrays referenced, so their ids stay unique while pickling
+    arrays = {}
+
+    def persistent_id(obj):
+        if (type(obj) not in (_np.ndarray, _np.memmap) or
+                obj.dtype.hasobject or obj.nbytes < ARRAY_MIN_BYTES):
+            return None
+        if id(obj) not in arrays:
+            arrays[id(obj)] = (obj, _save_array(obj))
+        return ("npy", arrays[id(obj)][1])
+
+    # The header lists the array files, so pickle the models first. Without
+    # the large arrays they are small.
+    buf = _BytesIO()
+    pickler = _pickle.Pickler(buf, _pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump({"bg_inj": bg_inj, "llh": llh})
+    header = {
+        "format": _SNAPSHOT_FORMAT,
+        "key": key,
+        "tw_id": tw_id,
+        "hash": digest,
+        "fingerprints": _fingerprints(key),
+        "arrays": sorted(set(d for _, d in arrays.values())),
+        }
+    # Write atomically, jobs may be reading the old snapshot
+    with open(fname + ".tmp", "wb") as outf:
+        _pickle.dump(header, outf, protocol=_pickle.HIGHEST_PROTOCOL)
+        outf.write(buf.getvalue())
+    _os.rename(fname + ".tmp", fname)
+
+
+def load_model_snapshot(fname, rndgen):
+    """
+    Load a fitted injector and LLH from a snapshot file.
+
+    Parameters
+    ----------
+    fname : str
+        Full path to the snapshot file.
+    rndgen : ``np.random.RandomState`` instance
+        Random state set to the background injector, because the pickled
+        injector carries the random state from the time it was built.
+
+    Returns
+    -------
+    bg_inj, llh : tdepps objects
+        Fitted background injector and LLH.
+
+    Raises
+    ------
+    RuntimeError
+        If the snapshot is outdated, because input files have changed, or has
+        an unknown format.
+    """
+    with open(fname, "rb") as inf:
+        header = _load_header(inf, fname)
+        if header["fingerprints"] != _fingerprints(header["key"]):
+            raise RuntimeError("Snapshot '{}' is outdated.".format(fname))
+        # Objects sharing an array share it again after loading
+        loaded = {}
+
+        def persistent_load(pid):
+            if pid not in loaded:
+                loaded[pid] = _load_array(pid)
+            return loaded[pid]
+
+        unpickler = _pickle.Unpickler(inf)
+        unpickler.persistent_load = persistent_load
+        models = unpickler.load()
+    print("Loaded model snapshot for sample {} from:\n  {}".format(
+        header["key"], fname))
+    bg_inj = models["bg_inj"]
+    bg_inj.rndgen = rndgen
+    return bg_inj, models["llh"]
+
+
+def load_snapshot_header(fname):
+    """
+    Header of a snapshot, without loading the models.
+
+    Returns
+    -------
+    header : dict or None
+        Keys ``'key', 'tw_id', 'hash', 'fingerprints'`` and ``'arrays'``, the
+        content hashes of the array files used. ``None`` if the snapshot is
+        missing or not readable.
+    """
+    try:
+        with open(fname, "rb") as inf:
+            return _load_header(inf, fname)
+    except _SNAPSHOT_ERRORS:
+        return None
+
+
+def load_snapshot_hash(fname):
+    """ Stored content hash of a snapshot or ``None`` if not available """
+    header = load_snapshot_header(fname)
+    return None if header is None else header["hash"]
+
+
+def _load_header(inf, fname):
+    """ Read the header record from an open snapshot file """
+    header = _pickle.load(inf)
+    if (not isinstance(header, dict) or
+            header.get("format", None) != _SNAPSHOT_FORMAT):
+        raise RuntimeError("Snapshot '{}' has an old format.".format(fname))
+    return header
+
+
+def _save_array(arr):
+    """ Store an array under its content hash, returns the hash """
+    arr = _np.ascontiguousarray(arr)
+    sha = _hashlib.sha1("{}{}".format(arr.dtype.descr, arr.shape).encode(
+        "utf-8"))
+    sha.update(arr.reshape(-1).view(_np.uint8))
+    digest = sha.hexdigest()
+    fname = snapshot_array_path(digest)
+    if not _os.path.isfile(fname):
+        if not _os.path.isdir(_os.path.dirname(fname)):
+            _os.makedirs(_os.path.dirname(fname))
+        with open(fname + ".tmp", "wb") as outf:
+            _np.save(outf, arr)
+        _os.rename(fname + ".tmp", fname)
+    return digest
+
+
+def _load_array(pid):
+    """
+    Persistent load of arrays stored with ``_save_array``. Arrays are memory
+    mapped copy-on-write: pages are shared until a model writes to them, which
+    then only copies the written pages.
+    """
+    kind, digest = pid
+    if kind != "npy":
+        raise _pickle.UnpicklingError("Unknown persistent ID: {}".format(pid))
+    return _np.load(snapshot_array_path(digest), mmap_mode="c")
+
+
+def _fingerprints(key):
+    """ Cheap ``[path, size, mtime]`` fingerprints of the sample's inputs """
+    fps = []
+    for fname in snapshot_inputs(key):
+        stat = _os.stat(fname)
+        fps.append([fname, stat.st_size, int(stat.st_mtime)])
+    return fps
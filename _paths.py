@@ -7,26 +7,49 @@ for each branch, without interfering with previous results.
 
 In a script use `from PATHS import PATHS` and eg. `local_path = PATHS.local`.
 Get all available paths with `print(PATHS)`.
-```
+
+To work outside the cluster, eg. with the synthetic data from
+`make_synthetic_data.py`, set the environment variable `HESE_STACKING_ROOT` to
+a working directory. All paths are then placed below it and the branch name is
+read from `HESE_STACKING_BRANCH` (default: 'offline') instead of git.
+
+Paths are resolved lazily on first access and cached. Without
+`HESE_STACKING_ROOT`, the branch name is taken from `HESE_STACKING_BRANCH` or
+read from the repository's `.git/HEAD` file, so git itself is never needed.
+Single paths can be set explicitly with `HESE_STACKING_<NAME>`, eg.
+`HESE_STACKING_DATA`. The job generators bake the resolved paths into the job
+files with `job_exe`, so cluster jobs don't resolve anything themselves. DAG
+jobs keep the default command of the job creator, see `creator_default_exe`.
 """
 
 import os as _os
-from git import Repo as _Repo
+import sys as _sys
+import inspect as _inspect
+
+
+# Default locations on the cluster
+_REPO_PATH = _os.path.join("/home", "tmenne", "analysis",
+                           "hese_transient_stacking_analysis")
+_DATA_ROOT = _os.path.join("/data", "user", "tmenne")
+_NAMES = ["repo", "local", "data", "jobs", "plots"]
 
 
 class _Paths(object):
     """
     Class to acces paths via it's attributes.
     Code adopted from scipy.optimize.OptimizeResult.
+    Paths are resolved on the first attribute access.
     """
-    def __init__(self, d):
+    def __init__(self, d=None):
         self._d = d
 
     def __getattr__(self, name):
-            try:
-                return self._d[name]
-            except KeyError:
-                raise AttributeError(name)
+        if self._d is None:
+            self._d = _resolve_paths()
+        try:
+            return self._d[name]
+        except KeyError:
+            raise AttributeError(name)
 
     def __setattr__(self, name, val):
         if name != "_d":
@@ -36,25 +59,129 @@ class _Paths(object):
             super(_Paths, self).__setattr__(name, val)
 
     def __repr__(self):
+        if self._d is None:
+            self._d = _resolve_paths()
         m = max(map(len, list(self._d.keys()))) + 1
         return '\n'.join([name.rjust(m) + ': ' + path
                           for name, path in self._d.items()])
 
 
-# Insert the current branch name to automatically switch to a new work dir
-_repo_path = _os.path.join("/home", "tmenne", "analysis",
-                           "hese_transient_stacking_analysis")
-_repo_name = _os.path.basename(_repo_path)
-_repo = _Repo(_repo_path)
-_BRANCH_NAME = _repo.active_branch.name
-
-_paths = {
-    "repo": _repo_path,
-    "local": _os.path.join(_repo_path, "out_" + _BRANCH_NAME),
-    "data": _os.path.join("/data", "user", "tmenne", _repo_name,
-                          "rawout_" + _BRANCH_NAME),
-    "jobs": _os.path.join(_repo_path, "jobfiles_" + _BRANCH_NAME),
-    "plots": _os.path.join(_repo_path, "plots_" + _BRANCH_NAME),
-}
-
-PATHS = _Paths(_paths)
+def _resolve_paths():
+    """ Build all paths from the environment or the repository state """
+    env = _os.environ
+    overrides = {name: env.get("HESE_STACKING_" + name.upper()) for name in
+                 _NAMES}
+    if all(overrides.values()):
+        # Fully set, eg. in job files from `job_exe`
+        return overrides
+
+    root = env.get("HESE_STACKING_ROOT", None)
+    if root is None:
+        repo_path = env.get("HESE_STACKING_REPO", _REPO_PATH)
+        branch = env.get("HESE_STACKING_BRANCH", None)
+        if branch is None:
+            branch = _read_git_branch(repo_path)
+        data_path = _os.path.join(_DATA_ROOT, _os.path.basename(repo_path))
+        work_path = repo_path
+    else:
+        # Offline mode: Repo is where this file is, all output below the root
+        repo_path = env.get("HESE_STACKING_REPO", _os.path.dirname(
+            _os.path.abspath(__file__)))
+        branch = env.get("HESE_STACKING_BRANCH", "offline")
+        data_path = _os.path.abspath(root)
+        work_path = _os.path.abspath(root)
+
+    paths = {
+        "repo": repo_path,
+        "local": _os.path.join(work_path, "out_" + branch),
+        "data": _os.path.join(data_path, "rawout_" + branch),
+        "jobs": _os.path.join(work_path, "jobfiles_" + branch),
+        "plots": _os.path.join(work_path, "plots_" + branch),
+    }
+    # Explicit overrides for single paths
+    for name, path in overrides.items():
+        if path:
+            paths[name] = path
+    return paths
+
+
+def _read_git_branch(repo_path):
+    """ Active branch name from ``.git/HEAD``, short hash if detached """
+    head = _os.path.join(repo_path, ".git", "HEAD")
+    with open(head) as inf:
+        ref = inf.read().strip()
+    if ref.startswith("ref:"):
+        return ref.split("refs/heads/", 1)[-1]
+    return ref[:8]
+
+
+def job_env():
+    """
+    Environment fixing all paths to the ones resolved here, to be baked into
+    job files so the jobs never need to resolve them. Other ``HESE_STACKING_``
+    settings, eg. for synthetic data, are passed on as they are.
+
+    Returns
+    -------
+    env : dict
+        Environment variable names and values.
+    """
+    env = {key: val for key, val in _os.environ.items() if
+           key.startswith("HESE_STACKING_")}
+    env.update({"HESE_STACKING_" + name.upper(): getattr(PATHS, name) for
+                name in _NAMES})
+    return env
+
+
+def job_exe(exe=None):
+    """
+    Command prefix for job files, running ``exe`` with the ``job_env``.
+
+    Parameters
+    ----------
+    exe : list of str or None, optional
+        Command prefix the job script is run with. If ``None``, the current
+        python interpreter is used. (default: ``None``)
+
+    Returns
+    -------
+    exe : list of str
+        ``env`` call setting the job environment followed by ``exe``.
+    """
+    exe = [_sys.executable] if exe is None else list(exe)
+    env = job_env()
+    return (["/usr/bin/env"] + ["{}={}".format(key, env[key]) for key in
+                                sorted(env.keys())] + exe)
+
+
+def creator_default_exe(job_creator):
+    """
+    Default command prefix of a job creator's ``create_job``, eg. of the
+    ``dagman.DAGManJobCreator``, to wrap it with ``job_exe`` unchanged.
+
+    Parameters
+    ----------
+    job_creator : object
+        Job creator with a ``create_job`` method having an ``exe`` argument.
+
+    Returns
+    -------
+    exe : list of str
+        Default command prefix.
+    """
+    try:
+        exe = _inspect.signature(job_creator.create_job).parameters[
+            "exe"].default
+    except AttributeError:  # No ``inspect.signature`` in python 2
+        spec = _inspect.getargspec(job_creator.create_job)
+        exe = dict(zip(spec.args[::-1], spec.defaults[::-1]))["exe"]
+    if isinstance(exe, str):
+        return [exe]
+    if isinstance(exe, (list, tuple)):
+        return list(exe)
+    raise ValueError("Can't wrap the default command '{}' of ".format(exe) +
+                     "{}, pass `exe` explicitly.".format(
+                         type(job_creator).__name__))
+
+
+PATHS = _Paths()
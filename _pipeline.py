@@ -0,0 +1,427 @@
+# coding: utf-8
+
+"""
+Make-style runner for the analysis stages.
+
+Each stage declares the scripts it runs and the files or folders it reads and
+writes. A stage's key is a hash over the content of its scripts and the local
+helper modules they import, its arguments, the ``HESE_STACKING_*`` environment
+and the content of its inputs. After a successful run, the key and the hash of
+the outputs are stored in the state file. A stage is rerun only if its key
+changed or its outputs were changed or removed since, so a stage whose
+upstream reran but produced identical outputs is not recomputed either.
+
+Stages are scheduled as soon as all stages producing their inputs are done, so
+independent stages run concurrently. File hashes are cached by size and
+modification time, so unchanged large data files are only hashed once.
+"""
+
+from __future__ import print_function
+
+import os as _os
+import re as _re
+import sys as _sys
+import json as _json
+import time as _time
+import shutil as _shutil
+import hashlib as _hashlib
+import subprocess as _subprocess
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED as _FIRST_COMPLETED
+from concurrent.futures import wait as _wait
+
+from _paths import PATHS as _PATHS
+
+
+_IMPORT_RE = _re.compile(r"^\s*(?:from|import)\s+(_\w+)", _re.MULTILINE)
+
+
+class Stage(object):
+    """
+    A single pipeline stage.
+
+    Parameters
+    ----------
+    name : str
+        Unique stage name.
+    commands : list of lists
+        Each command is a script file name in the repository followed by its
+        arguments. Commands run one after another.
+    inputs, outputs : list of str
+        Full paths of the files or folders read and written.
+    clean : list of str, optional
+        Folders with intermediate job outputs, removed before the stage runs,
+        so no results from outdated inputs are merged. (default: ``None``)
+    cluster : bool, optional
+        If ``True``, the stage needs the cluster environment and is only run
+        if explicitly enabled. Otherwise its outputs are used as they are.
+        (default: ``False``)
+    manual : bool, optional
+        If ``True``, the stage is only run if it is given as a target or
+        forced, eg. because its inputs are written by cluster jobs the
+        pipeline can't wait for. Otherwise its outputs are used as they are.
+        (default: ``False``)
+    """
+    def __init__(self, name, commands, inputs, outputs, clean=None,
+                 cluster=False, manual=False):
+        self.name = name
+        self.commands = commands
+        self.inputs = inputs
+        self.outputs = outputs
+        self.clean = [] if clean is None else clean
+        self.cluster = cluster
+        self.manual = manual
+
+    @property
+    def scripts(self):
+        return sorted(set(cmd[0] for cmd in self.commands))
+
+    def __repr__(self):
+        return "Stage({})".format(self.name)
+
+
+class Pipeline(object):
+    """
+    Dependency resolution, staleness checks and concurrent stage execution.
+
+    Parameters
+    ----------
+    stages : list of ``Stage``
+        Stages in pipeline order. A stage may only depend on earlier stages.
+    state_file : str
+        JSON file with the stage keys and output hashes of the last runs.
+    log_dir : str
+        Folder for the stage logs.
+    """
+    def __init__(self, stages, state_file, log_dir):
+        self._stages = stages
+        self._state_file = state_file
+        self._log_dir = log_dir
+        self._state = {"stages": {}, "hashes": {}}
+        if _os.path.isfile(state_file):
+            with open(state_file) as inf:
+                self._state = _json.load(inf)
+        self._deps = self._resolve_deps()
+
+    @property
+    def stages(self):
+        return [stage.name for stage in self._stages]
+
+    def deps(self, name):
+        """ Names of the stages producing the inputs of stage ``name`` """
+        return self._deps[name]
+
+    def stage_key(self, stage):
+        """ Hash over code, arguments, environment and inputs of a stage """
+        code = {}
+        for mod in _local_modules(stage.scripts, _PATHS.repo):
+            code[mod] = self._hash_path(_os.path.join(_PATHS.repo, mod))
+        env = {key: val for key, val in _os.environ.items() if
+               key.startswith("HESE_STACKING_")}
+        key = {"commands": stage.commands, "code": code, "env": env,
+               "inputs": {path: self._hash_path(path) for path in
+                          stage.inputs}}
+        return _hash_str(_json.dumps(key, sort_keys=True))
+
+    def outputs_hash(self, stage):
+        """ Hash over the outputs of a stage, ``None`` if any is missing """
+        if not all(_os.path.exists(path) for path in stage.outputs):
+            return None
+        return _hash_str(_json.dumps(
+            {path: self._hash_path(path) for path in stage.outputs},
+            sort_keys=True))
+
+    def is_stale(self, stage):
+        """
+        ``True`` if the stage must run, because it never ran, its key changed
+        or its outputs are missing or were changed since the last run.
+        """
+        last = self._state["stages"].get(stage.name)
+        if last is None:
+            return True
+        if last["key"] != self.stage_key(stage):
+            return True
+        return last["outputs"] != self.outputs_hash(stage)
+
+    def run(self, names=None, force=None, nworkers=2, dry_run=False,
+            cluster=False):
+        """
+        Run all stale stages needed for the selected ones.
+
+        Parameters
+        ----------
+        names : list of str or None, optional
+            Target stages, all their upstream stages are considered too. If
+            ``None``, all stages are targets. Manual stages only run if they
+            are given here or in ``force``. (default: ``None``)
+        force : list of str or None, optional
+            Stages to run even if up to date. (default: ``None``)
+        nworkers : int, optional
+            Number of stages running at the same time. (default: 2)
+        dry_run : bool, optional
+            If ``True``, only print which stages would run. Stale stages are
+            assumed to change their outputs. (default: ``False``)
+        cluster : bool, optional
+            If ``True``, also run the cluster stages. (default: ``False``)
+
+        Returns
+        -------
+        status : dict
+            Stage names as keys, one of ``'ran', 'up to date', 'skipped',
+            'failed', 'blocked', 'would run'`` as values.
+        """
+        force = set() if force is None else set(force)
+        explicit = force | set([] if names is None else names)
+        todo = self._upstream(self.stages if names is None else names)
+        stages = {stage.name: stage for stage in self._stages
+                  if stage.name in todo}
+        status = {}
+        if not _os.path.isdir(self._log_dir):
+            _os.makedirs(self._log_dir)
+
+        running = {}
+        with _ThreadPoolExecutor(max_workers=nworkers) as executor:
+            while len(status) < len(stages):
+                for name, stage in stages.items():
+                    if name in status or name in running.values():
+                        continue
+                    dep_status = [status.get(dep) for dep in self.deps(name)
+                                  if dep in stages]
+                    if any(s is None for s in dep_status):
+                        continue
+                    if any(s in ("failed", "blocked") for s in dep_status):
+                        status[name] = "blocked"
+                        continue
+                    # Upstream is final, so the key is final too
+                    upstream_changed = any(s == "would run" for s in
+                                           dep_status)
+                    if ((stage.cluster and not cluster) or
+                            (stage.manual and name not in explicit)):
+                        status[name] = "skipped"
+                    elif (name not in force and not upstream_changed and
+                            not self.is_stale(stage)):
+                        status[name] = "up to date"
+                    elif dry_run:
+                        status[name] = "would run"
+                    else:
+                        print("Starting stage '{}'".format(name))
+                        running[executor.submit(self._run_stage, stage)] = name
+                        continue
+                    print("Stage '{}': {}".format(name, status[name]))
+                if not running:
+                    continue
+                done, _ = _wait(list(running.keys()),
+                                return_when=_FIRST_COMPLETED)
+                for fut in done:
+                    name = running.pop(fut)
+                    runtime = fut.result()
+                    if runtime is None:
+                        status[name] = "failed"
+                    else:
+                        # Hashes are only touched in this thread
+                        status[name] = "ran"
+                        self._state["stages"][name] = {
+                            "key": self.stage_key(stages[name]),
+                            "outputs": self.outputs_hash(stages[name]),
+                            "runtime": runtime}
+                    print("Stage '{}': {}".format(name, status[name]))
+                    self._save_state()
+        self._save_state()
+        return status
+
+    def _run_stage(self, stage):
+        """ Run all commands of a stage, returns the runtime or ``None`` """
+        for path in stage.clean:
+            if _os.path.isdir(path):
+                _shutil.rmtree(path)
+        log = _os.path.join(self._log_dir, stage.name + ".log")
+        t0 = _time.time()
+        with open(log, "w") as logf:
+            for cmd in stage.commands:
+                args = [_sys.executable,
+                        _os.path.join(_PATHS.repo, cmd[0])] + list(cmd[1:])
+                logf.write("$ {}\n".format(" ".join(args)))
+                logf.flush()
+                ret = _subprocess.call(args, stdout=logf,
+                                       stderr=_subprocess.STDOUT,
+                                       cwd=_PATHS.repo)
+                # Local job scripts exit non-zero if any single job failed,
+                # so a partial job set never reaches the combine command
+                if ret != 0:
+                    print("Stage '{}' failed, see:\n  {}".format(
+                        stage.name, log))
+                    return None
+        return _time.time() - t0
+
+    def _resolve_deps(self):
+        """ Stage depends on the earlier stages writing any of its inputs """
+        deps = {}
+        for i, stage in enumerate(self._stages):
+            deps[stage.name] = []
+            for other in self._stages[:i]:
+                if any(_is_inside(inp, out) or _is_inside(out, inp) for
+                       inp in stage.inputs for out in other.outputs):
+                    deps[stage.name].append(other.name)
+        return deps
+
+    def _upstream(self, names):
+        """ ``names`` and all stages they depend on """
+        todo, stack = set(), list(names)
+        while stack:
+            name = stack.pop()
+            if name not in self._deps:
+                raise ValueError("Unknown stage '{}'.".format(name))
+            if name not in todo:
+                todo.add(name)
+                stack.extend(self._deps[name])
+        return todo
+
+    def _hash_path(self, path):
+        """ Content hash of a file or of all files in a folder """
+        if _os.path.isfile(path):
+            return self._hash_file(path)
+        if not _os.path.isdir(path):
+            return None
+        hashes = []
+        for root, dirs, files in _os.walk(path):
+            dirs.sort()
+            for fname in sorted(files):
+                fpath = _os.path.join(root, fname)
+                hashes.append([_os.path.relpath(fpath, path),
+                               self._hash_file(fpath)])
+        return _hash_str(_json.dumps(hashes))
+
+    def _hash_file(self, path):
+        """ Cached file content hash, rehashed only if size or mtime change """
+        st = _os.stat(path)
+        cached = self._state["hashes"].get(path)
+        if cached is not None and cached[:2] == [st.st_size, st.st_mtime]:
+            return cached[2]
+        sha = _hashlib.sha1()
+        with open(path, "rb") as inf:
+            for chunk in iter(lambda: inf.read(1 << 20), b""):
+                sha.update(chunk)
+        self._state["hashes"][path] = [st.st_size, st.st_mtime,
+                                       sha.hexdigest()]
+        return sha.hexdigest()
+
+    def _save_state(self):
+        tmp = self._state_file + ".tmp"
+        with open(tmp, "w") as outf:
+            _json.dump(self._state, fp=outf, indent=1, sort_keys=True)
+        _os.rename(tmp, self._state_file)
+
+
+def _local_modules(scripts, repo):
+    """ Scripts and all local ``_module`` files they import, recursively """
+    found, stack = set(), list(scripts)
+    while stack:
+        fname = stack.pop()
+        fpath = _os.path.join(repo, fname)
+        if fname in found or not _os.path.isfile(fpath):
+            continue
+        found.add(fname)
+        with open(fpath) as inf:
+            stack.extend(mod + ".py" for mod in _IMPORT_RE.findall(inf.read()))
+    return sorted(found)
+
+
+def _is_inside(path, folder):
+    """ ``True`` if ``path`` is ``folder`` or inside it """
+    path, folder = _os.path.abspath(path), _os.path.abspath(folder)
+    return path == folder or path.startswith(folder.rstrip(_os.sep) + _os.sep)
+
+
+def _hash_str(s):
+    return _hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+def default_stages(sig_inj="ps", nworkers=None):
+    """
+    The analysis stages 00 - 10 with their inputs and outputs.
+
+    Parameters
+    ----------
+    sig_inj : str, optional
+        Signal injector type for the performance trials. (default: ``'ps'``)
+    nworkers : int or None, optional
+        Concurrent local trial jobs per stage, ``None`` uses all cores.
+        (default: ``None``)
+
+    Returns
+    -------
+    stages : list of ``Stage``
+        Stages in pipeline order.
+    """
+    def local(*p):
+        return _os.path.join(_PATHS.local, *p)
+
+    def jobs(*p):
+        return _os.path.join(_PATHS.jobs, *p)
+
+    def data(*p):
+        return _os.path.join(_PATHS.data, *p)
+
+    jobs_args = ["--local"]
+    if nworkers is not None:
+        jobs_args += ["--nworkers", str(nworkers)]
+
+    # The datasets are external, except for offline runs on synthetic data
+    datasets = []
+    if _os.environ.get("HESE_STACKING_SYNTHETIC", "0") not in ("", "0"):
+        datasets = [data("synthetic_datasets")]
+
+    time_windows = local("time_window_list")
+    maps = local("hese_scan_maps_truncated")
+    runlists = local("runlists")
+    sources = local("source_list")
+    hese_ids = local("check_hese_mc_ids")
+    splits = [data("data_offtime"), data("data_ontime"), data("mc_no_hese")]
+    settings = local("settings")
+    snapshots = data("model_snapshots")
+    model_inputs = [time_windows, sources, runlists, settings, snapshots]
+    model_inputs += splits
+    # The healpy signal injector samples from the source prior maps
+    perf_inputs = model_inputs + ([maps] if sig_inj == "healpy" else [])
+    return [
+        Stage("time_windows", [["00-make_time_window_list.py"]],
+              inputs=[], outputs=[time_windows]),
+        Stage("maps", [["01-create_hese_equatorial_maps.py"]],
+              inputs=[], outputs=[maps], cluster=True),
+        Stage("runlists", [["02-make_runlists.py"]],
+              inputs=datasets, outputs=[runlists]),
+        Stage("sources", [["03-make_source_files.py"]],
+              inputs=[maps, runlists], outputs=[sources]),
+        # Only writes the DAG files, the jobs are submitted by hand. Run the
+        # combine stage explicitly when all jobs are done
+        Stage("hese_mc_ids_jobs", [["04-check_hese_mc_ids_jobs.py"]],
+              inputs=[], outputs=[jobs("check_hese_mc_ids")], cluster=True),
+        Stage("hese_mc_ids", [["04-check_hese_mc_ids_combine.py",
+                               "--rebuild"]],
+              inputs=[data("check_hese_mc_ids")], outputs=[hese_ids],
+              cluster=True, manual=True),
+        Stage("data", [["05-prepare_data_and_mc.py"]],
+              inputs=datasets + [time_windows, runlists, sources, hese_ids],
+              outputs=splits),
+        Stage("settings", [["06-make_settings.py"]],
+              inputs=[sources, runlists] + splits, outputs=[settings]),
+        Stage("snapshots", [["06-make_snapshots.py", "--force"]],
+              inputs=[time_windows, sources, runlists, settings] + splits,
+              outputs=[snapshots]),
+        Stage("bg_trials", [["07-bg_trials_jobs.py"] + jobs_args,
+                            ["07-bg_trials_combine.py", "--rebuild"]],
+              inputs=model_inputs, outputs=[data("bg_trials_combined")],
+              clean=[data("bg_trials")]),
+        Stage("bg_pdfs", [["08-make_bg_pdfs.py"]],
+              inputs=[time_windows, data("bg_trials_combined")],
+              outputs=[local("bg_pdfs")]),
+        Stage("performance", [["09-performance_jobs.py", "--sig_inj",
+                               sig_inj] + jobs_args],
+              inputs=perf_inputs,
+              outputs=[data("performance_trials_" + sig_inj)],
+              clean=[data("performance_trials_" + sig_inj)]),
+        Stage("post_trials", [["10-post_trials_jobs.py"] + jobs_args,
+                              ["10-post_trials_combine.py", "--rebuild"]],
+              inputs=model_inputs, outputs=[local("post_trials_combined")],
+              clean=[data("post_trials")]),
+        ]
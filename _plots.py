@@ -19,7 +19,8 @@ def make_bg_pdf_scan_plots(fname, emp_dist, thresh_vals, pvals, scales,
     fname : str
         Absolute filename to where the plot is saved.
     emp_dist : ``tdepps.utils.stats.emp_with_exp_tail_dist`` instance
-        PDF object with the best fit threshold stored.
+        PDF object with the best fit threshold stored. Can also be a
+        ``_trial_stats.WeightedEmpWithExpTailDist`` for weighted trials.
     thresh_vals : array-like
         Scanned threshold values.
     pvals : array-like
@@ -29,11 +30,16 @@ def make_bg_pdf_scan_plots(fname, emp_dist, thresh_vals, pvals, scales,
     pval_thresh : float
         p-value used to decide which is the best fit threshold.
     """
+    weighted = hasattr(emp_dist, "weights")
+
     def _plot_sigma_lines(ax, sigmas):
         sigmas = np.sort(sigmas)
         q = 100. * np.atleast_1d(stats.sigma2prob(sigmas))
-        _p = stats.percentile_nzeros(emp_dist.data, emp_dist.nzeros,
-                                     q=q, sorted=True)
+        if weighted:
+            _p = emp_dist.emp_ppf(q)
+        else:
+            _p = stats.percentile_nzeros(emp_dist.data, emp_dist.nzeros,
+                                         q=q, sorted=True)
         for i, pi in enumerate(_p):
             ax.axvline(pi, 0, 1, ls="--", c="C7",
                        alpha=sigmas[i] / np.amax(sigmas),
@@ -66,8 +72,11 @@ def make_bg_pdf_scan_plots(fname, emp_dist, thresh_vals, pvals, scales,
 
     # ## Center: Plot the selected combined p-values ##
     x = np.linspace(0, np.amax(emp_dist.data), 500)
-    cdf_emp = 1. - stats.cdf_nzeros(emp_dist.data, emp_dist.nzeros, vals=x,
-                                    sorted=True)
+    if weighted:
+        cdf_emp = emp_dist.emp_sf(x)
+    else:
+        cdf_emp = 1. - stats.cdf_nzeros(emp_dist.data, emp_dist.nzeros,
+                                        vals=x, sorted=True)
     cdf_dist = emp_dist.sf(x)
     _plot_sigma_lines(axc, [3., 4., 5., 5.5])
     axc.plot(x, cdf_emp, color="k")
@@ -0,0 +1,165 @@
+# coding: utf-8
+
+"""
+Numeric run interval index built from the JSON runlists.
+
+The runlists store the run borders as ISO strings. Parsing them with astropy
+is slow, so they are converted once to sorted MJD arrays, which answer the
+usual run queries with ``searchsorted``. The runs of a runlist are assumed to
+be non-overlapping, as constructed in `02-make_runlists.py`.
+"""
+
+from __future__ import division
+
+import numpy as _np
+
+
+class RunIndex(object):
+    """
+    Sorted, non-overlapping run intervals.
+
+    Parameters
+    ----------
+    runs : array-like, shape (nruns,)
+        Run IDs.
+    start, stop : array-like, shape (nruns,)
+        Run start and stop times in MJD.
+    """
+    def __init__(self, runs, start, stop):
+        runs = _np.atleast_1d(runs).astype(int)
+        start = _np.atleast_1d(start).astype(float)
+        stop = _np.atleast_1d(stop).astype(float)
+        if not len(runs) == len(start) == len(stop):
+            raise ValueError("`runs`, `start` and `stop` must have the same " +
+                             "length.")
+        if _np.any(stop < start):
+            raise ValueError("Run stop times must not be before start times.")
+        srt_idx = _np.argsort(start, kind="mergesort")
+        self._runs = runs[srt_idx]
+        self._start = start[srt_idx]
+        self._stop = stop[srt_idx]
+        if _np.any(self._start[1:] < self._stop[:-1]):
+            raise ValueError("Runs must not overlap.")
+        # Livetime before each run start, for livetime in arbitrary windows
+        self._cum_livetime = _np.concatenate(
+            [[0.], _np.cumsum(self._stop - self._start)])
+
+    @classmethod
+    def from_runlist(cls, run_list):
+        """
+        Build the index from a runlist as loaded by ``runlist_loader``. All
+        ISO time strings are parsed in a single astropy call.
+        """
+        from astropy.time import Time as _astrotime
+        runs = [r["run"] for r in run_list]
+        start = _astrotime([r["good_tstart"] for r in run_list],
+                           format="iso").mjd
+        stop = _astrotime([r["good_tstop"] for r in run_list],
+                          format="iso").mjd
+        return cls(runs, start, stop)
+
+    @classmethod
+    def load(cls, fname):
+        """ Load an index saved with ``save`` """
+        with _np.load(fname) as f:
+            return cls(f["runs"], f["start"], f["stop"])
+
+    def save(self, fname):
+        """ Save the index arrays to an ``.npz`` file """
+        with open(fname, "wb") as outf:
+            _np.savez(outf, runs=self._runs, start=self._start,
+                      stop=self._stop)
+
+    @property
+    def runs(self):
+        return self._runs
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def stop(self):
+        return self._stop
+
+    @property
+    def tmin(self):
+        """ Start of the first run in MJD """
+        return self._start[0]
+
+    @property
+    def tmax(self):
+        """ Stop of the last run in MJD """
+        return self._stop[-1]
+
+    def __len__(self):
+        return len(self._runs)
+
+    def run_index(self, t):
+        """
+        Index of the run containing each time, ``-1`` if not inside any run.
+
+        Parameters
+        ----------
+        t : array-like
+            Times in MJD.
+
+        Returns
+        -------
+        idx : array-like, same shape as ``t``
+            Run indices in the sorted arrays of this index.
+        """
+        t = _np.asarray(t, dtype=float)
+        idx = _np.searchsorted(self._start, t, side="right") - 1
+        inside = (idx >= 0) & (t <= self._stop[_np.maximum(idx, 0)])
+        return _np.where(inside, idx, -1)
+
+    def run_at(self, t):
+        """ Run ID containing each time in MJD, ``-1`` if not inside a run """
+        idx = self.run_index(t)
+        return _np.where(idx >= 0, self._runs[_np.maximum(idx, 0)], -1)
+
+    def overlapping(self, t0, t1):
+        """
+        Runs overlapping the window ``[t0, t1]``.
+
+        Parameters
+        ----------
+        t0, t1 : float
+            Window borders in MJD.
+
+        Returns
+        -------
+        sl : slice
+            Slice into ``runs``, ``start`` and ``stop`` of the overlapping runs.
+        """
+        lo = _np.searchsorted(self._stop, t0, side="left")
+        hi = _np.searchsorted(self._start, t1, side="right")
+        return slice(int(lo), int(max(lo, hi)))
+
+    def livetime(self, t0, t1):
+        """
+        Livetime in days inside the windows ``[t0, t1]``.
+
+        Parameters
+        ----------
+        t0, t1 : array-like
+            Window borders in MJD, broadcastable to each other.
+
+        Returns
+        -------
+        livetime : array-like
+            Summed run time inside each window in days.
+        """
+        return _np.maximum(self._livetime_before(t1) -
+                           self._livetime_before(t0), 0.)
+
+    def _livetime_before(self, t):
+        """ Total livetime before time ``t`` """
+        t = _np.asarray(t, dtype=float)
+        idx = _np.maximum(_np.searchsorted(self._start, t, side="right") - 1,
+                          0)
+        inside = _np.clip(t - self._start[idx], 0.,
+                          self._stop[idx] - self._start[idx])
+        return _np.where(t < self._start[0], 0., self._cum_livetime[idx] +
+                         inside)
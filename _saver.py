@@ -0,0 +1,379 @@
+# coding: utf-8
+
+"""
+Saver methods for binary data formats, counterpart to the readers in
+`_loader.py`. If a format changes, we only need to change the saving part here
+once.
+
+Column files are used to store trial outputs and sparse source maps. The layout
+is:
+
+- 8 byte magic string ``_MAGIC``.
+- 8 byte little endian unsigned int, the length of the JSON header in bytes.
+- JSON header with keys ``'meta'`` (dict, arbitrary JSON metadata) and
+  ``'columns'`` (list of dicts with keys ``'name', 'dtype', 'shape',
+  'offset'``). The header is padded with whitespace to ``_ALIGN`` bytes.
+- Raw C-ordered column data, each column starting at ``offset`` bytes from the
+  file start, aligned to ``_ALIGN`` bytes.
+
+Because the columns are raw arrays, reading is a plain ``np.fromfile`` or a
+``np.memmap`` and writing is a single ``tobytes`` call per column.
+
+Columns growing along their last axis, like combined trials, can reserve
+space: the stored array then has ``'capacity'`` entries along the last axis,
+of which the first ``shape[-1]`` are valid, and the header is padded further.
+``column_file_appender`` fills the reserved space in place and rewrites only
+the header.
+"""
+
+import os as _os
+import json as _json
+import struct as _struct
+import numpy as _np
+
+
+_MAGIC = b"HESECOL1"
+_ALIGN = 64
+# Trial columns don't need more than single precision
+TRIAL_DTYPE = _np.dtype("<f4")
+
+
+def column_file_saver(fname, cols, meta=None, dtype=None):
+    """
+    Write arrays and metadata to a binary column file.
+
+    Parameters
+    ----------
+    fname : str
+        Full output file path.
+    cols : dict
+        Column names as keys and array-like data as values.
+    meta : dict or None, optional
+        JSON serializable metadata stored in the file header. numpy scalars and
+        arrays are converted to native types. (default: ``None``)
+    dtype : numpy dtype or None, optional
+        If given, all columns are converted to this dtype, otherwise each
+        column's own dtype is used. (default: ``None``)
+    """
+    cols = {name: _np.ascontiguousarray(arr, dtype=dtype) for
+            name, arr in cols.items()}
+    specs = {name: (arr.dtype, arr.shape) for name, arr in cols.items()}
+    header, offsets = _make_header(specs, meta)
+    with open(fname, "wb") as outf:
+        outf.write(header)
+        for name in sorted(cols.keys()):
+            outf.seek(offsets[name])
+            # Written straight from the array buffer, without a bytes copy
+            cols[name].tofile(outf)
+
+
+def column_file_allocator(fname, specs, meta=None, grow=1.):
+    """
+    Create a column file with preallocated, zero filled columns and return
+    writeable memory maps to fill them without holding them in memory.
+
+    Parameters
+    ----------
+    fname : str
+        Full output file path.
+    specs : dict
+        Column names as keys and tuples ``(dtype, shape)`` as values.
+    meta : dict or None, optional
+        JSON serializable metadata stored in the file header.
+        (default: ``None``)
+    grow : float, optional
+        If larger than 1, ``grow`` times the needed space is reserved for the
+        last axis of each column and for the header, to append to later with
+        ``column_file_appender``. (default: 1.)
+
+    Returns
+    -------
+    cols : dict
+        Column names as keys and ``np.memmap`` objects in ``'r+'`` mode as
+        values. Call ``flush`` or delete them to write to disk.
+    """
+    specs = {name: (_np.dtype(dt), tuple(shape)) for
+             name, (dt, shape) in specs.items()}
+    capacity = None
+    if grow > 1.:
+        capacity = {name: int(_np.ceil(grow * shape[-1])) for
+                    name, (_, shape) in specs.items()}
+    header, offsets = _make_header(specs, meta, capacity=capacity, grow=grow)
+    stored = _stored_specs(specs, capacity)
+    nbytes = max([offsets[n] + _nbytes(*stored[n]) for n in specs] +
+                 [len(header)])
+    with open(fname, "wb") as outf:
+        outf.write(header)
+        outf.truncate(nbytes)
+    return _map_columns(fname, specs, offsets, capacity)
+
+
+def column_file_merger(fname, files, meta=None, grow=1.):
+    """
+    Concatenate the columns of multiple column files into a single new column
+    file. Columns are concatenated along their last axis and are copied file by
+    file into a preallocated, memory mapped output, so peak memory is bounded
+    by a single input file and never by the full output.
+
+    Parameters
+    ----------
+    fname : str
+        Full output file path.
+    files : list of str
+        Input column files. All must have the same column names, dtypes and
+        shapes apart from the last axis.
+    meta : dict or None, optional
+        JSON serializable metadata for the output file header.
+        (default: ``None``)
+    grow : float, optional
+        Space reserved for appending, see ``column_file_allocator``.
+        (default: 1.)
+
+    Returns
+    -------
+    nrows : dict
+        Column names as keys and the list of the number of entries along the
+        last axis contributed by each input file as values.
+    """
+    specs, nrows = _concat_specs(files)
+    out = column_file_allocator(fname, specs, meta, grow=grow)
+    _copy_columns(out, files, {name: 0 for name in out})
+    return nrows
+
+
+def column_file_appender(fname, files, meta=None, grow=2.):
+    """
+    Append the columns of column files to an existing column file along their
+    last axis. If the reserved space behind each column and the header
+    padding are large enough, the new entries are written in place and only
+    the header is rewritten, so the existing entries are not touched.
+    Otherwise the file is rewritten once with ``grow`` times the needed space
+    reserved, which keeps repeated appends cheap on average.
+
+    The new entries are written before the header, so an interrupted append
+    leaves the previous content valid.
+
+    Parameters
+    ----------
+    fname : str
+        Existing column file, eg. from ``column_file_merger``.
+    files : list of str
+        Column files to append, with the same column names, dtypes and shapes
+        apart from the last axis as ``fname``.
+    meta : dict or None, optional
+        JSON serializable metadata for the new file header.
+        (default: ``None``)
+    grow : float, optional
+        Reserved space factor for a rewrite. (default: 2.)
+
+    Returns
+    -------
+    nrows : dict
+        Column names as keys and the list of the number of entries along the
+        last axis contributed by each file in ``files`` as values.
+    """
+    # Lazy import, the loader itself needs the format constants from here
+    from _loader import column_file_header_loader
+
+    specs, nrows = _concat_specs([fname] + files)
+    _, columns = column_file_header_loader(fname)
+    old_rows = {col["name"]: col["shape"][-1] for col in columns}
+    capacity = {col["name"]: col.get("capacity", col["shape"][-1]) for
+                col in columns}
+    with open(fname, "rb") as inf:
+        hlen = read_header_length(inf, fname)
+    header, offsets = _make_header(specs, meta, capacity=capacity,
+                                   min_hlen=hlen)
+    fits = (all(specs[n][1][-1] <= capacity[n] for n in specs) and
+            all(offsets[col["name"]] == col["offset"] for col in columns))
+    if not fits:
+        print("Reserved space of '{}' is full, rewriting it.".format(fname))
+        _nrows = column_file_merger(fname + ".tmp", [fname] + files, meta,
+                                    grow=grow)
+        _os.rename(fname + ".tmp", fname)
+        return {name: rows[1:] for name, rows in _nrows.items()}
+
+    out = _map_columns(fname, specs, offsets, capacity)
+    _copy_columns(out, files, old_rows)
+    del out
+    # Commit the new entries by replacing the header of the same length
+    with open(fname, "r+b") as outf:
+        outf.write(header)
+    return {name: rows[1:] for name, rows in nrows.items()}
+
+
+def read_header_length(inf, fname):
+    """
+    Check the magic string at the start of an open column file and read the
+    length of its JSON header.
+
+    Parameters
+    ----------
+    inf : file object
+        Column file opened in binary mode, positioned at the start.
+    fname : str
+        File name, only used for the error message.
+
+    Returns
+    -------
+    hlen : int
+        Length of the padded JSON header in bytes, which follows directly.
+    """
+    if inf.read(len(_MAGIC)) != _MAGIC:
+        raise ValueError("'{}' is not a column file.".format(fname))
+    return _struct.unpack("<Q", inf.read(8))[0]
+
+
+def _concat_specs(files):
+    """
+    Output ``(dtype, shape)`` per column when concatenating ``files`` along
+    the last axis, and the rows contributed by each file, from the headers.
+    """
+    # Lazy import, the loader itself needs the format constants from here
+    from _loader import column_file_header_loader
+
+    specs, nrows = None, None
+    for fi in files:
+        _, columns = column_file_header_loader(fi)
+        _specs = {col["name"]: (col["dtype"], col["shape"]) for col in columns}
+        if specs is None:
+            specs = {n: (dt, shp[:-1] + [0]) for n, (dt, shp) in
+                     _specs.items()}
+            nrows = {n: [] for n in specs}
+        if sorted(_specs.keys()) != sorted(specs.keys()):
+            raise ValueError("Columns in '{}' don't match.".format(fi))
+        for name, (dt, shp) in _specs.items():
+            dt0, shp0 = specs[name]
+            if dt != dt0 or shp[:-1] != shp0[:-1]:
+                raise ValueError("Column '{}' in '{}' ".format(name, fi) +
+                                 "has incompatible dtype or shape.")
+            shp0[-1] += shp[-1]
+            nrows[name].append(shp[-1])
+    if specs is None:
+        raise ValueError("No input files given.")
+    specs = {name: (_np.dtype(dt), tuple(shape)) for
+             name, (dt, shape) in specs.items()}
+    return specs, nrows
+
+
+def _map_columns(fname, specs, offsets, capacity):
+    """
+    Writeable memory maps of the valid part of each column, see
+    ``column_file_allocator``.
+    """
+    stored = _stored_specs(specs, capacity)
+    cols = {}
+    for name, (dt, shape) in specs.items():
+        if _nbytes(dt, shape) == 0:
+            cols[name] = _np.empty(shape, dtype=dt)
+            continue
+        cols[name] = _np.memmap(fname, dtype=dt, mode="r+",
+                                offset=offsets[name], shape=stored[name][1])
+        if stored[name][1] != shape:
+            cols[name] = cols[name][..., :shape[-1]]
+    return cols
+
+
+def _copy_columns(out, files, offsets):
+    """
+    Copy the columns of ``files`` file by file into the output arrays ``out``
+    along the last axis, starting at ``offsets`` per column.
+    """
+    # Lazy import, the loader itself needs the format constants from here
+    from _loader import column_file_loader
+
+    for fi in files:
+        cols, _ = column_file_loader(fi, mmap=True)
+        for name, arr in cols.items():
+            n = arr.shape[-1]
+            out[name][..., offsets[name]:offsets[name] + n] = arr
+            offsets[name] += n
+        del cols
+    for arr in out.values():
+        if isinstance(arr, _np.memmap):
+            arr.flush()
+
+
+def _stored_specs(specs, capacity):
+    """ ``(dtype, shape)`` per column including the reserved space """
+    if capacity is None:
+        return specs
+    return {name: (dt, tuple(shape[:-1]) + (capacity[name],)) for
+            name, (dt, shape) in specs.items()}
+
+
+def _make_header(specs, meta, capacity=None, grow=1., min_hlen=0):
+    """
+    Build the binary file header and the column data offsets.
+
+    Parameters
+    ----------
+    specs : dict
+        Column names as keys and tuples ``(dtype, shape)`` as values.
+    meta : dict or None
+        JSON serializable metadata.
+    capacity : dict or None, optional
+        Column names as keys and the reserved length of the last axis as
+        values. (default: ``None``)
+    grow : float, optional
+        Reserve ``grow`` times the needed header length. (default: 1.)
+    min_hlen : int, optional
+        Minimum padded header length, eg. to keep the offsets of an existing
+        file. (default: 0)
+
+    Returns
+    -------
+    header : bytes
+        Magic, header length and padded JSON header.
+    offsets : dict
+        Column names as keys and byte offsets from the file start as values.
+    """
+    names = sorted(specs.keys())
+    columns = [{"name": n, "dtype": specs[n][0].str,
+                "shape": list(specs[n][1]), "offset": 0} for n in names]
+    if capacity is not None:
+        for col in columns:
+            col["capacity"] = int(capacity[col["name"]])
+    stored = _stored_specs(specs, capacity)
+    meta = {} if meta is None else meta
+
+    # Offsets depend on the header length which depends on the offsets. Iterate
+    # until the header size is stable, which is usually the second pass
+    hlen = 0
+    while True:
+        start = _align(len(_MAGIC) + 8 + hlen)
+        offsets = {}
+        for col in columns:
+            col["offset"] = start
+            offsets[col["name"]] = start
+            start = _align(start + _nbytes(*stored[col["name"]]))
+        js = _json.dumps({"meta": meta, "columns": columns},
+                         default=_to_builtin, separators=(",", ":"))
+        js = js.encode("utf-8")
+        _hlen = max(_align(len(_MAGIC) + 8 + int(grow * len(js))) -
+                    len(_MAGIC) - 8, min_hlen)
+        if _hlen == hlen:
+            break
+        hlen = _hlen
+
+    js = js + b" " * (hlen - len(js))
+    return _MAGIC + _struct.pack("<Q", hlen) + js, offsets
+
+
+def _align(n):
+    """ Round ``n`` up to the next multiple of ``_ALIGN`` """
+    return int(-(-n // _ALIGN) * _ALIGN)
+
+
+def _nbytes(dtype, shape):
+    """ Bytes needed for an array with given ``dtype`` and ``shape`` """
+    return int(_np.prod(shape, dtype=int)) * _np.dtype(dtype).itemsize
+
+
+def _to_builtin(obj):
+    """ ``json.dump`` default hook converting numpy types to native types """
+    if isinstance(obj, _np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, _np.generic):
+        return obj.item()
+    raise TypeError("{} is not JSON serializable".format(repr(obj)))
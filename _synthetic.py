@@ -0,0 +1,318 @@
+# coding: utf-8
+
+"""
+Synthetic stand-ins for the external analysis inputs, to run and time the
+pipeline offline without the skylab datasets and the cluster file systems.
+
+`make_synthetic_data.py` writes, at a configurable scale:
+
+- Experimental data and MC record arrays per sample with the dtypes of the
+  skylab track samples, readable with the ``Datasets`` shim here.
+- Truncated HESE source maps as written by `01-create_hese_equatorial_maps.py`.
+- HESE like MC IDs as written by `04-check_hese_mc_ids_combine.py`.
+
+To use them, set ``HESE_STACKING_ROOT`` to a working directory (see
+`_paths.py`) and ``HESE_STACKING_SYNTHETIC=1``, so `02-make_runlists.py` and
+`05-prepare_data_and_mc.py` load the synthetic samples via ``load_datasets``.
+Then all stages from `02` on run as usual, skipping `04`.
+"""
+
+from __future__ import print_function, division
+
+import os as _os
+import numpy as _np
+
+from _paths import PATHS as _PATHS
+from _utils import pack_ids as _pack_ids
+
+
+# Sample layout: dataset, MJD range, first run ID, events per day at scale 1,
+# MC name. Roughly the real 6 year HESE overlap of the PS and GFU samples
+SAMPLES = {
+    "IC79": ("PointSourceTracks", 55347.3, 55694.4, 115000, 270., "IC79"),
+    "IC86, 2011": ("PointSourceTracks", 55694.4, 56062.4, 118000, 370.,
+                   "IC86_2011"),
+    "IC86, 2012-2014": ("PointSourceTracks", 56062.4, 57160.0, 120028, 310.,
+                        "IC86_2012-2015"),
+    "IC86, 2015": ("GFU", 57160.0, 57528.0, 126289, 500., "IC86_2012-2015"),
+    }
+# Dtypes as in the skylab track samples
+EXP_DTYPE = [("Run", _np.int64), ("Event", _np.int64), ("time", float),
+             ("ra", float), ("dec", float), ("sinDec", float),
+             ("logE", float), ("sigma", float)]
+MC_DTYPE = EXP_DTYPE + [("trueRa", float), ("trueDec", float),
+                        ("trueE", float), ("ow", float)]
+RUN_LENGTH = 8. / 24.  # Run length in days
+MC_NEVTS = 500000      # MC events per MC set at scale 1
+
+
+def datasets_path():
+    """ Folder with the synthetic samples """
+    return _os.path.join(_PATHS.data, "synthetic_datasets")
+
+
+def load_datasets():
+    """
+    Dataset collection used by the data preparation scripts.
+
+    Returns
+    -------
+    Datasets : dict-like
+        ``skylab.datasets.Datasets`` or, if the environment variable
+        ``HESE_STACKING_SYNTHETIC`` is set, a dict of ``SyntheticTracks``
+        with the same ``files`` and ``load`` interface.
+    """
+    if _os.environ.get("HESE_STACKING_SYNTHETIC", "") not in ("", "0"):
+        print("Using synthetic datasets from:\n  {}".format(datasets_path()))
+        # All samples are in the same folder, so MC can be shared
+        return {name: SyntheticTracks(datasets_path())
+                for name in set(s[0] for s in SAMPLES.values())}
+    from skylab.datasets import Datasets
+    return Datasets
+
+
+class SyntheticTracks(object):
+    """
+    Minimal replacement for a skylab track dataset, reading the samples written
+    by `make_synthetic_data.py`.
+
+    Parameters
+    ----------
+    folder : str
+        Folder with ``<sample>_exp.npy`` and ``<mc name>_mc.npy`` files.
+    """
+    def __init__(self, folder):
+        self._folder = folder
+
+    def files(self, name):
+        """ Full paths to the data and MC files of sample ``name`` """
+        name_ = name.replace(", ", "_")
+        exp_file = _os.path.join(self._folder, name_ + "_exp.npy")
+        mc_file = _os.path.join(self._folder, SAMPLES[name][-1] + "_mc.npy")
+        return exp_file, mc_file
+
+    def load(self, files):
+        """ Load and concatenate sample files """
+        if isinstance(files, list):
+            return _np.concatenate([_np.load(f) for f in files])
+        return _np.load(files)
+
+
+def make_run_table(t0, t1, first_run, rndgen, drop=0.05):
+    """
+    Consecutive runs between ``t0`` and ``t1`` with a fraction of dropped runs
+    to get realistic gaps.
+
+    Returns
+    -------
+    runs : array-like
+        Run IDs.
+    tstart, tstop : array-like
+        Run start and stop times in MJD.
+    """
+    tstart = _np.arange(t0, t1, RUN_LENGTH)
+    tstop = _np.minimum(tstart + RUN_LENGTH, t1)
+    runs = first_run + _np.arange(len(tstart))
+    keep = rndgen.uniform(size=len(runs)) >= drop
+    # Keep the first runs, they are the ones excluded for overlapping samples
+    keep[:3] = True
+    return runs[keep], tstart[keep], tstop[keep]
+
+
+def make_exp(name, scale, rndgen):
+    """
+    Experimental data for a sample. Events are spread uniformly over the runs
+    with an atmospheric like northern and a harder, sparser southern part.
+
+    Parameters
+    ----------
+    name : str
+        Sample name, key in ``SAMPLES``.
+    scale : float
+        Scale of the number of events relative to the real sample.
+    rndgen : ``np.random.RandomState`` instance
+
+    Returns
+    -------
+    exp : record-array
+        Data with dtype ``EXP_DTYPE``, sorted in time.
+    runs : array-like
+        Run IDs, the run table of this sample.
+    """
+    _, t0, t1, first_run, rate, _ = SAMPLES[name]
+    runs, tstart, tstop = make_run_table(t0, t1, first_run, rndgen)
+    livetime = tstop - tstart
+    nevts = rndgen.poisson(scale * rate * _np.sum(livetime))
+
+    # Distribute events to runs by livetime and uniformly in each run
+    run_idx = rndgen.choice(len(runs), size=nevts,
+                            p=livetime / _np.sum(livetime))
+    exp = _np.empty(nevts, dtype=EXP_DTYPE)
+    exp["Run"] = runs[run_idx]
+    exp["time"] = (tstart[run_idx] +
+                   rndgen.uniform(size=nevts) * livetime[run_idx])
+    srt = _np.argsort(exp["time"])
+    exp = exp[srt]
+    exp["Event"] = _event_ids(exp["Run"], rndgen)
+
+    north = rndgen.uniform(size=nevts) < 0.7
+    exp["sinDec"] = _np.where(north, rndgen.uniform(-0.1, 1., size=nevts),
+                              rndgen.uniform(-1., -0.1, size=nevts))
+    exp["dec"] = _np.arcsin(exp["sinDec"])
+    exp["ra"] = rndgen.uniform(0., 2. * _np.pi, size=nevts)
+    exp["logE"] = _np.where(north, 2.3 + rndgen.exponential(0.5, size=nevts),
+                            4.3 + rndgen.exponential(0.4, size=nevts))
+    exp["sigma"] = _sigma(exp["logE"], rndgen)
+    return exp, runs
+
+
+def make_mc(name, scale, rndgen):
+    """
+    MC for a MC set, generated with an ``E^-2`` power law over the full sky.
+
+    Parameters
+    ----------
+    name : str
+        MC name, last entry in ``SAMPLES``.
+    scale : float
+        Scale of the number of events relative to ``MC_NEVTS``.
+    rndgen : ``np.random.RandomState`` instance
+
+    Returns
+    -------
+    mc : record-array
+        MC with dtype ``MC_DTYPE``. Run IDs are unique per MC set.
+    """
+    nevts = max(int(scale * MC_NEVTS), 1000)
+    mc = _np.empty(nevts, dtype=MC_DTYPE)
+    # E^-2 from 1e2 to 1e8 GeV by inverse transform
+    emin, emax = 1e2, 1e8
+    u = rndgen.uniform(size=nevts)
+    mc["trueE"] = 1. / (1. / emin - u * (1. / emin - 1. / emax))
+    mc["trueRa"] = rndgen.uniform(0., 2. * _np.pi, size=nevts)
+    mc["trueDec"] = _np.arcsin(rndgen.uniform(-1., 1., size=nevts))
+    mc["logE"] = _np.log10(mc["trueE"]) + rndgen.normal(0., 0.3, size=nevts)
+    mc["sigma"] = _sigma(mc["logE"], rndgen)
+    # Smear the directions with the reconstruction uncertainty
+    mc["ra"], mc["dec"] = _smear(mc["trueRa"], mc["trueDec"], mc["sigma"],
+                                 rndgen)
+    mc["sinDec"] = _np.sin(mc["dec"])
+    # One weight for E^-2 generation with a rising effective area
+    aeff = 1e-4 * _np.sqrt(mc["trueE"])  # m^2
+    mc["ow"] = (aeff * 1e4 * 4. * _np.pi * mc["trueE"]**2 *
+                (1. / emin - 1. / emax) / nevts)
+    # 100 files with consecutive event IDs
+    mc["Run"] = _np.repeat(_np.arange(100), _np.ceil(nevts / 100.))[:nevts]
+    mc_names = sorted(set(sam[-1] for sam in SAMPLES.values()))
+    mc["Run"] += 1000 * (1 + mc_names.index(name))
+    mc["Event"] = _event_ids(mc["Run"], rndgen)
+    return mc
+
+
+def make_hese_ids(mc, frac=1e-3):
+    """
+    HESE like MC IDs in the format of `04-check_hese_mc_ids_combine.py`,
+    sorted, unique packed ``uint64`` IDs. The highest energy fraction ``frac``
+    of the MC is tagged as HESE like.
+    """
+    nhese = max(int(frac * len(mc)), 1)
+    idx = _np.argsort(mc["trueE"])[-nhese:]
+    return _np.unique(_pack_ids(mc["Run"][idx], mc["Event"][idx]))
+
+
+def make_source_maps(nsrcs, nside, rndgen, run_tables):
+    """
+    Source maps with a Gaussian shaped reco LLH around a random position, as
+    written by `01-create_hese_equatorial_maps.py`. Sources are placed at
+    random times during the runs of the samples.
+
+    Parameters
+    ----------
+    nsrcs : int
+        Number of sources.
+    nside : int
+        Healpy map resolution.
+    rndgen : ``np.random.RandomState`` instance
+    run_tables : list of tuples
+        ``(runs, tstart, tstop)`` as from ``make_run_table``. Each source is
+        placed in a random run of these.
+
+    Returns
+    -------
+    maps : list of tuples
+        ``(cols, meta)`` per source, with columns ``'pix', 'vals'`` and the
+        source info plus ``nside`` as metadata.
+    """
+    import healpy as hp
+
+    npix = hp.nside2npix(nside)
+    th, phi = hp.pix2ang(nside, _np.arange(npix))
+    pix_dec, pix_ra = _np.pi / 2. - th, phi
+
+    runs = _np.concatenate([rt[0] for rt in run_tables])
+    tstart = _np.concatenate([rt[1] for rt in run_tables])
+    tstop = _np.concatenate([rt[2] for rt in run_tables])
+
+    maps = []
+    for i in range(nsrcs):
+        j = rndgen.randint(len(runs))
+        mjd = tstart[j] + rndgen.uniform() * (tstop[j] - tstart[j])
+        ra = rndgen.uniform(0., 2. * _np.pi)
+        dec = _np.arcsin(rndgen.uniform(-1., 1.))
+        sigma = _np.deg2rad(rndgen.uniform(0.5, 3.))
+
+        cos_dist = (_np.sin(dec) * _np.sin(pix_dec) + _np.cos(dec) *
+                    _np.cos(pix_dec) * _np.cos(pix_ra - ra))
+        dist = _np.arccos(_np.clip(cos_dist, -1., 1.))
+        pdf_map = _np.exp(-0.5 * (dist / sigma)**2)
+        pdf_map /= _np.sum(pdf_map) * hp.nside2pixarea(nside)
+        pix = _np.flatnonzero(dist <= 6. * sigma)
+        if len(pix) == 0:
+            pix = _np.array([_np.argmin(dist)])
+        bf_pix = _np.argmax(pdf_map)
+
+        meta = {"run_id": int(runs[j]), "event_id": int(rndgen.randint(10**8)),
+                "mjd": float(mjd), "nside": int(nside),
+                "bf_equ": {"ra": ra, "dec": dec},
+                "bf_equ_pix": {"ra": float(pix_ra[bf_pix]),
+                               "dec": float(pix_dec[bf_pix])}}
+        cols = {"pix": pix.astype(_np.int64),
+                "vals": pdf_map[pix].astype(_np.float64)}
+        maps.append((cols, meta))
+    return maps
+
+
+def save_hese_ids(fname, hese_ids):
+    """ Save HESE like MC IDs as plain npy, to be memory mapped """
+    _np.save(fname, hese_ids)
+
+
+def _event_ids(runs, rndgen):
+    """ Increasing event IDs per run with random gaps """
+    steps = 1 + rndgen.poisson(50., size=len(runs))
+    ids = _np.cumsum(steps)
+    # Restart the counter at each new run
+    new_run = _np.r_[True, runs[1:] != runs[:-1]]
+    offsets = _np.maximum.accumulate(_np.where(new_run, ids - steps, 0))
+    return ids - offsets
+
+
+def _sigma(logE, rndgen):
+    """ Angular uncertainty shrinking with energy, in radian """
+    sig = _np.deg2rad(1.5) * 10**(-0.25 * (logE - 3.))
+    sig *= rndgen.lognormal(0., 0.3, size=len(logE))
+    return _np.clip(sig, _np.deg2rad(0.1), _np.deg2rad(20.))
+
+
+def _smear(ra, dec, sigma, rndgen):
+    """ Move directions by Gaussian offsets with width ``sigma`` """
+    x = _np.cos(dec) * _np.cos(ra)
+    y = _np.cos(dec) * _np.sin(ra)
+    z = _np.sin(dec)
+    # Random offsets in the tangential plane
+    dx, dy, dz = sigma * rndgen.normal(size=(3, len(ra)))
+    x, y, z = x + dx, y + dy, z + dz
+    norm = _np.sqrt(x**2 + y**2 + z**2)
+    dec_s = _np.arcsin(z / norm)
+    ra_s = _np.mod(_np.arctan2(y, x), 2. * _np.pi)
+    return ra_s, dec_s
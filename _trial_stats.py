@@ -0,0 +1,450 @@
+# coding: utf-8
+
+"""
+Statistics helpers for background trial distributions, complementing
+`tdepps.utils.stats`.
+
+Trial summaries store the bulk of the test statistic distribution as a fixed
+binning histogram and only the largest ``topk`` values exactly. Summaries from
+independent jobs are merged by adding histograms and counts and keeping the
+overall largest values, so a whole time window fits in a few MB.
+
+Below the exact tail, ts values are only resolved to the bin width of
+``TS_BINS`` (0.01). ``TOPK`` is chosen so that the exact tail still reaches
+below the 3 sigma quantile, where the tail threshold scan of
+`08-make_bg_pdfs.py` starts, for up to ~1.5e8 trials per time window.
+
+Importance sampled trials from `07-bg_trials.py --bias` carry per trial
+weights. ``WeightedEmpWithExpTailDist`` is the weighted counterpart of
+``tdepps.utils.stats.emp_with_exp_tail_dist`` for these. It also holds the
+distributions built from summaries, with histogram bins as count weighted
+entries, see ``ts_summary_to_dist``.
+"""
+
+import json as _json
+import numpy as _np
+
+
+# Fixed default binning, so that summaries of all jobs can be merged
+TS_BINS = _np.linspace(0., 100., 10001)
+# 3 sigma one-sided tail fraction is 1.35e-3, so 2e5 values cover 1.5e8 trials
+TOPK = 200000
+# Keys of array and scalar entries in a summary dict
+SUMMARY_COLS = ("hist", "bins", "tail")
+SUMMARY_COUNTS = ("nzeros", "ntrials", "noverflow")
+
+
+def make_ts_summary(ts, nzeros, ntrials, bins=None, topk=TOPK):
+    """
+    Build a mergeable summary from non-zero trial test statistic values.
+
+    Parameters
+    ----------
+    ts : array-like
+        Non-zero test statistic values.
+    nzeros : int
+        Number of trials with ``ts = 0``.
+    ntrials : int
+        Total number of trials, including zero trials.
+    bins : array-like or None, optional
+        Histogram bin edges. If ``None``, ``TS_BINS`` is used.
+        (default: ``None``)
+    topk : int, optional
+        How many of the largest ``ts`` values are kept exactly.
+        (default: ``TOPK``)
+
+    Returns
+    -------
+    summary : dict
+        Keys ``SUMMARY_COLS`` with arrays: ``'hist'`` the counts of all ``ts``
+        values in ``bins``, ``'bins'`` the used edges and ``'tail'`` the
+        ``topk`` largest ``ts`` values, sorted descending. Keys
+        ``SUMMARY_COUNTS`` with ints: ``'nzeros', 'ntrials'`` and
+        ``'noverflow'``, the number of values above the last bin edge.
+    """
+    ts = _np.asarray(ts, dtype=float)
+    bins = TS_BINS if bins is None else _np.asarray(bins, dtype=float)
+    hist, _ = _np.histogram(ts, bins)
+    return {
+        "hist": hist.astype(_np.int64),
+        "bins": bins,
+        "tail": _topk(ts, topk),
+        "nzeros": int(nzeros),
+        "ntrials": int(ntrials),
+        "noverflow": int(_np.sum(ts > bins[-1])),
+        }
+
+
+def merge_ts_summaries(summaries, topk=TOPK):
+    """
+    Merge trial summaries by adding histograms and counts. The merged tail
+    holds the ``topk`` largest values of all input tails, which are exactly the
+    overall ``topk`` largest values if each input kept at least ``topk``.
+
+    Parameters
+    ----------
+    summaries : list of dicts
+        Summaries as returned by ``make_ts_summary``, all with the same bins.
+    topk : int, optional
+        How many of the largest ``ts`` values are kept. (default: ``TOPK``)
+
+    Returns
+    -------
+    summary : dict
+        Merged summary with the same structure as the inputs.
+    """
+    summaries = list(summaries)
+    if len(summaries) == 0:
+        raise ValueError("Need at least one summary to merge.")
+    bins = _np.asarray(summaries[0]["bins"])
+    merged = {"hist": _np.zeros(len(bins) - 1, dtype=_np.int64),
+              "bins": bins}
+    merged.update({key: 0 for key in SUMMARY_COUNTS})
+    tails = []
+    for sam in summaries:
+        if not _np.array_equal(sam["bins"], bins):
+            raise ValueError("Can only merge summaries with equal binning.")
+        merged["hist"] += sam["hist"]
+        for key in SUMMARY_COUNTS:
+            merged[key] += int(sam[key])
+        tails.append(sam["tail"])
+    merged["tail"] = _topk(_np.concatenate(tails), topk)
+    return merged
+
+
+def ts_summary_to_dist(summary):
+    """
+    Build a background distribution directly from a summary, without
+    expanding the histogram to single trials. Each non-empty histogram bin is
+    one entry at its bin center, weighted by its count, the exact tail values
+    are entries with unit weight.
+
+    Parameters
+    ----------
+    summary : dict
+        Summary as returned by ``make_ts_summary`` or ``merge_ts_summaries``.
+
+    Returns
+    -------
+    dist : ``WeightedEmpWithExpTailDist``
+        Distribution of all trials, including the zero trials.
+    exact_above : float
+        Smallest exactly stored ``ts`` value. Above it, the distribution is
+        built from exact values only, below it the values are resolved to the
+        bin width only. ``0`` if all non-zero values are stored exactly.
+    """
+    bins = _np.asarray(summary["bins"], dtype=float)
+    tail = _np.asarray(summary["tail"], dtype=float)
+    # Values above the binning are only available if they are in the tail
+    if _np.sum(tail > bins[-1]) != summary["noverflow"]:
+        raise ValueError("Summary has more values above the last bin edge " +
+                         "than stored exactly in the tail. Use a larger " +
+                         "binning range or larger `topk`.")
+    # Remove exact tail values from the histogram to not count them twice
+    tail_hist, _ = _np.histogram(tail, bins)
+    bulk = summary["hist"] - tail_hist
+    nbulk = int(_np.sum(bulk))
+    exact_above = 0. if nbulk == 0 or len(tail) == 0 else tail[-1]
+    # Keep the bulk entries below the exact tail, the bin holding the
+    # smallest tail value may have its center above it
+    mids = 0.5 * (bins[:-1] + bins[1:])
+    if len(tail) > 0:
+        mids = _np.minimum(mids, tail[-1])
+    m = bulk > 0
+    # A bin entry stands for `count` unit weight trials, so its summed
+    # squared weights are `count` too
+    counts = bulk[m].astype(float)
+    data = _np.concatenate([mids[m], tail])
+    weights = _np.concatenate([counts, _np.ones(len(tail))])
+    dist = WeightedEmpWithExpTailDist(data, weights, summary["nzeros"],
+                                      wsq=weights.copy())
+    return dist, exact_above
+
+
+def _topk(x, k):
+    """ Largest ``k`` values of ``x`` sorted descending """
+    x = _np.asarray(x, dtype=float)
+    if len(x) > k:
+        x = _np.partition(x, len(x) - k)[len(x) - k:]
+    return _np.sort(x)[::-1]
+
+
+class WeightedEmpWithExpTailDist(object):
+    """
+    Background test statistic distribution from weighted trials. Below the
+    threshold the weighted empirical distribution is used, above it an
+    exponential tail fitted to the weighted trials, normalized to the
+    weighted empirical tail fraction.
+
+    Implements the methods of ``tdepps.utils.stats.emp_with_exp_tail_dist``
+    used in the analysis scripts and plots.
+
+    Parameters
+    ----------
+    data : array-like
+        Non-zero test statistic values.
+    weights : array-like
+        Trial weights, same length as ``data``.
+    wzeros : float
+        Summed weights of all trials with ``ts = 0``.
+    thresh : float or None, optional
+        Threshold above which the exponential tail is used. If ``None``, the
+        largest ``data`` value is used, so the distribution is purely
+        empirical. (default: ``None``)
+    wsq : array-like or None, optional
+        Summed squared trial weights per entry, if an entry stands for
+        multiple trials at the same value, as for histogram bins. If ``None``,
+        each entry is a single trial and ``weights**2`` is used.
+        (default: ``None``)
+    """
+    def __init__(self, data, weights, wzeros, thresh=None, wsq=None):
+        data = _np.asarray(data, dtype=float)
+        weights = _np.asarray(weights, dtype=float)
+        if data.shape != weights.shape:
+            raise ValueError("`data` and `weights` must have the same shape.")
+        if wsq is not None:
+            wsq = _np.asarray(wsq, dtype=float)
+            if wsq.shape != weights.shape:
+                raise ValueError("`wsq` and `weights` must have the same " +
+                                 "shape.")
+        srt = _np.argsort(data)
+        self._data = data[srt]
+        self._weights = weights[srt]
+        self._wsq = None if wsq is None else wsq[srt]
+        self._wzeros = float(wzeros)
+        self._wtot = self._wzeros + _np.sum(self._weights)
+        # Summed weights of all trials with larger ts, for each data point
+        self._wsf = _np.r_[_np.cumsum(self._weights[::-1])[::-1][1:], 0.]
+        self.fit_tail(_np.amax(self._data) if thresh is None else thresh)
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def weights(self):
+        return self._weights
+
+    @property
+    def wzeros(self):
+        return self._wzeros
+
+    @property
+    def wsq(self):
+        """ Summed squared trial weights per entry """
+        return self._weights**2 if self._wsq is None else self._wsq
+
+    @property
+    def thresh(self):
+        return self._thresh
+
+    @property
+    def scale(self):
+        return self._scale
+
+    def n_eff(self, thresh=0.):
+        """ Effective number of trials above ``thresh`` """
+        m = self._data > thresh
+        w = self._weights[m]
+        return _np.sum(w)**2 / _np.sum(self.wsq[m]) if len(w) > 0 else 0.
+
+    def fit_tail(self, thresh):
+        """
+        Set the threshold and fit the exponential tail scale with the weighted
+        maximum likelihood estimate to all trials above it.
+
+        Parameters
+        ----------
+        thresh : float
+            New threshold.
+
+        Returns
+        -------
+        scale : float
+            Fitted scale of the exponential tail.
+        """
+        m = self._data > thresh
+        if not _np.any(m):
+            # No data above, the tail is never used
+            self._thresh, self._scale = float(thresh), 1.
+            return self._scale
+        w = self._weights[m]
+        self._thresh = float(thresh)
+        self._scale = _np.sum(w * (self._data[m] - thresh)) / _np.sum(w)
+        return self._scale
+
+    def emp_sf(self, x):
+        """ Weighted empirical survival function """
+        x = _np.atleast_1d(x).astype(float)
+        idx = _np.searchsorted(self._data, x, side="right")
+        wsf = _np.r_[_np.sum(self._weights), self._wsf][idx]
+        return _np.where(x < 0, 1., wsf / self._wtot)
+
+    def emp_ppf(self, q):
+        """ Weighted empirical percentiles, ``q`` in percent """
+        q = _np.atleast_1d(q) / 100.
+        # Cumulative weight fraction up to and including each data point
+        cdf = 1. - self._wsf / self._wtot
+        idx = _np.searchsorted(cdf, q, side="left")
+        vals = self._data[_np.clip(idx, 0, len(self._data) - 1)]
+        return _np.where(q <= self._wzeros / self._wtot, 0., vals)
+
+    def sf(self, x):
+        """ Survival function, exponential above the threshold """
+        x = _np.atleast_1d(x).astype(float)
+        sf = self.emp_sf(x)
+        m = x > self._thresh
+        sf[m] = self.emp_sf(self._thresh) * _np.exp(
+            -(x[m] - self._thresh) / self._scale)
+        return sf
+
+    def cdf(self, x):
+        """ Cumulative distribution function """
+        return 1. - self.sf(x)
+
+    def pdf(self, x):
+        """ PDF of the exponential tail, zero below the threshold """
+        x = _np.atleast_1d(x).astype(float)
+        pdf = _np.zeros_like(x)
+        m = x > self._thresh
+        pdf[m] = (self.emp_sf(self._thresh) / self._scale *
+                  _np.exp(-(x[m] - self._thresh) / self._scale))
+        return pdf
+
+    def ppf(self, q):
+        """ Percent point function, ``q`` in percent """
+        q = _np.atleast_1d(q).astype(float)
+        ppf = self.emp_ppf(q)
+        sf_thresh = self.emp_sf(self._thresh)
+        m = 1. - q / 100. < sf_thresh
+        ppf[m] = self._thresh - self._scale * _np.log(
+            (1. - q[m] / 100.) / sf_thresh)
+        return ppf
+
+    def data_hist(self, dx, density=False, which="all"):
+        """
+        Weighted histogram of the data.
+
+        Parameters
+        ----------
+        dx : float
+            Bin width.
+        density : bool, optional
+            If ``True``, normalize to a PDF of all trials, including zeros.
+            (default: ``False``)
+        which : str, optional
+            Use ``'emp'`` data below, ``'exp'`` data above the threshold or
+            ``'all'``. (default: ``'all'``)
+
+        Returns
+        -------
+        h, b, err : array-like
+            Weighted counts, bin edges and statistical errors.
+        n : array-like
+            Number of entries per bin.
+        """
+        if which == "emp":
+            m = self._data <= self._thresh
+        elif which == "exp":
+            m = self._data > self._thresh
+        else:
+            m = _np.ones(len(self._data), dtype=bool)
+        data, w, w2 = self._data[m], self._weights[m], self.wsq[m]
+        lo = _np.floor(data.min() / dx) * dx if len(data) > 0 else 0.
+        hi = _np.ceil(data.max() / dx) * dx if len(data) > 0 else dx
+        b = _np.arange(lo, hi + dx, dx)
+        h, _ = _np.histogram(data, b, weights=w)
+        err, _ = _np.histogram(data, b, weights=w2)
+        n, _ = _np.histogram(data, b)
+        err = _np.sqrt(err)
+        if density:
+            h, err = h / self._wtot / dx, err / self._wtot / dx
+        return h, b, err, n
+
+    def to_json(self, fp, dtype=_np.float64, **json_args):
+        """
+        Write the distribution to a JSON file. Only the data is converted to
+        ``dtype``, weights are always stored in full precision.
+
+        Parameters
+        ----------
+        fp : file object
+            Open file to write to.
+        dtype : numpy dtype, optional
+            Data type for the stored data. (default: ``np.float64``)
+        json_args
+            Passed to ``json.dump``.
+        """
+        out = {"data": self._data.astype(dtype).tolist(),
+               "weights": self._weights.tolist(),
+               "wzeros": self._wzeros,
+               "thresh": self._thresh}
+        if self._wsq is not None:
+            out["wsq"] = self._wsq.tolist()
+        _json.dump(out, fp=fp, **json_args)
+
+    @classmethod
+    def from_json(cls, fp):
+        """ Load a distribution written with ``to_json`` """
+        return cls.from_dict(_json.load(fp))
+
+    @classmethod
+    def from_dict(cls, d):
+        """ Build a distribution from an already parsed ``to_json`` dict """
+        return cls(d["data"], d["weights"], d["wzeros"], thresh=d["thresh"],
+                   wsq=d.get("wsq", None))
+
+
+def scan_best_weighted_thresh(dist, thresh_vals, pval_thresh=0.5):
+    """
+    Scan tail thresholds for a ``WeightedEmpWithExpTailDist`` like
+    ``tdepps.utils.stats.scan_best_thresh``. For each threshold the tail is
+    fitted and compared to the weighted trials above it with a KS test, using
+    the effective number of trials ``(sum w)**2 / sum w**2``. The best
+    threshold is set to ``dist``.
+
+    Parameters
+    ----------
+    dist : ``WeightedEmpWithExpTailDist`` instance
+        Distribution to scan.
+    thresh_vals : array-like
+        Thresholds to test.
+    pval_thresh : float, optional
+        The first threshold with a KS p-value larger than this is the best fit.
+        If none passes, the one with the largest p-value is used.
+        (default: 0.5)
+
+    Returns
+    -------
+    best_thresh : float
+        Best threshold.
+    best_idx : int
+        Index of the best threshold in ``thresh_vals``.
+    pvals : array-like
+        KS test p-values per threshold.
+    scales : array-like
+        Fitted scales per threshold.
+    """
+    from scipy.stats import kstwobign
+
+    thresh_vals = _np.atleast_1d(thresh_vals)
+    pvals = _np.zeros(len(thresh_vals), dtype=float)
+    scales = _np.zeros(len(thresh_vals), dtype=float)
+    for i, thresh in enumerate(thresh_vals):
+        scales[i] = dist.fit_tail(thresh)
+        m = dist.data > thresh
+        if _np.sum(m) < 2:
+            continue
+        x, w = dist.data[m], dist.weights[m]
+        ecdf = _np.cumsum(w) / _np.sum(w)
+        cdf = 1. - _np.exp(-(x - thresh) / scales[i])
+        # KS distance at both sides of each step of the weighted ECDF
+        ks = max(_np.amax(_np.abs(ecdf - cdf)),
+                 _np.amax(_np.abs(_np.r_[0., ecdf[:-1]] - cdf)))
+        pvals[i] = kstwobign.sf(ks * _np.sqrt(dist.n_eff(thresh)))
+
+    passed = _np.flatnonzero(pvals > pval_thresh)
+    best_idx = passed[0] if len(passed) > 0 else int(_np.argmax(pvals))
+    best_thresh = thresh_vals[best_idx]
+    dist.fit_tail(best_thresh)
+    return best_thresh, best_idx, pvals, scales
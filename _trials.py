@@ -0,0 +1,1257 @@
+# coding: utf-8
+
+"""
+Vectorized trial helpers working on the fitted tdepps injectors and LLHs.
+
+The stacked LLH ratio used here is, with the per event signal over background
+ratio ``sob_i`` summed over all sources of all samples,
+
+    ln Lambda(ns) = -ns + sum_i ln(1 + ns * sob_i)
+
+and the test statistic is ``ts = 2 * ln Lambda(ns_best)``, with ``ns >= 0``.
+The per event ratios are
+
+    sob_i = sum_k w_k / nb_k * S_ik / B_ik
+
+with normalized source weights ``w_k`` over all sources of all samples, the
+expected background ``nb_k`` in each source's time window and the signal and
+background PDF ratio ``S_ik / B_ik`` of event ``i`` for source ``k``.
+
+Like ``GRBLLH``, events with a ratio below the ``sob_abs_eps`` and
+``sob_rel_eps`` thresholds of the sample's LLH options are dropped, see
+``sob_thresholds``.
+
+All tdepps internals used are collected in ``_model_soverb``,
+``_model_src_weights`` and ``_llh_sob_eps``. Batched injection presets the
+event counts of the injectors, see ``sample_batch``. Use
+``check_batched_trials`` to compare against the minimizer of
+``tdepps.grb.MultiGRBLLH`` when these change.
+"""
+
+from __future__ import print_function, division
+
+from copy import deepcopy as _deepcopy
+import numpy as _np
+
+
+def _src_soverb(llh, X):
+    """
+    Signal over background PDF ratio for each source and event.
+
+    Parameters
+    ----------
+    llh : ``tdepps.grb.GRBLLH``
+        LLH with fitted ``GRBModel`` for a single sample.
+    X : record-array
+        Events for the sample.
+
+    Returns
+    -------
+    sob : array-like, shape (nsrcs, nevts)
+        ``S_ik / B_ik`` for each source ``k`` and event ``i``. Zero for events
+        outside a source's time window or spatial band.
+    """
+    return _model_soverb(llh.model, X)
+
+
+def _model_soverb(model, X):
+    """ ``_src_soverb`` for a ``GRBModel`` instead of the ``GRBLLH`` """
+    return _np.atleast_2d(model.get_soverb(X, band_select=False))
+
+
+def _src_weights(llh):
+    """
+    Unnormalized source weights and expected background counts.
+
+    Parameters
+    ----------
+    llh : ``tdepps.grb.GRBLLH``
+        LLH with fitted ``GRBModel`` for a single sample.
+
+    Returns
+    -------
+    src_w : array-like, shape (nsrcs,)
+        Declination times theoretical source weights.
+    nb : array-like, shape (nsrcs,)
+        Expected background events in each source's time window.
+    """
+    return _model_src_weights(llh.model)
+
+
+def _model_src_weights(model):
+    """ ``_src_weights`` for a ``GRBModel`` instead of the ``GRBLLH`` """
+    args = model.llh_args
+    src_w = _np.asarray(args["src_w_dec"]) * _np.asarray(args["src_w_theo"])
+    return src_w, _np.asarray(args["nb"], dtype=float)
+
+
+def _llh_sob_eps(llh):
+    """ Absolute and relative ``sob`` thresholds of a ``GRBLLH`` """
+    opts = llh.llh_opts
+    return float(opts["sob_abs_eps"]), float(opts["sob_rel_eps"])
+
+
+def src_coefficients(llhs):
+    """
+    Per source factors ``w_k / nb_k`` with source weights normalized over all
+    samples.
+
+    Parameters
+    ----------
+    llhs : dict
+        Sample names as keys, fitted ``tdepps.grb.GRBLLH`` as values.
+
+    Returns
+    -------
+    coeffs : dict
+        Sample names as keys, arrays with ``w_k / nb_k`` as values.
+    """
+    weights = {key: _src_weights(llh) for key, llh in llhs.items()}
+    w_tot = sum(_np.sum(src_w) for src_w, _ in weights.values())
+    return {key: src_w / w_tot / nb for key, (src_w, nb) in weights.items()}
+
+
+def sob_thresholds(llhs):
+    """
+    Per sample thresholds on the stacked ``sob_i`` equivalent to the cuts of
+    each ``GRBLLH``. A ``GRBLLH`` cuts on its own ratio, with the source
+    weights normalized within the sample, which is ``sob_i / f`` with the
+    sample's share ``f`` of the source weights over all samples.
+
+    Parameters
+    ----------
+    llhs : dict
+        Sample names as keys, fitted ``tdepps.grb.GRBLLH`` as values.
+
+    Returns
+    -------
+    cuts : dict
+        Sample names as keys, tuples ``(abs_thresh, rel_eps)`` as values.
+        Events with ``sob_i < abs_thresh`` or ``sob_i < rel_eps * max(sob)``
+        in their trial are dropped.
+    """
+    weights = {key: _np.sum(_src_weights(llh)[0]) for key, llh in llhs.items()}
+    w_tot = sum(weights.values())
+    cuts = {}
+    for key, llh in llhs.items():
+        abs_eps, rel_eps = _llh_sob_eps(llh)
+        cuts[key] = (abs_eps * weights[key] / w_tot, rel_eps)
+    return cuts
+
+
+def cut_soverb(sob, trial_idx, ntrials, abs_thresh, rel_eps):
+    """
+    Set ``sob_i`` below the thresholds to zero, so the events don't contribute
+    to the LLH, as if they were dropped.
+
+    Parameters
+    ----------
+    sob : array-like, shape (nevts,) or (nevts, nwins)
+        Stacked ratios of the events of one sample, optionally per window.
+    trial_idx : array-like, shape (nevts,)
+        Trial index in ``[0, ntrials)`` for each event.
+    ntrials : int
+        Number of trials.
+    abs_thresh : float or array-like, shape (nwins,)
+        Absolute threshold, per window for 2D ``sob``.
+    rel_eps : float
+        Threshold relative to the largest ratio in the event's trial.
+
+    Returns
+    -------
+    sob : array-like
+        Ratios with the cut events set to zero.
+    """
+    cut = sob < abs_thresh
+    if rel_eps > 0 and len(sob) > 0:
+        smax = _np.zeros((ntrials,) + sob.shape[1:], dtype=float)
+        _np.maximum.at(smax, trial_idx, sob)
+        cut |= sob < rel_eps * smax[trial_idx]
+    return _np.where(cut, 0., sob)
+
+
+def stacked_soverb(llhs, X, coeffs=None, trial_idx=None, cuts=None):
+    """
+    Per event stacked signal over background ratios for all samples, with the
+    ``GRBLLH`` thresholds applied.
+
+    Parameters
+    ----------
+    llhs : dict
+        Sample names as keys, fitted ``tdepps.grb.GRBLLH`` as values.
+    X : dict
+        Sample names as keys, event record arrays as values.
+    coeffs : dict or None, optional
+        Precomputed output of ``src_coefficients(llhs)``. (default: ``None``)
+    trial_idx : dict or None, optional
+        Sample names as keys, trial index of each event as values, needed for
+        the relative threshold. If ``None``, ``X`` is a single trial.
+        (default: ``None``)
+    cuts : dict or None, optional
+        Precomputed output of ``sob_thresholds(llhs)``. (default: ``None``)
+
+    Returns
+    -------
+    sob : dict
+        Sample names as keys, arrays of ``sob_i`` for each event in ``X`` as
+        values. Cut events have ``sob_i = 0``.
+    """
+    if coeffs is None:
+        coeffs = src_coefficients(llhs)
+    if cuts is None:
+        cuts = sob_thresholds(llhs)
+    if trial_idx is None:
+        trial_idx = {key: _np.zeros(len(X[key]), dtype=int) for key in llhs}
+    ntrials = 1 + max([_np.amax(idx) for idx in trial_idx.values()
+                       if len(idx) > 0] or [0])
+    sob = {}
+    for key, llh in llhs.items():
+        if len(X[key]) == 0:
+            sob[key] = _np.zeros(0, dtype=float)
+        else:
+            sob[key] = cut_soverb(
+                _np.dot(coeffs[key], _src_soverb(llh, X[key])),
+                trial_idx[key], ntrials, *cuts[key])
+    return sob
+
+
+def fit_ns_batch(sob, trial_idx, ntrials, tol=1e-10, maxiter=100, grad0=None):
+    """
+    Fit ``ns`` for many trials at once. Events of all trials are given as a
+    single flat array together with the trial each event belongs to.
+
+    ``ln Lambda`` is concave in ``ns``, so the best fit is ``ns = 0`` exactly
+    if the gradient at zero, ``-1 + sum_i sob_i``, is not positive. Otherwise
+    the single root of the gradient in ``(0, nevts]`` is found with a Newton
+    iteration, safeguarded by bisection, for all trials simultaneously.
+
+    Parameters
+    ----------
+    sob : array-like, shape (nevts,)
+        Stacked signal over background ratios of all events of all trials.
+    trial_idx : array-like, shape (nevts,)
+        Trial index in ``[0, ntrials)`` for each event.
+    ntrials : int
+        Number of trials.
+    tol : float, optional
+        Absolute tolerance on ``ns``. (default: 1e-10)
+    maxiter : int, optional
+        Maximum number of iterations. (default: 100)
+    grad0 : array-like, shape (ntrials,) or None, optional
+        Precomputed output of ``grad_at_zero``. (default: ``None``)
+
+    Returns
+    -------
+    ns, ts : array-like, shape (ntrials,)
+        Best fit ``ns`` and test statistic per trial.
+    """
+    sob = _np.asarray(sob, dtype=float)
+    trial_idx = _np.asarray(trial_idx, dtype=int)
+    ns = _np.zeros(ntrials, dtype=float)
+    ts = _np.zeros(ntrials, dtype=float)
+
+    if grad0 is None:
+        grad0 = grad_at_zero(sob, trial_idx, ntrials)
+    fit = grad0 > 0
+    if not _np.any(fit):
+        return ns, ts
+
+    # Only work with events of trials that need a fit, relabel the trials
+    m = fit[trial_idx]
+    sob, trial_idx = sob[m], trial_idx[m]
+    fit_idx = _np.flatnonzero(fit)
+    trial_idx = _np.searchsorted(fit_idx, trial_idx)
+    nfit = len(fit_idx)
+
+    # Gradient is positive at lo and negative at hi, root is inside
+    lo = _np.zeros(nfit, dtype=float)
+    hi = _np.bincount(trial_idx, minlength=nfit).astype(float)
+    x = 0.5 * hi
+    for _ in range(maxiter):
+        xi = x[trial_idx]
+        q = sob / (1. + xi * sob)
+        grad = _np.bincount(trial_idx, weights=q, minlength=nfit) - 1.
+        hess = -_np.bincount(trial_idx, weights=q**2, minlength=nfit)
+        lo = _np.where(grad > 0, x, lo)
+        hi = _np.where(grad > 0, hi, x)
+        # Newton step, fall back to bisection if it leaves the bracket
+        with _np.errstate(divide="ignore", invalid="ignore"):
+            x_new = x - grad / hess
+        bad = ~((x_new > lo) & (x_new < hi))
+        x_new[bad] = 0.5 * (lo[bad] + hi[bad])
+        converged = _np.all(_np.abs(x_new - x) < tol)
+        x = x_new
+        if converged:
+            break
+
+    ns[fit_idx] = x
+    lnllh = _np.bincount(trial_idx, weights=_np.log1p(x[trial_idx] * sob),
+                         minlength=nfit) - x
+    ts[fit_idx] = 2. * _np.maximum(lnllh, 0.)
+    return ns, ts
+
+
+def grad_at_zero(sob, trial_idx, ntrials):
+    """
+    Gradient ``d ln Lambda / d ns`` at ``ns = 0`` for each trial. Because
+    ``ln Lambda`` is concave in ``ns``, the best fit is ``ns = 0`` and
+    ``ts = 0`` exactly, if the gradient at zero is not positive.
+
+    Parameters
+    ----------
+    sob : array-like, shape (nevts,)
+        Stacked signal over background ratios of all events of all trials.
+    trial_idx : array-like, shape (nevts,)
+        Trial index in ``[0, ntrials)`` for each event.
+    ntrials : int
+        Number of trials.
+
+    Returns
+    -------
+    grad : array-like, shape (ntrials,)
+        ``-1 + sum_i sob_i`` for each trial.
+    """
+    return _np.bincount(trial_idx, weights=sob, minlength=ntrials) - 1.
+
+
+def sample_batch(bg_injs, ntrials):
+    """
+    Draw ``ntrials`` background pseudo experiments and concatenate them to one
+    flat event array per sample.
+
+    The event counts per source of all trials are drawn in bulk and their sum
+    is injected with a single ``sample`` call per sample, see
+    ``_sample_counts``. On first use, the injectors' random states are
+    replaced by ``PresetPoissonState`` objects seeded from them.
+
+    Parameters
+    ----------
+    bg_injs : dict
+        Sample names as keys, fitted background injectors as values.
+    ntrials : int
+        Number of pseudo experiments.
+
+    Returns
+    -------
+    X : dict
+        Sample names as keys, concatenated event record arrays as values,
+        grouped by trial.
+    trial_idx : dict
+        Sample names as keys, arrays with the trial index of each event as
+        values.
+    """
+    X, trial_idx = {}, {}
+    for key, state in _preset_states(bg_injs).items():
+        lam = state.last_lam
+        counts = state.poisson(lam, size=(ntrials,) + lam.shape)
+        X[key], trial_idx[key] = _sample_counts(bg_injs[key], state, counts)
+    return X, trial_idx
+
+
+def sample_probe(bg_injs, ntrials, seed=0):
+    """
+    Draw ``ntrials`` background pseudo experiments with a separate random
+    state, eg. to measure per window factors. The injectors' random states are
+    restored afterwards, so the trial stream is unchanged. With the fixed
+    ``seed``, all jobs get the same probe.
+
+    Parameters
+    ----------
+    bg_injs : dict
+        Sample names as keys, fitted background injectors as values.
+    ntrials : int
+        Number of pseudo experiments.
+    seed : int, optional
+        Seed of the probe random state. (default: 0)
+
+    Returns
+    -------
+    X : dict
+        Sample names as keys, concatenated event record arrays as values.
+    """
+    rndgen = _np.random.RandomState(seed)
+    X = {}
+    for key in sorted(bg_injs.keys()):
+        inj = bg_injs[key]
+        rndgen_orig, inj.rndgen = inj.rndgen, rndgen
+        try:
+            X[key] = _np.concatenate([inj.sample() for _ in range(ntrials)])
+        finally:
+            inj.rndgen = rndgen_orig
+    return X
+
+
+def _preset_states(bg_injs):
+    """
+    ``PresetPoissonState`` of each injector. Injectors without one get it
+    installed, seeded from their current random state, and are probed once
+    for their Poisson means.
+    """
+    for key in sorted(bg_injs.keys()):
+        if not isinstance(bg_injs[key].rndgen, PresetPoissonState):
+            _probe_poisson_means({key: bg_injs[key]}, bg_injs[key].rndgen)
+    return {key: inj.rndgen for key, inj in bg_injs.items()}
+
+
+def _sample_counts(inj, state, counts):
+    """
+    Inject the events of many trials with a single ``sample`` call.
+
+    The summed ``counts`` per source are preset and injected at once. This
+    requires the injector to return the events of each source as one block,
+    in source order. Events within a block are independent, so they are
+    assigned to the trials in order.
+
+    Parameters
+    ----------
+    inj : background injector
+        Injector using ``state`` as random state.
+    state : ``PresetPoissonState``
+        Random state of ``inj``.
+    counts : array-like, shape (ntrials, ...)
+        Event counts per trial, with the shape of the Poisson means for each
+        trial.
+
+    Returns
+    -------
+    X : record-array
+        Events of all trials, grouped by trial.
+    trial_idx : array-like
+        Trial index of each event.
+    """
+    counts = _np.asarray(counts)
+    ntrials = len(counts)
+    state.preset_poisson(counts.sum(axis=0))
+    X = inj.sample()
+    per_src = counts.reshape(ntrials, -1)
+    if len(X) != _np.sum(per_src):
+        raise RuntimeError("Injector didn't return the preset number of " +
+                           "events, can't batch the injection.")
+    trial_idx = _np.repeat(_np.tile(_np.arange(ntrials), per_src.shape[1]),
+                           per_src.T.ravel())
+    srt = _np.argsort(trial_idx, kind="mergesort")
+    return X[srt], trial_idx[srt]
+
+
+def do_batched_trials(bg_injs, llhs, n_trials, batch_size=10000):
+    """
+    Background trials with batched injection and vectorized ``ns`` fits.
+    Output is the same as from ``GRBLLHAnalysis.do_trials`` without signal.
+
+    Parameters
+    ----------
+    bg_injs : dict
+        Sample names as keys, fitted background injectors as values.
+    llhs : dict
+        Sample names as keys, fitted ``tdepps.grb.GRBLLH`` as values.
+    n_trials : int
+        Number of trials.
+    batch_size : int, optional
+        Trials injected and fitted at once. (default: 10000)
+
+    Returns
+    -------
+    trials : record-array
+        Names ``'ns', 'ts'`` for all trials with ``ts > 0``.
+    nzeros : int
+        Number of trials with ``ts = 0``.
+    nskipped : int
+        Number of trials decided by the gradient at zero without iterating.
+    """
+    coeffs = src_coefficients(llhs)
+    cuts = sob_thresholds(llhs)
+    ns, ts = [], []
+    nzeros, nskipped = 0, 0
+    ndone = 0
+    while ndone < n_trials:
+        nbatch = min(batch_size, n_trials - ndone)
+        X, trial_idx = sample_batch(bg_injs, nbatch)
+        sob = stacked_soverb(llhs, X, coeffs, trial_idx=trial_idx, cuts=cuts)
+        keys = sorted(sob.keys())
+        sob = _np.concatenate([sob[key] for key in keys])
+        trial_idx = _np.concatenate([trial_idx[key] for key in keys])
+        grad0 = grad_at_zero(sob, trial_idx, nbatch)
+        nskipped += int(_np.sum(grad0 <= 0))
+        ns_i, ts_i = fit_ns_batch(sob, trial_idx, nbatch, grad0=grad0)
+        nonzero = ts_i > 0
+        nzeros += int(nbatch - _np.sum(nonzero))
+        ns.append(ns_i[nonzero])
+        ts.append(ts_i[nonzero])
+        ndone += nbatch
+
+    print("Gradient at zero decided {} / {} trials without fit.".format(
+        nskipped, n_trials))
+    return _make_trials(ns, ts), nzeros, nskipped
+
+
+def do_grad_shortcut_trials(multi_llh, bg_injs, llhs, n_trials, ns0=0.1):
+    """
+    Background trials with the ``MultiGRBLLH`` minimizer, which is only called
+    if the gradient at ``ns = 0`` is positive. Otherwise the trial is booked as
+    ``ns = ts = 0`` directly, which is the exact best fit in this case.
+
+    Parameters
+    ----------
+    multi_llh : ``tdepps.grb.MultiGRBLLH``
+        Fitted multi LLH built from ``llhs``.
+    bg_injs : dict
+        Sample names as keys, fitted background injectors as values.
+    llhs : dict
+        Sample names as keys, fitted ``tdepps.grb.GRBLLH`` as values.
+    n_trials : int
+        Number of trials.
+    ns0 : float, optional
+        Minimizer seed. (default: 0.1)
+
+    Returns
+    -------
+    trials : record-array
+        Names ``'ns', 'ts'`` for all trials with ``ts > 0``.
+    nzeros : int
+        Number of trials with ``ts = 0``.
+    nskipped : int
+        Number of trials for which the minimizer was skipped.
+    """
+    coeffs = src_coefficients(llhs)
+    cuts = sob_thresholds(llhs)
+    ns, ts = [], []
+    nzeros, nskipped = 0, 0
+    for _ in range(n_trials):
+        X = {key: inj.sample() for key, inj in bg_injs.items()}
+        # Events dropped by the LLH cuts have zero ratios and don't count
+        sob = stacked_soverb(llhs, X, coeffs, cuts=cuts)
+        if sum(_np.sum(sob_i) for sob_i in sob.values()) <= 1.:
+            nzeros += 1
+            nskipped += 1
+            continue
+        ns_i, ts_i = multi_llh.fit_lnllh_ratio(X, ns0=ns0)
+        if ts_i > 0:
+            ns.append(ns_i)
+            ts.append(ts_i)
+        else:
+            nzeros += 1
+
+    print("Skipped the minimizer in {} / {} trials.".format(
+        nskipped, n_trials))
+    return _make_trials([ns], [ts]), nzeros, nskipped
+
+
+class PresetPoissonState(_np.random.RandomState):
+    """
+    Random state that returns preset values for the next ``poisson`` call
+    instead of drawing them. All other draws are unchanged.
+
+    Given to a background injector, this injects events with counts drawn in
+    bulk beforehand, while positions, times and energies are still sampled by
+    the injector itself. The last requested Poisson means are stored in
+    ``last_lam``.
+    """
+    def __init__(self, seed=None):
+        super(PresetPoissonState, self).__init__(seed)
+        self._preset = None
+        self.last_lam = None
+
+    def preset_poisson(self, counts):
+        """ Use ``counts`` as the result of the next ``poisson`` call """
+        self._preset = _np.asarray(counts)
+
+    def poisson(self, lam=1.0, size=None):
+        self.last_lam = _np.array(lam, dtype=float, copy=True)
+        if self._preset is None:
+            return super(PresetPoissonState, self).poisson(lam, size)
+        counts, self._preset = self._preset, None
+        if counts.shape != _np.broadcast(lam, _np.empty(size or ())).shape:
+            raise ValueError("Preset counts don't match the requested shape.")
+        return counts
+
+
+def do_empty_fastpath_trials(bg_injs, llhs, n_trials, rndgen,
+                             batch_size=10000):
+    """
+    Background trials, where the number of injected events per sample and
+    source is drawn for all trials in bulk first. Trials without any events
+    are ``ts = 0`` trials and are booked directly. Only the remaining trials
+    are injected, with the drawn counts, and fitted with ``fit_ns_batch``.
+    For the short time windows nearly all trials are empty.
+
+    The injectors' random states are replaced by ``PresetPoissonState``
+    objects continuing the stream of ``rndgen``, which requires the injectors
+    to draw their event counts with a single ``rndgen.poisson`` call per
+    sample.
+
+    Parameters
+    ----------
+    bg_injs : dict
+        Sample names as keys, fitted background injectors as values.
+    llhs : dict
+        Sample names as keys, fitted ``tdepps.grb.GRBLLH`` as values.
+    n_trials : int
+        Number of trials.
+    rndgen : ``np.random.RandomState`` instance
+        Random state used to draw the counts and seed the injectors.
+    batch_size : int, optional
+        Trials drawn and fitted at once. (default: 10000)
+
+    Returns
+    -------
+    trials : record-array
+        Names ``'ns', 'ts'`` for all trials with ``ts > 0``.
+    nzeros : int
+        Number of trials with ``ts = 0``.
+    nempty : int
+        Number of trials without any injected event.
+    """
+    keys = sorted(bg_injs.keys())
+    states, lams = _probe_poisson_means(bg_injs, rndgen)
+    coeffs = src_coefficients(llhs)
+    ns, ts = [_np.empty(0)], [_np.empty(0)]
+    nzeros, nempty = 0, 0
+    ndone = 0
+    while ndone < n_trials:
+        nbatch = min(batch_size, n_trials - ndone)
+        counts = {key: rndgen.poisson(lams[key], size=(nbatch,) +
+                                      lams[key].shape) for key in keys}
+        filled = _np.flatnonzero(_total_counts(counts, nbatch) > 0)
+        nempty += nbatch - len(filled)
+        nzeros += nbatch - len(filled)
+        ndone += nbatch
+        if len(filled) == 0:
+            continue
+
+        # Inject the remaining trials with the drawn counts and fit them all
+        ns_i, ts_i = _fit_counts(bg_injs, llhs, states, counts, filled, coeffs)
+        nonzero = ts_i > 0
+        nzeros += int(len(filled) - _np.sum(nonzero))
+        ns.append(ns_i[nonzero])
+        ts.append(ts_i[nonzero])
+
+    print("Booked {} / {} empty trials without injection.".format(
+        nempty, n_trials))
+    return _make_trials(ns, ts), nzeros, nempty
+
+
+def do_biased_trials(bg_injs, llhs, n_trials, rndgen, bias,
+                     batch_size=10000):
+    """
+    Importance sampled background trials. The event counts of all sources are
+    drawn from Poissons with the expected background scaled by ``bias > 1``,
+    which oversamples upward fluctuations producing large ``ts`` values. Each
+    trial carries the likelihood ratio of the true and the biased count
+    distribution as weight
+
+        w = exp((bias - 1) * sum_k nb_k) * bias**(-N)
+
+    with the total number of injected events ``N``. Event positions, times
+    and energies are sampled by the injectors as usual, given the counts.
+    The sum of all weights is ``n_trials`` on average, weighted tail
+    fractions are unbiased estimates of the true background p-values.
+
+    The weights are drawn for the total count over all sources, so their
+    variance grows exponentially with the total expected background
+    ``nb_tot = sum_k nb_k``. The effective number of trials is
+
+        n_eff = n_trials * exp(-nb_tot * (bias - 1)**2 / bias)
+
+    which limits the usable range to ``nb_tot * (bias - 1)**2 / bias`` of a
+    few. For ``nb_tot = 10`` this is ``bias <~ 1.7``, for ``nb_tot = 100``
+    already ``bias <~ 1.2``. The expected ``n_eff`` is printed.
+
+    Trials without events are booked as ``ts = 0`` without injection, as in
+    ``do_empty_fastpath_trials``.
+
+    Parameters
+    ----------
+    bg_injs : dict
+        Sample names as keys, fitted background injectors as values.
+    llhs : dict
+        Sample names as keys, fitted ``tdepps.grb.GRBLLH`` as values.
+    n_trials : int
+        Number of trials.
+    rndgen : ``np.random.RandomState`` instance
+        Random state used to draw the counts and seed the injectors.
+    bias : float
+        Factor the expected background counts are scaled with, ``>= 1``. See
+        above for the usable range.
+    batch_size : int, optional
+        Trials drawn and fitted at once. (default: 10000)
+
+    Returns
+    -------
+    trials : record-array
+        Names ``'ns', 'ts', 'weights'`` for all trials with ``ts > 0``.
+    nzeros : int
+        Number of trials with ``ts = 0``.
+    wzeros : float
+        Summed weights of all trials with ``ts = 0``.
+    """
+    if bias < 1.:
+        raise ValueError("`bias` must be >= 1.")
+    keys = sorted(bg_injs.keys())
+    states, lams = _probe_poisson_means(bg_injs, rndgen)
+    nb_tot = sum(_np.sum(lam) for lam in lams.values())
+    print("Expected effective trials {:.4g} of {} for nb_tot {:.3g}.".format(
+        n_trials * _np.exp(-nb_tot * (bias - 1.)**2 / bias), n_trials, nb_tot))
+    coeffs = src_coefficients(llhs)
+    ns, ts, weights = [_np.empty(0)], [_np.empty(0)], [_np.empty(0)]
+    nzeros, wzeros = 0, 0.
+    ndone = 0
+    while ndone < n_trials:
+        nbatch = min(batch_size, n_trials - ndone)
+        counts = {key: rndgen.poisson(bias * lams[key], size=(nbatch,) +
+                                      lams[key].shape) for key in keys}
+        ntot = _total_counts(counts, nbatch)
+        w = _np.exp((bias - 1.) * nb_tot - ntot * _np.log(bias))
+        filled = _np.flatnonzero(ntot > 0)
+        nzeros += nbatch - len(filled)
+        wzeros += _np.sum(w[ntot == 0])
+        ndone += nbatch
+        if len(filled) == 0:
+            continue
+
+        ns_i, ts_i = _fit_counts(bg_injs, llhs, states, counts, filled, coeffs)
+        nonzero = ts_i > 0
+        nzeros += int(len(filled) - _np.sum(nonzero))
+        wzeros += _np.sum(w[filled][~nonzero])
+        ns.append(ns_i[nonzero])
+        ts.append(ts_i[nonzero])
+        weights.append(w[filled][nonzero])
+
+    trials = _make_trials(ns, ts, weights)
+    print("Summed weights {:.4g} for {} biased trials.".format(
+        wzeros + _np.sum(trials["weights"]), n_trials))
+    return trials, nzeros, wzeros
+
+
+def _probe_poisson_means(bg_injs, rndgen):
+    """
+    Replace the injectors' random states with ``PresetPoissonState`` objects
+    seeded from ``rndgen`` and sample once, to get the Poisson means the
+    event counts are drawn with.
+    """
+    states, lams = {}, {}
+    for key in sorted(bg_injs.keys()):
+        states[key] = PresetPoissonState(rndgen.randint(2**31))
+        bg_injs[key].rndgen = states[key]
+        bg_injs[key].sample()
+        if states[key].last_lam is None:
+            raise RuntimeError("Injector for sample '{}' ".format(key) +
+                               "doesn't draw Poisson counts, can't preset " +
+                               "the event counts.")
+        lams[key] = states[key].last_lam
+        print("Expected events for sample {}: {:.3g}".format(
+            key, _np.sum(lams[key])))
+    return states, lams
+
+
+def _total_counts(counts, ntrials):
+    """ Total number of events per trial over all samples and sources """
+    return sum(c.reshape(ntrials, -1).sum(axis=1) for c in counts.values())
+
+
+def _fit_counts(bg_injs, llhs, states, counts, filled, coeffs):
+    """
+    Inject the trials ``filled`` with the preset ``counts`` and fit them with
+    ``fit_ns_batch``. Returns ``ns, ts`` for each trial in ``filled``.
+    """
+    keys = sorted(bg_injs.keys())
+    X, trial_idx = {}, {}
+    for key in keys:
+        X[key], trial_idx[key] = _sample_counts(bg_injs[key], states[key],
+                                                counts[key][filled])
+    sob = stacked_soverb(llhs, X, coeffs, trial_idx=trial_idx)
+    return fit_ns_batch(_np.concatenate([sob[key] for key in keys]),
+                        _np.concatenate([trial_idx[key] for key in keys]),
+                        len(filled))
+
+
+def _make_trials(ns, ts, weights=None):
+    """ Trial record array from lists of ``ns``, ``ts`` and weight arrays """
+    ns, ts = _np.concatenate(ns), _np.concatenate(ts)
+    names = ["ns", "ts"] if weights is None else ["ns", "ts", "weights"]
+    trials = _np.empty(len(ts), dtype=[(n, float) for n in names])
+    trials["ns"] = ns
+    trials["ts"] = ts
+    if weights is not None:
+        trials["weights"] = _np.concatenate(weights)
+    return trials
+
+
+def check_batched_trials(multi_llh, bg_injs, llhs, n_trials, ns0=0.1,
+                         tol=1e-4):
+    """
+    Compare the vectorized fit against the ``MultiGRBLLH`` minimizer on the
+    same pseudo experiments.
+
+    Parameters
+    ----------
+    multi_llh : ``tdepps.grb.MultiGRBLLH``
+        Fitted multi LLH built from ``llhs``.
+    bg_injs : dict
+        Sample names as keys, fitted background injectors as values.
+    llhs : dict
+        Sample names as keys, fitted ``tdepps.grb.GRBLLH`` as values.
+    n_trials : int
+        Number of trials to compare.
+    ns0 : float, optional
+        Minimizer seed. (default: 0.1)
+    tol : float, optional
+        Largest allowed absolute ``ts`` difference. (default: 1e-4)
+
+    Returns
+    -------
+    max_dts : float
+        Largest absolute difference in ``ts`` over all compared trials.
+
+    Raises
+    ------
+    RuntimeError
+        If the ``ts`` of any trial differs by more than ``tol``.
+    """
+    coeffs = src_coefficients(llhs)
+    cuts = sob_thresholds(llhs)
+    max_dts = 0.
+    for _ in range(n_trials):
+        X = {key: inj.sample() for key, inj in bg_injs.items()}
+        sob = stacked_soverb(llhs, X, coeffs, cuts=cuts)
+        sob = _np.concatenate([sob[key] for key in sorted(sob.keys())])
+        _, ts = fit_ns_batch(sob, _np.zeros(len(sob), dtype=int), 1)
+        _, ts_ref = multi_llh.fit_lnllh_ratio(X, ns0=ns0)
+        max_dts = max(max_dts, abs(ts[0] - ts_ref))
+    print("Max. ts difference to minimizer in {} trials: {:.3g}".format(
+        n_trials, max_dts))
+    if max_dts > tol:
+        raise RuntimeError("Batched fit differs from the minimizer by " +
+                           "{:.3g} > {:.3g} in ts.".format(max_dts, tol))
+    return max_dts
+
+
+def time_window_views(multi_llh, dt0s, dt1s, min_nbytes=1 << 16):
+    """
+    Copies of a ``MultiGRBLLH`` with new source time windows, which share all
+    large arrays, like the selected event data and PDF tables, with the base
+    LLH and with each other. Only the small per source state is copied, which
+    ``set_new_srcs_dt`` changes. This replaces one full ``deepcopy`` per
+    window, so memory stays close to that of a single LLH.
+
+    Parameters
+    ----------
+    multi_llh : ``tdepps.grb.MultiGRBLLH``
+        Fitted base LLH.
+    dt0s, dt1s : array-like
+        Left and right time window edges in seconds, one view per pair.
+    min_nbytes : int, optional
+        Arrays with at least this many bytes are shared instead of copied.
+        These must not depend on the time window, which is verified with
+        ``check_time_window_views``. (default: 64 kB)
+
+    Returns
+    -------
+    views : list of ``tdepps.grb.MultiGRBLLH``
+        One LLH per time window.
+    """
+    shared = _large_arrays(multi_llh, min_nbytes)
+    print("Sharing {} arrays, {:.1f} MB, between {} time window LLHs".format(
+        len(shared), sum(arr.nbytes for arr in shared.values()) / 1024.**2,
+        len(dt0s)))
+    views = []
+    for dt0, dt1 in zip(dt0s, dt1s):
+        # Arrays found in the memo are not copied but used as is
+        view = _deepcopy(multi_llh, memo=dict(shared))
+        for model in view.model.values():
+            model.set_new_srcs_dt(dt0=dt0, dt1=dt1, copy=False)
+        views.append(view)
+    return views
+
+
+def check_time_window_views(multi_llh, views, dt0s, dt1s, bg_injs, n_trials,
+                            ns0=0.1, tol=1e-8):
+    """
+    Compare the ``ts`` of the views from ``time_window_views`` with those of
+    independent full copies of ``multi_llh`` on the same pseudo experiments.
+    This fails if a shared array depends on the time window. The copies are
+    built one window at a time, so memory stays at two LLHs.
+
+    Parameters
+    ----------
+    multi_llh : ``tdepps.grb.MultiGRBLLH``
+        Base LLH the views were built from.
+    views : list of ``tdepps.grb.MultiGRBLLH``
+        Output of ``time_window_views(multi_llh, dt0s, dt1s)``.
+    dt0s, dt1s : array-like
+        Time window edges in seconds, as used for the views.
+    bg_injs : dict
+        Sample names as keys, fitted background injectors as values.
+    n_trials : int
+        Number of compared trials.
+    ns0 : float, optional
+        Minimizer seed. (default: 0.1)
+    tol : float, optional
+        Largest allowed absolute ``ts`` difference. (default: 1e-8)
+
+    Returns
+    -------
+    max_dts : float
+        Largest absolute difference in ``ts`` over all windows and trials.
+
+    Raises
+    ------
+    RuntimeError
+        If the ``ts`` of any view and trial differs by more than ``tol``.
+    """
+    Xs = [{key: inj.sample() for key, inj in bg_injs.items()}
+          for _ in range(n_trials)]
+    max_dts = 0.
+    for view, dt0, dt1 in zip(views, dt0s, dt1s):
+        llh = _deepcopy(multi_llh)
+        for model in llh.model.values():
+            model.set_new_srcs_dt(dt0=dt0, dt1=dt1, copy=False)
+        for X in Xs:
+            _, ts_view = view.fit_lnllh_ratio(X, ns0=ns0)
+            _, ts_llh = llh.fit_lnllh_ratio(X, ns0=ns0)
+            max_dts = max(max_dts, abs(ts_view - ts_llh))
+        del llh
+
+    print("Max. ts difference of the views to full copies in {} ".format(
+        n_trials) + "trials: {:.3g}".format(max_dts))
+    if max_dts > tol:
+        raise RuntimeError("Time window views differ from independent LLHs " +
+                           "by {:.3g} > {:.3g} in ts.".format(max_dts, tol))
+    return max_dts
+
+
+def _large_arrays(obj, min_nbytes):
+    """
+    Walk the attributes and containers of ``obj`` and collect all numpy arrays
+    with at least ``min_nbytes`` bytes, as ``{id(arr): arr}``.
+    """
+    found, seen, stack = {}, set(), [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, _np.ndarray):
+            if obj.nbytes >= min_nbytes:
+                found[id(obj)] = obj
+            elif obj.dtype == object:
+                stack.extend(obj.ravel())
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__"):
+            stack.extend(vars(obj).values())
+    return found
+
+
+class NestedWindowEvaluator(object):
+    """
+    Fit all nested time windows of a trial in a single pass over its events.
+
+    The spatial and energy PDFs are the same for all windows and the time PDF
+    ratio is flat inside a window, so the signal over background ratio of
+    event ``i`` and source ``k`` only depends on the window through the
+    window membership of the event and a per source and window factor. Each
+    event source pair is therefore evaluated once with the LLHs of the
+    largest window and assigned to the innermost window shell containing it.
+    A window's ``sob_i`` is the sum over the shells up to that window,
+    weighted with the window's coefficients, and the ``ns`` of all windows
+    are fitted together with ``fit_ns_batch``.
+
+    If the coefficients split into a per source and a per window factor, as
+    for windows shared by all sources, the pairs are summed per event and
+    shell and the windows are a cumulative sum over the shells. Otherwise the
+    pairs are sorted by shell and each window sums the prefix of pairs in its
+    shells with its own coefficients.
+
+    The per window factors, the stacking coefficients and the time PDF
+    normalization relative to the largest window, are taken from the window
+    views. The latter is measured once on ``probe`` events moved to the
+    source times, which are inside the flat part of all windows. The
+    ``GRBLLH`` thresholds are applied per window, as in ``stacked_soverb``.
+
+    Parameters
+    ----------
+    llhs : dict
+        Sample names as keys, ``tdepps.grb.GRBLLH`` fitted for the largest
+        time window as values.
+    views : list of ``tdepps.grb.MultiGRBLLH``
+        One LLH per window, as from ``time_window_views``.
+    dt0s, dt1s : array-like
+        Nested time window edges in seconds, same order as ``views``.
+    src_mjds : dict
+        Sample names as keys, source times in MJD as values, in the order of
+        the sources in the LLH models.
+    probe : dict
+        Sample names as keys, some events of each sample as values, eg. from
+        ``sample_probe``. Only the events with a non-zero ratio to a source
+        are used to measure its time PDF normalization.
+    """
+    def __init__(self, llhs, views, dt0s, dt1s, src_mjds, probe):
+        dt0s, dt1s = _np.asarray(dt0s, dtype=float), _np.asarray(dt1s,
+                                                                 dtype=float)
+        if _np.any(_np.diff(dt0s) > 0) or _np.any(_np.diff(dt1s) < 0):
+            raise ValueError("Time windows must be nested and sorted from " +
+                             "the innermost to the outermost one.")
+        if len(views) != len(dt0s):
+            raise ValueError("Need one view LLH per time window.")
+        self._llhs = llhs
+        self._dt0s, self._dt1s = dt0s, dt1s
+        self._src_mjds = {key: _np.atleast_1d(src_mjds[key]).astype(float)
+                          for key in llhs}
+        # Per source and window coefficients, shape (nsrcs, nwins) per sample
+        weights = [{key: _model_src_weights(view.model[key]) for key in llhs}
+                   for view in views]
+        self._coeffs, self._factors, self._cuts = {}, {}, {}
+        for key in llhs:
+            w_tot = _np.array([sum(_np.sum(wi[0]) for wi in w.values())
+                               for w in weights])
+            coeffs = _np.vstack([w[key][0] / w_tot[i] / w[key][1]
+                                 for i, w in enumerate(weights)]).T
+            self._coeffs[key] = coeffs * self._time_norm(key, views,
+                                                         probe[key])
+            self._factors[key] = _split_coefficients(self._coeffs[key])
+            # Same thresholds as ``sob_thresholds``, for each window
+            abs_eps, rel_eps = _llh_sob_eps(llhs[key])
+            frac = _np.array([_np.sum(w[key][0]) for w in weights]) / w_tot
+            self._cuts[key] = (abs_eps * frac, rel_eps)
+
+    def _time_norm(self, key, views, X):
+        """ Time PDF ratio of each window relative to the largest one """
+        norm = _np.ones((len(self._src_mjds[key]), self.nwins), dtype=float)
+        for k, mjd in enumerate(self._src_mjds[key]):
+            Xk = _np.array(X, copy=True)
+            Xk["time"] = mjd
+            base = _src_soverb(self._llhs[key], Xk)[k]
+            m = base > 0
+            if not _np.any(m):
+                raise ValueError("No probe event of sample '{}' ".format(key) +
+                                 "has a signal contribution for source " +
+                                 "{}, use more probe events.".format(k))
+            for w, view in enumerate(views):
+                sob = _model_soverb(view.model[key], Xk[m])[k]
+                norm[k, w] = _np.median(sob / base[m])
+        return norm
+
+    @property
+    def nwins(self):
+        return len(self._dt0s)
+
+    def shells(self, key, t):
+        """
+        Innermost window index for each source and event of a sample,
+        ``nwins`` if the event is outside of all windows.
+
+        Parameters
+        ----------
+        key : str
+            Sample name.
+        t : array-like, shape (nevts,)
+            Event times in MJD.
+
+        Returns
+        -------
+        shell : array-like, shape (nsrcs, nevts)
+            Window indices.
+        """
+        dt = (_np.atleast_1d(t)[None, :] -
+              self._src_mjds[key][:, None]) * 86400.
+        return _np.maximum(_np.searchsorted(self._dt1s, dt, side="left"),
+                           _np.searchsorted(-self._dt0s, -dt, side="left"))
+
+    def window_soverb(self, X, trial_idx=None):
+        """
+        Stacked ``sob_i`` of each event in each window, with the ``GRBLLH``
+        thresholds of each window applied.
+
+        Parameters
+        ----------
+        X : dict
+            Sample names as keys, event record arrays as values.
+        trial_idx : dict or None, optional
+            Sample names as keys, trial index of each event as values, needed
+            for the relative threshold. If ``None``, ``X`` is a single trial.
+            (default: ``None``)
+
+        Returns
+        -------
+        sob : dict
+            Sample names as keys, arrays of shape ``(nevts, nwins)`` as values.
+            Cut events have ``sob_i = 0`` in the affected windows.
+        """
+        if trial_idx is None:
+            trial_idx = {key: _np.zeros(len(X[key]), dtype=int)
+                         for key in self._llhs}
+        ntrials = 1 + max([_np.amax(idx) for idx in trial_idx.values()
+                           if len(idx) > 0] or [0])
+        wins = _np.arange(self.nwins)
+        sob = {}
+        for key, llh in self._llhs.items():
+            nevts = len(X[key])
+            sob[key] = _np.zeros((nevts, self.nwins), dtype=float)
+            if nevts == 0:
+                continue
+            ratio = _src_soverb(llh, X[key])
+            shell = self.shells(key, X[key]["time"])
+            k, i = _np.nonzero((ratio > 0) & (shell < self.nwins))
+            ratio, shell = ratio[k, i], shell[k, i]
+            # Each pair counts for its own shell and all enclosing windows
+            if self._factors[key] is not None:
+                src_fac, win_fac = self._factors[key]
+                per_shell = _np.bincount(i * self.nwins + shell,
+                                         weights=ratio * src_fac[k],
+                                         minlength=nevts * self.nwins)
+                sob[key] = win_fac * _np.cumsum(
+                    per_shell.reshape(nevts, self.nwins), axis=1)
+            else:
+                order = _np.argsort(shell, kind="mergesort")
+                k, i, ratio = k[order], i[order], ratio[order]
+                ends = _np.searchsorted(shell[order], wins, side="right")
+                for w, end in enumerate(ends):
+                    sob[key][:, w] = _np.bincount(
+                        i[:end], weights=ratio[:end] *
+                        self._coeffs[key][k[:end], w], minlength=nevts)
+            sob[key] = cut_soverb(sob[key], trial_idx[key], ntrials,
+                                  *self._cuts[key])
+        return sob
+
+    def fit(self, X, trial_idx, ntrials):
+        """
+        Fit ``ns`` in all windows for a batch of trials.
+
+        Parameters
+        ----------
+        X : dict
+            Sample names as keys, concatenated event arrays of all trials.
+        trial_idx : dict
+            Sample names as keys, trial index of each event.
+        ntrials : int
+            Number of trials in the batch.
+
+        Returns
+        -------
+        ns, ts : array-like, shape (nwins, ntrials)
+            Best fit ``ns`` and test statistic per window and trial.
+        """
+        sob = self.window_soverb(X, trial_idx)
+        keys = sorted(sob.keys())
+        sob = _np.concatenate([sob[key] for key in keys])
+        trial_idx = _np.concatenate([trial_idx[key] for key in keys])
+        # Flatten to one fit per window and trial, window major
+        idx = (_np.arange(self.nwins)[None, :] * ntrials +
+               trial_idx[:, None]).ravel()
+        sob = sob.ravel()
+        m = sob > 0
+        ns, ts = fit_ns_batch(sob[m], idx[m], ntrials * self.nwins)
+        return ns.reshape(self.nwins, ntrials), ts.reshape(self.nwins, ntrials)
+
+
+def _split_coefficients(coeffs, rtol=1e-10):
+    """
+    Split per source and window coefficients into ``coeffs[k, w] = src[k] *
+    win[w]``. Returns ``(src, win)`` or ``None``, if they don't factorize.
+    """
+    src = coeffs[:, -1]
+    if _np.any(src <= 0):
+        return None
+    win = coeffs[0] / src[0]
+    if not _np.allclose(src[:, None] * win[None, :], coeffs, rtol=rtol,
+                        atol=0.):
+        return None
+    return src, win
+
+
+def do_nested_window_trials(bg_injs, evaluator, n_trials, batch_size=10000,
+                            keep_zeros=False):
+    """
+    Background trials for all nested time windows from one injection stream.
+    Events are injected with the injectors of the largest window and each
+    trial is fitted in all windows with a ``NestedWindowEvaluator``.
+
+    Parameters
+    ----------
+    bg_injs : dict
+        Sample names as keys, background injectors fitted for the largest
+        window as values.
+    evaluator : ``NestedWindowEvaluator``
+        Evaluator for all windows.
+    n_trials : int
+        Number of trials.
+    batch_size : int, optional
+        Trials injected and fitted at once. (default: 10000)
+    keep_zeros : bool, optional
+        If ``True``, the ``ts = 0`` trials are kept, so the trials of all
+        windows are aligned, as needed for post trials. (default: ``False``)
+
+    Returns
+    -------
+    trials : list of record-arrays
+        Names ``'ns', 'ts'``, one array per window, only for trials with
+        ``ts > 0`` unless ``keep_zeros`` is ``True``.
+    nzeros : array-like, shape (nwins,)
+        Number of trials with ``ts = 0`` per window.
+    """
+    ns = [[] for _ in range(evaluator.nwins)]
+    ts = [[] for _ in range(evaluator.nwins)]
+    nzeros = _np.zeros(evaluator.nwins, dtype=int)
+    ndone = 0
+    while ndone < n_trials:
+        nbatch = min(batch_size, n_trials - ndone)
+        X, trial_idx = sample_batch(bg_injs, nbatch)
+        ns_i, ts_i = evaluator.fit(X, trial_idx, nbatch)
+        for w in range(evaluator.nwins):
+            keep = ts_i[w] > 0
+            nzeros[w] += nbatch - _np.sum(keep)
+            if keep_zeros:
+                keep = slice(None)
+            ns[w].append(ns_i[w][keep])
+            ts[w].append(ts_i[w][keep])
+        ndone += nbatch
+    return [_make_trials(ns_w, ts_w) for ns_w, ts_w in zip(ns, ts)], nzeros
+
+
+def check_nested_windows(views, evaluator, bg_injs, n_trials, ns0=0.1,
+                         tol=1e-4):
+    """
+    Compare the single pass nested window fit against the ``MultiGRBLLH``
+    minimizer of each window view on the same pseudo experiments.
+
+    Parameters
+    ----------
+    views : list of ``tdepps.grb.MultiGRBLLH``
+        LLHs per window, as given to ``evaluator``.
+    evaluator : ``NestedWindowEvaluator``
+        Evaluator to check.
+    bg_injs : dict
+        Sample names as keys, fitted background injectors as values.
+    n_trials : int
+        Number of trials to compare.
+    ns0 : float, optional
+        Seed for the minimizer. (default: 0.1)
+    tol : float, optional
+        Largest allowed absolute ``ts`` difference. (default: 1e-4)
+
+    Returns
+    -------
+    max_dts : array-like, shape (nwins,)
+        Largest absolute test statistic difference per window.
+
+    Raises
+    ------
+    RuntimeError
+        If the ``ts`` of any window and trial differs by more than ``tol``.
+    """
+    max_dts = _np.zeros(evaluator.nwins, dtype=float)
+    for _ in range(n_trials):
+        X, trial_idx = sample_batch(bg_injs, 1)
+        _, ts = evaluator.fit(X, trial_idx, 1)
+        for w, view in enumerate(views):
+            _, ts_ref = view.fit_lnllh_ratio(X=X, ns0=ns0)
+            max_dts[w] = max(max_dts[w], abs(ts[w, 0] - ts_ref))
+    print("Nested window check: max |dts| = {:.3g} in {} trials".format(
+        _np.amax(max_dts), n_trials))
+    if _np.amax(max_dts) > tol:
+        raise RuntimeError("Nested window fit differs from the minimizer " +
+                           "by {:.3g} > {:.3g} in ts.".format(
+                               _np.amax(max_dts), tol))
+    return max_dts
@@ -0,0 +1,164 @@
+# coding: utf-8
+
+"""
+Small helpers shared by the analysis scripts.
+"""
+
+import os as _os
+import resource as _resource
+import numpy as _np
+
+
+def memory_report():
+    """
+    Memory usage of the current process from ``/proc/self/status``.
+
+    ``rss_anon`` is private memory of this process. ``rss_file`` are file
+    backed pages, eg. from memory mapped data files, which are shared with all
+    other processes mapping the same files.
+
+    Returns
+    -------
+    mem : dict
+        Memory usage in MB with keys ``'rss', 'rss_anon', 'rss_file',
+        'rss_shmem', 'peak_rss'``. Keys not available on this system are
+        missing, ``'peak_rss'`` is always available.
+    """
+    keys = {"VmRSS": "rss", "RssAnon": "rss_anon", "RssFile": "rss_file",
+            "RssShmem": "rss_shmem", "VmHWM": "peak_rss"}
+    mem = {}
+    try:
+        with open(_os.path.join("/proc", "self", "status")) as inf:
+            for line in inf:
+                key, _, val = line.partition(":")
+                if key in keys:
+                    # Values are given as '<val> kB'
+                    mem[keys[key]] = float(val.split()[0]) / 1024.
+    except IOError:
+        pass
+    if "peak_rss" not in mem:
+        # Max RSS from getrusage is in kB on linux
+        mem["peak_rss"] = _resource.getrusage(
+            _resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return mem
+
+
+def print_memory_report(info=""):
+    """
+    Print the current memory usage of this process.
+
+    Parameters
+    ----------
+    info : str, optional
+        Printed in the report headline. (default: ``''``)
+    """
+    mem = memory_report()
+    print("Memory usage{}:".format(" " + info if info else ""))
+    for key in ["rss", "rss_anon", "rss_file", "rss_shmem", "peak_rss"]:
+        if key in mem:
+            print("  {:9s}: {:10.1f} MB".format(key, mem[key]))
+    if "rss_file" in mem:
+        print("  File backed pages are shared with other processes mapping " +
+              "the same data files.")
+
+
+def available_memory():
+    """
+    Memory available for new processes without swapping, from
+    ``/proc/meminfo``.
+
+    Returns
+    -------
+    mem : float or None
+        Available memory in GB. ``None`` if not available on this system.
+    """
+    try:
+        with open(_os.path.join("/proc", "meminfo")) as inf:
+            for line in inf:
+                key, _, val = line.partition(":")
+                if key == "MemAvailable":
+                    # Value is given as '<val> kB'
+                    return float(val.split()[0]) / 1024.**2
+    except IOError:
+        pass
+    return None
+
+
+def pack_ids(run_ids, event_ids):
+    """
+    Pack run and event IDs into single, exact ``uint64`` IDs, with the run ID
+    in the upper and the event ID in the lower 32 bits.
+
+    Parameters
+    ----------
+    run_ids, event_ids : array-like
+        Non-negative integer IDs below ``2**32``, broadcastable to each other.
+        Float IDs, as stored in some data files, are accepted if they hold
+        integral values.
+
+    Returns
+    -------
+    ids : array-like, dtype ``uint64``
+        Packed IDs, sorting them sorts by run first and then by event.
+    """
+    run_ids = _np.asarray(run_ids)
+    event_ids = _np.asarray(event_ids)
+    for name, arr in [("run", run_ids), ("event", event_ids)]:
+        if arr.size > 0 and arr.dtype.kind == "f":
+            if not _np.all(_np.floor(arr) == arr):
+                raise ValueError("{} IDs must have integral values.".format(
+                    name.title()))
+        elif arr.size > 0 and arr.dtype.kind not in "iu":
+            raise TypeError("{} IDs must be integers.".format(name.title()))
+        if arr.size > 0 and (_np.amin(arr) < 0 or _np.amax(arr) >= 2**32):
+            raise ValueError("{} IDs must be in [0, 2**32).".format(
+                name.title()))
+    return ((run_ids.astype(_np.uint64) << _np.uint64(32)) |
+            event_ids.astype(_np.uint64))
+
+
+def in_sorted_ids(ids, sorted_ids):
+    """
+    Mask of ``ids`` contained in ``sorted_ids``, using a binary search in
+    the sorted reference IDs instead of sorting both arrays like ``np.isin``.
+
+    Parameters
+    ----------
+    ids : array-like
+        IDs to check, eg. from ``pack_ids``.
+    sorted_ids : array-like
+        Sorted reference IDs with the same dtype as ``ids``.
+
+    Returns
+    -------
+    is_in : array-like, shape (len(ids),)
+        Mask: ``True`` for each ID found in ``sorted_ids``.
+    """
+    ids = _np.atleast_1d(ids)
+    sorted_ids = _np.atleast_1d(sorted_ids)
+    if len(sorted_ids) == 0:
+        return _np.zeros(len(ids), dtype=bool)
+    idx = _np.searchsorted(sorted_ids, ids, side="left")
+    idx[idx == len(sorted_ids)] = 0
+    return sorted_ids[idx] == ids
+
+
+def match_run_event_ids(run_ids, event_ids, ref_run_ids, ref_event_ids):
+    """
+    Mask of the run and event ID pairs that are also in the reference pairs.
+
+    Parameters
+    ----------
+    run_ids, event_ids : array-like, shape (nevts,)
+        IDs to check.
+    ref_run_ids, ref_event_ids : array-like, shape (nrefs,)
+        Reference IDs, eg. of HESE like events.
+
+    Returns
+    -------
+    is_in : array-like, shape (nevts,)
+        Mask: ``True`` for each ID pair found in the reference pairs.
+    """
+    ref_ids = _np.unique(pack_ids(_np.atleast_1d(ref_run_ids),
+                                  _np.atleast_1d(ref_event_ids)))
+    return in_sorted_ids(pack_ids(run_ids, event_ids), ref_ids)
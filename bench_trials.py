@@ -0,0 +1,213 @@
+# coding: utf-8
+
+"""
+Benchmark the trial throughput for each time window.
+
+Times the model setup, background trials (`ana.do_trials`), post trials
+(`ana.post_trials` with one test LLH per time window) and performance trials
+(`ana.performance`) and records the rates, setup time and peak memory to
+`PATHS.local/benchmarks/trials_benchmark.json`. This file is used by
+`07-bg_trials_jobs.py` to size the jobs per time window.
+
+Each time window is benchmarked in a fresh process, so the peak memory is that
+of a single trial job. If a baseline exists, the results are compared to it
+and the script exits with an error, if any rate dropped or setup time or
+memory grew by more than `--tolerance`. Use `--save_baseline` to store the
+current results as new baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+from _paths import PATHS
+from _loader import time_window_loader
+from _job_planner import default_benchmark_file
+
+
+# Rates are better if larger, the others if smaller
+RATE_KEYS = ["bg_trials_per_sec", "post_trials_per_sec",
+             "perf_trials_per_sec"]
+COST_KEYS = ["setup_sec", "peak_rss_mb"]
+
+
+def run_single(tw_id, args):
+    """ Benchmark a single time window in this process """
+    from tdepps.grb import MultiGRBLLH, UniformTimeSampler
+    from tdepps.grb import MultiBGDataInjector, MultiSignalFluenceInjector
+    from tdepps.grb import GRBLLHAnalysis
+    from _models import get_sample_models, build_sig_injector
+    from _utils import memory_report
+    from _trials import time_window_views
+    import _loader
+
+    res = {}
+    rndgen = np.random.RandomState(args.rnd_seed)
+    dt0, dt1 = _loader.time_window_loader(tw_id)
+
+    # Setup, as in the trial scripts
+    t0 = time.time()
+    time_sam = UniformTimeSampler(random_state=rndgen)
+    bg_injs, sig_injs, llhs = {}, {}, {}
+    for key in _loader.source_list_loader():
+        bg_injs[key], llhs[key] = get_sample_models(key, tw_id, rndgen)
+    multi_bg_inj = MultiBGDataInjector()
+    multi_bg_inj.fit(bg_injs)
+    multi_llh_opts = _loader.settings_loader("multi_llh")["multi_llh"]
+    multi_llh = MultiGRBLLH(llh_opts=multi_llh_opts)
+    multi_llh.fit(llhs=llhs)
+    ana = GRBLLHAnalysis(multi_llh, multi_bg_inj, sig_inj=None)
+    res["setup_sec"] = time.time() - t0
+
+    # Background trials
+    t0 = time.time()
+    ana.do_trials(n_trials=args.nbg, n_signal=None, ns0=0.1, full_out=False)
+    res["bg_trials_per_sec"] = args.nbg / (time.time() - t0)
+
+    # Post trials, test LLHs for all time windows as in `10-post_trials.py`
+    if args.npost > 0:
+        dt0s, dt1s = _loader.time_window_loader("all")
+        test_llhs = time_window_views(ana.llh, dt0s, dt1s)
+        t0 = time.time()
+        ana.post_trials(n_trials=args.npost, test_llhs=test_llhs, ns0=0.1)
+        res["post_trials_per_sec"] = args.npost / (time.time() - t0)
+        del test_llhs
+
+    # Performance trials, signal injector setup is not timed
+    if args.nperf > 0:
+        for key in bg_injs:
+            sig_injs[key] = build_sig_injector(key, dt0, dt1, args.sig_inj,
+                                               time_sam)
+        multi_sig_inj = MultiSignalFluenceInjector(random_state=rndgen)
+        multi_sig_inj.fit(sig_injs)
+        ana = GRBLLHAnalysis(multi_llh, multi_bg_inj, sig_inj=multi_sig_inj)
+        mus = np.array(args.mus, dtype=float)
+        t0 = time.time()
+        ana.performance(ts_val=0., beta=0.9, mus=mus, ns0=0.1,
+                        n_batch_trials=args.nperf)
+        res["perf_trials_per_sec"] = (len(mus) * args.nperf /
+                                      (time.time() - t0))
+
+    res["peak_rss_mb"] = memory_report()["peak_rss"]
+    res.update({"nbg": args.nbg, "npost": args.npost, "nperf": args.nperf})
+    return res
+
+
+def run_all(tw_ids, args):
+    """ Benchmark each time window in a separate process """
+    results = {}
+    for tw_id in tw_ids:
+        print("Benchmarking time window {:02d}".format(tw_id))
+        cmd = [sys.executable, os.path.abspath(__file__), "--single",
+               "--tw_ids", str(tw_id)] + _pass_args(args)
+        out = subprocess.check_output(cmd)
+        # The result is the last line, everything before is job output
+        res = json.loads(out.decode("utf-8").strip().split("\n")[-1])
+        results["{:02d}".format(tw_id)] = res
+        print("  " + ", ".join("{}: {:.4g}".format(k, res[k]) for k in
+                               RATE_KEYS + COST_KEYS if k in res))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results to a baseline.
+
+    Returns
+    -------
+    regressions : list of str
+        One message per value worse than ``tolerance`` relative to baseline.
+    """
+    regressions = []
+    print("Comparison to baseline, ratio new / baseline:")
+    for tw, res in sorted(results.items()):
+        base = baseline.get(tw, {})
+        ratios = []
+        for key in RATE_KEYS + COST_KEYS:
+            if key not in res or base.get(key, 0) <= 0:
+                continue
+            ratio = res[key] / base[key]
+            ratios.append("{}: {:.2f}".format(key, ratio))
+            if ((key in RATE_KEYS and ratio < 1. - tolerance) or
+                    (key in COST_KEYS and ratio > 1. + tolerance)):
+                regressions.append("tw {}, {}: {:.4g} -> {:.4g}".format(
+                    tw, key, base[key], res[key]))
+        print("  tw {}: {}".format(tw, ", ".join(ratios)))
+    return regressions
+
+
+def _pass_args(args):
+    """ Benchmark settings as command line arguments for single runs """
+    return ["--nbg", str(args.nbg), "--npost", str(args.npost),
+            "--nperf", str(args.nperf), "--sig_inj", args.sig_inj,
+            "--rnd_seed", str(args.rnd_seed),
+            "--mus"] + [str(mu) for mu in args.mus]
+
+
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("--tw_ids", type=int, nargs="*", default=None,
+                    help="Time windows to benchmark. Default: all.")
+parser.add_argument("--nbg", type=int, default=10000)
+parser.add_argument("--npost", type=int, default=20)
+parser.add_argument("--nperf", type=int, default=20,
+                    help="Performance trials per signal mean.")
+parser.add_argument("--mus", type=float, nargs="+", default=[1., 5.])
+parser.add_argument("--sig_inj", type=str, default="ps")
+parser.add_argument("--rnd_seed", type=int, default=0)
+parser.add_argument("--outfile", type=str, default=None)
+parser.add_argument("--baseline", type=str, default=None)
+parser.add_argument("--save_baseline", action="store_true")
+parser.add_argument("--tolerance", type=float, default=0.2)
+parser.add_argument("--single", action="store_true",
+                    help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+if args.single:
+    print(json.dumps(run_single(args.tw_ids[0], args)))
+    sys.exit()
+
+outfile = default_benchmark_file() if args.outfile is None else args.outfile
+baseline_file = args.baseline
+if baseline_file is None:
+    baseline_file = os.path.join(os.path.dirname(outfile),
+                                 "trials_benchmark_baseline.json")
+if not os.path.isdir(os.path.dirname(outfile)):
+    os.makedirs(os.path.dirname(outfile))
+
+tw_ids = time_window_loader() if args.tw_ids is None else args.tw_ids
+results = run_all(tw_ids, args)
+bench = {
+    "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+    "host": platform.node(),
+    "repo": PATHS.repo,
+    "settings": {"nbg": args.nbg, "npost": args.npost, "nperf": args.nperf,
+                 "mus": args.mus, "sig_inj": args.sig_inj,
+                 "rnd_seed": args.rnd_seed},
+    "time_windows": results,
+    }
+with open(outfile, "w") as outf:
+    json.dump(bench, fp=outf, indent=1, sort_keys=True)
+    print("Saved benchmark to:\n  {}".format(outfile))
+
+if args.save_baseline:
+    shutil.copy(outfile, baseline_file)
+    print("Saved as baseline to:\n  {}".format(baseline_file))
+elif os.path.isfile(baseline_file):
+    with open(baseline_file) as inf:
+        baseline = json.load(inf)
+    regressions = compare(results, baseline["time_windows"], args.tolerance)
+    if regressions:
+        print("Regressions larger than {:.0f}%:".format(100 * args.tolerance))
+        for msg in regressions:
+            print("  " + msg)
+        sys.exit(1)
+    print("No regressions larger than {:.0f}%.".format(100 * args.tolerance))
+else:
+    print("No baseline found at:\n  {}".format(baseline_file))
+    print("Use `--save_baseline` to store these results as baseline.")
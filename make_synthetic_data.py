@@ -0,0 +1,85 @@
+# coding: utf-8
+
+"""
+Write a synthetic offline dataset, to run and time the analysis without the
+skylab datasets, the HESE scan files and the simulation on the cluster.
+
+Writes the data and MC samples, the truncated HESE source maps (replacing
+`01-create_hese_equatorial_maps.py`) and the HESE like MC IDs (replacing the
+`04-check_hese_mc_ids*.py` scripts). See `_synthetic.py` for the environment
+variables to run the pipeline on it, eg.:
+
+    export HESE_STACKING_ROOT=/tmp/hese_offline HESE_STACKING_SYNTHETIC=1
+    python make_synthetic_data.py --scale 0.1
+    python 00-make_time_window_list.py
+    python 02-make_runlists.py
+    python 03-make_source_files.py
+    python 05-prepare_data_and_mc.py
+    ...
+"""
+
+from __future__ import print_function, division
+
+import os
+import argparse
+import numpy as np
+
+from _paths import PATHS
+from _saver import column_file_saver
+import _synthetic
+
+
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("--scale", type=float, default=1.,
+                    help="Number of data and MC events relative to the " +
+                         "real samples.")
+parser.add_argument("--nsrcs", type=int, default=22)
+parser.add_argument("--nside", type=int, default=32)
+parser.add_argument("--rnd_seed", type=int, default=0)
+args = parser.parse_args()
+
+rndgen = np.random.RandomState(args.rnd_seed)
+
+data_path = _synthetic.datasets_path()
+tracks = _synthetic.SyntheticTracks(data_path)
+map_path = os.path.join(PATHS.local, "hese_scan_maps_truncated")
+heseid_path = os.path.join(PATHS.local, "check_hese_mc_ids")
+for _p in [data_path, map_path, heseid_path]:
+    if not os.path.isdir(_p):
+        os.makedirs(_p)
+
+# Data per sample
+run_tables = []
+for name in sorted(_synthetic.SAMPLES.keys()):
+    exp_file, _ = tracks.files(name)
+    exp, runs = _synthetic.make_exp(name, args.scale, rndgen)
+    np.save(exp_file, exp)
+    print("Sample {}: {} events in {} runs, saved to:\n  {}".format(
+        name, len(exp), len(runs), exp_file))
+    # Sources are placed inside the run start, stop estimated from data, as
+    # done for the runlists in `02-make_runlists.py`. Skip the first runs,
+    # which are excluded there for some samples
+    runs_ev = np.unique(exp["Run"])[3:]
+    first = np.searchsorted(exp["Run"], runs_ev, side="left")
+    last = np.searchsorted(exp["Run"], runs_ev, side="right") - 1
+    run_tables.append((runs_ev, exp["time"][first], exp["time"][last]))
+
+# MC per MC set, shared by samples as in the real datasets
+for mc_name in sorted(set(sam[-1] for sam in _synthetic.SAMPLES.values())):
+    mc_file = os.path.join(data_path, mc_name + "_mc.npy")
+    mc = _synthetic.make_mc(mc_name, args.scale, rndgen)
+    np.save(mc_file, mc)
+    print("MC {}: {} events, saved to:\n  {}".format(
+        mc_name, len(mc), mc_file))
+
+    fname = os.path.join(heseid_path, mc_name + ".npy")
+    hese_ids = _synthetic.make_hese_ids(mc)
+    _synthetic.save_hese_ids(fname, hese_ids)
+    print("  {} HESE like IDs saved to:\n    {}".format(len(hese_ids), fname))
+
+# Source maps
+maps = _synthetic.make_source_maps(args.nsrcs, args.nside, rndgen, run_tables)
+for cols, meta in maps:
+    fname = os.path.join(map_path, "{:06d}.cols".format(meta["run_id"]))
+    column_file_saver(fname, cols=cols, meta=meta)
+print("Saved {} source maps to:\n  {}".format(len(maps), map_path))
@@ -0,0 +1,238 @@
+# coding: utf-8
+
+"""
+Report the module level import time of the entry scripts.
+
+Each script is profiled in a fresh process: its top level import statements
+are parsed from the source and executed one by one, without running the
+script itself. The time of every statement and the self time of the heaviest
+modules it pulled in are reported, so slow imports on the startup path of the
+trial jobs are easy to spot. Heavy dependencies only needed by some code paths
+belong into the functions using them, as done in `_loader.py` and
+`_models.py`.
+
+With `--budget` the script exits with an error, if any profiled script needs
+longer than the given number of seconds for its imports. Statements failing
+to import, eg. `icecube` outside of an icetray environment, are reported and
+fail the budget check too, because the script's import time is unknown then.
+Profile only the scripts available in the current environment in that case.
+
+Examples:
+
+    python profile_imports.py                    # All entry scripts
+    python profile_imports.py 07-bg_trials.py --top 20
+    python profile_imports.py --budget 2 --outfile import_times.json
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import ast
+import json
+import time
+import argparse
+import subprocess
+from glob import glob
+
+try:
+    import __builtin__ as _builtins
+except ImportError:
+    import builtins as _builtins
+
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+# Entry scripts without a numbered prefix
+EXTRA_SCRIPTS = ["run_pipeline.py", "bench_trials.py", "make_synthetic_data.py"]
+
+
+def top_level_imports(fname):
+    """
+    Top level import statements of a script, including imports wrapped in
+    ``try`` blocks for optional dependencies.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the script.
+
+    Returns
+    -------
+    nodes : list of ``ast`` nodes
+        Import statements in source order, without ``__future__`` imports.
+    """
+    with open(fname) as inf:
+        tree = ast.parse(inf.read(), filename=fname)
+    imports = (ast.Import, ast.ImportFrom)
+    # ``ast.TryExcept`` in python 2, ``ast.Try`` in python 3
+    trys = tuple(getattr(ast, name) for name in ("Try", "TryExcept")
+                 if hasattr(ast, name))
+    nodes = []
+    for node in tree.body:
+        if isinstance(node, ast.ImportFrom) and node.module == "__future__":
+            continue
+        if isinstance(node, imports):
+            nodes.append(node)
+        elif (isinstance(node, trys) and
+                all(isinstance(n, imports) for n in node.body)):
+            nodes.append(node)
+    return nodes
+
+
+def profile_single(fname):
+    """
+    Execute the top level imports of a script in this process and time them.
+
+    Returns
+    -------
+    res : dict
+        ``"statements"``: list of ``[lineno, source, seconds, error]``,
+        ``"modules"``: list of ``[name, self_seconds, inclusive_seconds]``
+        for each module imported for the first time, ``"total"``: summed
+        statement times in seconds.
+    """
+    with open(fname) as inf:
+        lines = inf.read().splitlines()
+
+    # Record the inclusive time of each first time import and subtract it
+    # from the enclosing import to get the self times
+    orig_import = _builtins.__import__
+    modules, stack = [], []
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        args = (name, globals, locals, fromlist, level)
+        name = _absolute_name(name, globals, level)
+        if name in sys.modules:
+            return orig_import(*args)
+        stack.append(0.)
+        t0 = time.time()
+        try:
+            return orig_import(*args)
+        finally:
+            dt = time.time() - t0
+            child_time = stack.pop()
+            if stack:
+                stack[-1] += dt
+            modules.append([name, dt - child_time, dt])
+
+    statements, total = [], 0.
+    _builtins.__import__ = timed_import
+    try:
+        for node in top_level_imports(fname):
+            mod = ast.Module(body=[node])
+            mod.type_ignores = []
+            code = compile(ast.fix_missing_locations(mod), fname, "exec")
+            err = None
+            t0 = time.time()
+            try:
+                exec(code, {"__name__": "__profiled__"})
+            except Exception as exc:
+                err = "{}: {}".format(type(exc).__name__, exc)
+            dt = time.time() - t0
+            if err is None:
+                total += dt
+            statements.append([node.lineno, lines[node.lineno - 1].strip(),
+                               dt, err])
+    finally:
+        _builtins.__import__ = orig_import
+
+    return {"statements": statements, "modules": modules, "total": total}
+
+
+def _absolute_name(name, globals, level):
+    """ Resolve relative imports, ``level <= 0`` are absolute in python 2 """
+    if level <= 0 or not globals:
+        return name
+    package = globals.get("__package__") or globals.get("__name__", "")
+    if "__path__" not in globals and not globals.get("__package__"):
+        package = package.rpartition(".")[0]
+    base = package.rsplit(".", level - 1)[0]
+    return base + "." + name if name else base
+
+
+def profile_all(scripts):
+    """ Profile each script in a fresh interpreter """
+    results = {}
+    for script in scripts:
+        cmd = [sys.executable, os.path.abspath(__file__), "--single", script]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=REPO)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            print("Profiling {} failed:\n{}".format(script, err.decode()))
+            continue
+        # The imports may print, the result is the last line
+        results[script] = json.loads(out.decode().strip().splitlines()[-1])
+    return results
+
+
+def print_report(script, res, top, min_sec):
+    """ Print statement times and the modules with the largest self time """
+    print("{} : {:.3f} s".format(script, res["total"]))
+    for lineno, src, dt, err in res["statements"]:
+        if err is not None:
+            print("  {:4d} {:>8s}  {}\n         {}".format(
+                lineno, "failed", src, err))
+        elif dt >= min_sec:
+            print("  {:4d} {:7.3f}s  {}".format(lineno, dt, src))
+    mods = sorted(res["modules"], key=lambda m: m[1], reverse=True)[:top]
+    mods = [m for m in mods if m[1] >= min_sec]
+    if mods:
+        print("  Heaviest modules (self / inclusive):")
+        for name, self_dt, incl_dt in mods:
+            print("    {:7.3f}s {:7.3f}s  {}".format(self_dt, incl_dt, name))
+
+
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("scripts", type=str, nargs="*",
+                    help="Scripts to profile. Default: all entry scripts.")
+parser.add_argument("--top", type=int, default=10,
+                    help="Number of heaviest modules shown per script.")
+parser.add_argument("--min_sec", type=float, default=0.005,
+                    help="Hide statements and modules faster than this.")
+parser.add_argument("--budget", type=float, default=None,
+                    help="Fail if a script's imports take longer [s].")
+parser.add_argument("--outfile", type=str, default=None,
+                    help="Also save the raw results as JSON.")
+# Internal: profile a single script in this process
+parser.add_argument("--single", type=str, default=None,
+                    help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+if args.single:
+    print(json.dumps(profile_single(args.single)))
+    sys.exit()
+
+scripts = args.scripts
+if not scripts:
+    scripts = sorted(os.path.basename(f) for f in
+                     glob(os.path.join(REPO, "[0-9][0-9]-*.py")))
+    scripts += EXTRA_SCRIPTS
+
+results = profile_all(scripts)
+for script in scripts:
+    if script in results:
+        print_report(script, results[script], args.top, args.min_sec)
+
+if args.outfile is not None:
+    with open(args.outfile, "w") as outf:
+        json.dump(results, fp=outf, indent=1, sort_keys=True)
+        print("Saved import times to:\n  {}".format(args.outfile))
+
+if args.budget is not None:
+    over = [s for s in scripts if s in results and
+            results[s]["total"] > args.budget]
+    # Failed imports don't have a meaningful time, so they can't pass
+    failed = [s for s in scripts if s not in results or
+              any(st[3] is not None for st in results[s]["statements"])]
+    if over:
+        print("Import time over budget of {:.2f} s:".format(args.budget))
+        for script in over:
+            print("  {}: {:.3f} s".format(script, results[script]["total"]))
+    if failed:
+        print("Imports failed, time unknown:")
+        for script in failed:
+            print("  {}".format(script))
+    if over or failed:
+        sys.exit(1)
+    print("All imports within budget of {:.2f} s.".format(args.budget))
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+"""
+Run the analysis stages 00 - 10 make-style: only stages whose code, arguments
+or input contents changed since their last successful run are executed,
+independent stages run concurrently. See `_pipeline.py` for the stage
+definitions and the staleness rules.
+
+Cluster only stages (`01` HESE maps and `04` HESE MC IDs) are not run unless
+`--cluster` is given, their existing outputs are used as inputs. The `04` jobs
+are only written as DAG files by `hese_mc_ids_jobs`. Once the submitted jobs
+are done, combine them with `--cluster hese_mc_ids`, this manual stage is
+never run implicitly. Trial stages run their jobs locally with `--local`, see
+the `_jobs.py` scripts.
+Logs are written to `PATHS.jobs/pipeline`.
+
+Examples:
+
+    python run_pipeline.py --dry_run       # Show the stale stages
+    python run_pipeline.py                 # Bring everything up to date
+    python run_pipeline.py bg_pdfs         # Only what's needed for the PDFs
+    python run_pipeline.py --force settings
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+
+from _paths import PATHS
+from _pipeline import Pipeline, default_stages
+
+
+parser = argparse.ArgumentParser(description="hese_stacking")
+parser.add_argument("stages", type=str, nargs="*",
+                    help="Target stages. Default: all.")
+parser.add_argument("--force", type=str, nargs="+", default=None,
+                    help="Stages to rerun even if up to date.")
+parser.add_argument("--nworkers", type=int, default=2,
+                    help="Number of stages running concurrently.")
+parser.add_argument("--job_workers", type=int, default=None,
+                    help="Concurrent local jobs per trial stage. " +
+                         "Default: all cores.")
+parser.add_argument("--sig_inj", type=str, default="ps")
+parser.add_argument("--cluster", action="store_true",
+                    help="Also run the cluster only stages.")
+parser.add_argument("--dry_run", action="store_true")
+parser.add_argument("--list", action="store_true",
+                    help="List the stages and their dependencies.")
+args = parser.parse_args()
+
+stages = default_stages(sig_inj=args.sig_inj, nworkers=args.job_workers)
+pipeline = Pipeline(stages,
+                    state_file=os.path.join(PATHS.local, "pipeline_state.json"),
+                    log_dir=os.path.join(PATHS.jobs, "pipeline"))
+
+if args.list:
+    for stage in stages:
+        print("{:16s} <- {}".format(stage.name,
+                                    ", ".join(pipeline.deps(stage.name))))
+        for cmd in stage.commands:
+            print("  $ " + " ".join(cmd))
+    sys.exit()
+
+status = pipeline.run(names=args.stages or None, force=args.force,
+                      nworkers=args.nworkers, dry_run=args.dry_run,
+                      cluster=args.cluster)
+
+print("Summary:")
+for name in pipeline.stages:
+    if name in status:
+        print("  {:16s}: {}".format(name, status[name]))
+if any(s in ("failed", "blocked") for s in status.values()):
+    sys.exit(1)